@@ -1,39 +1,247 @@
-from IterativeFitting import iterative_fitting
+from MultiRegionFitting import region_spec, fit_regions
 from Residuals import residuals_vinyl, residuals_pxylene
-from Consolidate import aggregate_ratio
-from RegionDataFrame import region_df_slice
+from Consolidate import area_dataframe, update_ratio_statistics, finalise_ratio_statistics
+from RegionDataFrame import region_windows, read_regions, iter_regions
+from Parameters import define_region_parameters
+from FitCache import open_fit_cache, invalidate_stale_fits
+from Instrumentation import stage
+import Instrumentation
 import pandas as pd
+import argparse
+import os
 
 vinyl_parameter = 'vinyl_parameters.xlsx'
 pxylene_parameter = 'pxylene_parameters.xlsx'
 column_indices = 'column_indices.xlsx'
 
+# Files can be .csv files or binary spectral stores converted from them with SpectralStore.py (e.g. 'df_t0.store').
+# This script processes the files one after the other. Scheduler.py processes the files of a manifest concurrently.
 file_list = ['df_t0.csv', 'df_t0_repeat.csv', 'df_t30.csv', 'df_t60.csv', 'df_t90.csv', 'df_t120.csv']
 file_number = 0
 
-for file in file_list:
-    file_number += 1
-    print('Currently Processing File Number ' + str(file_number) + ' out of ' + str(len(file_list)))
-    print('File name is: ', file)
+# Number of worker processes used to fit the spectra in parallel. The default of 1 fits serially in the current
+# process, as the script always did. Parallel fitting is opted into here or with --workers, e.g. os.cpu_count() to use
+# every CPU, which is best left for machines which are not shared.
+workers = 1
 
-    df = pd.read_csv(file)
+# Fit the vinyl and p-xylene regions of every chunk of spectra concurrently on the worker processes, instead of one
+# after the other within each worker.
+concurrent_regions = False
 
-    df_vinyl, df_pxylene = region_df_slice(column_indices, file)
+# Fitting engine: 'lmfit' fits every spectrum with its own Minimizer, 'batched' fits all spectra of a region at once.
+engine = 'lmfit'
 
-    vinyl_bestfit_params, vinyl_r2_score, vinyl_area = iterative_fitting(df_region=df_vinyl,
-                                                                         parameter_filename=vinyl_parameter,
-                                                                         region='vinyl',
-                                                                         residuals=residuals_vinyl)
+# Seed every fit with the best fit parameters of the previous spectrum instead of the spreadsheet guesses.
+warm_start = False
 
-    pxylene_bestfit_params, pxylene_r2_score, pxylene_area = iterative_fitting(df_region=df_pxylene,
-                                                                               parameter_filename=pxylene_parameter,
-                                                                               region='pxylene',
-                                                                               residuals=residuals_pxylene)
+# Number of spectra read, fitted and released at a time. Set to None to read each file into memory at once.
+chunksize = None
 
-    df_ratio = aggregate_ratio(df=df,
-                               vinyl_area=vinyl_area, vinyl_r2_score=vinyl_r2_score,
-                               pxylene_area=pxylene_area, pxylene_r2_score=pxylene_r2_score,
-                               filename=file[:-4])
+# Number of spectra fitted between two checkpoints when a whole file is read into memory. When streaming, every chunk
+# is a checkpoint. The per-spectrum results of every checkpoint are appended to a _fits.csv file next to the
+# _ratio.csv file, and a .done marker file is written once a file is complete, so that a run interrupted by a crash or
+# a preempted job can be continued with --resume.
+checkpoint_every = 500
 
+# Filename of the persistent fit cache, e.g. 'fit_cache.sqlite'. Spectra fitted in a previous run with the same
+# parameters are then read from the cache instead of being fitted again. Set to None to disable the cache.
+cache = None
 
-print('Finished Processing all Files.')
+# Convergence options of the fits of each region. xtol and ftol are the relative tolerances of the parameters and of
+# the sum of squares, and max_nfev caps the function evaluations of each fit (None keeps the lmfit defaults). Spectra
+# whose baseline-corrected signal-to-noise ratio is below min_snr are not fitted at all (None fits every spectrum).
+# Capped, failed and skipped fits are flagged in the Fit Status columns of the _fits.csv file and left out of the
+# aggregate ratio. E.g. {'xtol': 1e-6, 'ftol': 1e-6, 'max_nfev': 300, 'min_snr': 5} stops hopeless spectra early.
+fit_options = {'vinyl': {'xtol': 1.5e-8, 'ftol': 1.5e-8, 'max_nfev': None, 'min_snr': None},
+               'pxylene': {'xtol': 1.5e-8, 'ftol': 1.5e-8, 'max_nfev': None, 'min_snr': None}}
+
+# Quantiles of the ratio of every condition written as extra columns of the _ratio.csv files, e.g. [0.25, 0.5, 0.75],
+# estimated from mergeable sketches to within Consolidate.sketch_accuracy. None writes the mean and std only.
+quantiles = None
+
+# Record the wall time and call count of every stage of the pipeline, and the function evaluations, convergence
+# status and seconds of every fit. A _profile.json summary, including the slowest spectra, and a _profile.csv file of
+# every fit are written next to the _ratio.csv file of every file. Can also be enabled with --profile.
+profile = False
+
+
+def fit_spectra(df_labels, region_frames, specs):
+    """
+    Fit both regions of a block of spectra in a single pass.
+
+    :param df_labels: DataFrame of the original index and Condition columns of the spectra.
+    :param region_frames: Dictionary mapping 'vinyl' and 'pxylene' to the DataFrames of the regions of the spectra.
+    :param specs: List of the region specs of both regions, created by MultiRegionFitting.region_spec.
+
+    :return: df_area - DataFrame of the per-spectrum AUCs and R2 scores, as created by Consolidate.area_dataframe.
+    """
+    with stage('fit'):
+        records = fit_regions(region_frames=region_frames,
+                              region_specs=specs,
+                              workers=workers,
+                              concurrent_regions=concurrent_regions,
+                              engine=engine,
+                              warm_start=warm_start,
+                              cache=cache)
+
+    df_area = area_dataframe(df=df_labels,
+                             vinyl_area=[record['vinyl'][2] for record in records],
+                             vinyl_r2_score=[record['vinyl'][1] for record in records],
+                             pxylene_area=[record['pxylene'][2] for record in records],
+                             pxylene_r2_score=[record['pxylene'][1] for record in records],
+                             vinyl_status=[record['vinyl'][3] for record in records],
+                             pxylene_status=[record['pxylene'][3] for record in records])
+
+    return df_area
+
+
+def extract_ratio(file, chunksize=None, resume=False):
+    """
+    Fit both regions of every spectrum in the file and write the aggregate AUC ratio of every condition to a
+    _ratio.csv file.
+
+    If chunksize is None, the whole file is read into memory at once. Otherwise the spectra are streamed from the file
+    in chunks of chunksize rows, and every chunk is baseline-corrected and fitted, then released before the next chunk
+    is read. The memory use is then bounded by the chunk size, for files larger than the available memory. Either way,
+    the aggregate statistics of the ratio are accumulated per condition as every block of spectra is fitted, see
+    Consolidate.update_ratio_statistics.
+
+    The per-spectrum AUCs and R2 scores are appended to a _fits.csv file after every checkpoint_every spectra (or
+    every chunk when streaming), and a .done marker file is written when the file is complete. If resume is True,
+    a file with a .done marker is skipped, and a file with a partial _fits.csv file is continued from the spectrum
+    after the last checkpoint.
+
+    :param file: String of the raw data filename with the .csv extension, or the directory of a spectral store.
+    :param chunksize: Integer number of spectra in each chunk when streaming, or None.
+    :param resume: Boolean. If True, continue from the checkpoints of a previous run.
+
+    :return: df_ratio - DataFrame of the condition label, the mean ratio and the standard deviation of the ratio.
+    """
+    name = os.path.splitext(file)[0]
+    fits_filename = name + '_fits.csv'
+    done_filename = name + '.done'
+
+    if resume and os.path.exists(done_filename):
+        print('File was already completed by a previous run, skipping.')
+        return pd.read_csv(name + '_ratio.csv')
+
+    # Profile the file only once it is known to be processed, and stop profiling even if the file fails, so that the
+    # profile of the next file handled by the process only records that file.
+    if profile:
+        Instrumentation.enable()
+    try:
+        if os.path.exists(done_filename):
+            os.remove(done_filename)
+
+        start = checkpointed_spectra(fits_filename) if resume else 0
+        if start == 0 and os.path.exists(fits_filename):
+            os.remove(fits_filename)  # Start the file from scratch.
+        elif start > 0:
+            print('Resuming after ' + str(start) + ' spectra completed by a previous run.')
+
+        # Read the column windows and the parameter spreadsheets once for all blocks of spectra.
+        windows = region_windows(column_indices, regions=('vinyl', 'pxylene'))
+        specs = [region_spec('vinyl', windows['vinyl'], residuals_vinyl, define_region_parameters(vinyl_parameter),
+                             fit_options=fit_options['vinyl']),
+                 region_spec('pxylene', windows['pxylene'], residuals_pxylene,
+                             define_region_parameters(pxylene_parameter), fit_options=fit_options['pxylene'])]
+
+        if chunksize is None:
+            # Parse the file once, keeping only the label columns and the columns of the two regions.
+            df_labels, region_frames = read_regions(file, windows)
+            blocks = [(df_labels.iloc[row:row + checkpoint_every],
+                       {region: df_region.iloc[row:row + checkpoint_every]
+                        for region, df_region in region_frames.items()})
+                      for row in range(start, len(df_labels), checkpoint_every)]
+        else:
+            blocks = iter_regions(file, windows, chunksize, start=start)
+
+        # Running count, mean and M2 of the ratio of every condition, including the spectra of a previous run.
+        statistics = {}
+        if start > 0:
+            for df_area in pd.read_csv(fits_filename, chunksize=chunksize or checkpoint_every):
+                update_ratio_statistics(statistics, df_area, sketch=quantiles is not None)
+
+        for df_labels, region_frames in blocks:
+            df_area = fit_spectra(df_labels, region_frames, specs)
+
+            # Checkpoint the block by appending it to the results file, with the header only at the start of the file.
+            with stage('checkpoint'):
+                df_area.to_csv(fits_filename, mode='a', header=not os.path.exists(fits_filename), index=False)
+
+            with stage('aggregation'):
+                update_ratio_statistics(statistics, df_area, sketch=quantiles is not None)
+
+        with stage('aggregation'):
+            df_ratio = finalise_ratio_statistics(statistics, filename=name, quantiles=quantiles)
+
+        open(done_filename, 'w').close()  # Mark the file as completed.
+
+        if profile:
+            Instrumentation.report(name)
+    finally:
+        if profile:
+            Instrumentation.disable()
+
+    return df_ratio
+
+
+def checkpointed_spectra(fits_filename):
+    """
+    Count the spectra checkpointed in a _fits.csv file by a previous run. If the previous run was killed while writing
+    a checkpoint, the incomplete last line is removed from the file first.
+
+    :param fits_filename: String of the _fits.csv filename.
+    :return: Integer number of spectra in the file, 0 if the file does not exist.
+    """
+    if not os.path.exists(fits_filename):
+        return 0
+
+    with open(fits_filename, 'rb+') as f:
+        contents = f.read()
+        if contents and not contents.endswith(b'\n'):
+            f.truncate(contents.rfind(b'\n') + 1)  # Keep everything up to the last complete line.
+            contents = contents[:contents.rfind(b'\n') + 1]
+
+    return max(contents.count(b'\n') - 1, 0)  # Do not count the header line.
+
+
+def invalidate_cache():
+    """
+    Reclaim the space of the fits made with previous versions of the parameter spreadsheets in the fit cache, if the
+    cache is enabled. Called once before a batch of files is processed.
+    """
+    if cache is not None:
+        connection = open_fit_cache(cache)
+        invalidate_stale_fits(connection, 'vinyl', define_region_parameters(vinyl_parameter))
+        invalidate_stale_fits(connection, 'pxylene', define_region_parameters(pxylene_parameter))
+        connection.close()
+
+
+# The worker processes re-import this script, so the processing loop must only run in the main process.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract the AUC ratio of every condition from the files of '
+                                                 'file_list.')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip files completed by a previous run and continue partial files from their last '
+                             'checkpoint')
+    parser.add_argument('--profile', action='store_true',
+                        help='write a _profile.json and a _profile.csv file of the stage timings and fit statistics '
+                             'of every file')
+    parser.add_argument('--workers', type=int, default=workers,
+                        help='number of worker processes fitting the spectra in parallel (default: ' + str(workers) +
+                             ', i.e. serial)')
+    args = parser.parse_args()
+    profile = profile or args.profile
+    workers = args.workers
+
+    invalidate_cache()
+
+    for file in file_list:
+        file_number += 1
+        print('Currently Processing File Number ' + str(file_number) + ' out of ' + str(len(file_list)))
+        print('File name is: ', file)
+
+        df_ratio = extract_ratio(file, chunksize=chunksize, resume=args.resume)
+
+    print('Finished Processing all Files.')
@@ -39,3 +39,51 @@ def baseline_subtraction_function(region):
     y_subtracted = y - linear_fit  # Subtract linear_fit array from y array.
 
     return linear_fit, y_subtracted
+
+
+def baseline_subtraction_matrix(x, y, overwrite=False):
+    """
+    Matrix version of baseline_subtraction_function, which subtracts the linear baselines of many spectra at once.
+
+    For every row of y, a linear baseline is fitted to the left-most 5 and right-most 5 x and y values, exactly as in
+    baseline_subtraction_function. As all rows share the same x-values, the linear least-squares problem is solved for
+    all rows in a single closed-form step: the slope of each row is the covariance of the 10 extreme x and y values
+    divided by the variance of the 10 extreme x values, and the intercept follows from the means.
+
+    The baselines agree with baseline_subtraction_function to floating point rounding (relative differences of the
+    order of 1e-15), as only the order of the arithmetic differs.
+
+    :param x: Numpy array of x-values of shape (M,)
+    :param y: Numpy array of y-values of shape (N, M), one spectrum per row.
+    :param overwrite: Boolean. If True, the baseline-corrected values are written into y itself to avoid allocating a
+                      second (N, M) array. y must then be a writeable float Numpy array.
+
+    :return: linear_fit - Numpy array of shape (N, M) containing the linear baseline of every spectrum.
+             y_subtracted - Numpy array of shape (N, M) containing the y-values after baseline subtraction. This is y
+                            itself if overwrite is True.
+    """
+    x = np.asarray(x, dtype=float)
+    if not overwrite:
+        y = np.asarray(y, dtype=float)
+
+    # Leftmost 5 and rightmost 5 x values, and the same columns of every spectrum.
+    x_extreme = np.concatenate((x[:5], x[-5:]))
+    y_extreme = np.concatenate((y[:, :5], y[:, -5:]), axis=1)
+
+    # Closed-form linear least-squares fit of y = ax + b to the extreme values of all rows at once.
+    x_centered = x_extreme - x_extreme.mean()
+    y_mean = y_extreme.mean(axis=1)
+    # The row sums are written out rather than using a matrix product, whose rounding could depend on the number of
+    # rows, so that every row gets exactly the same baseline however the rows are split into chunks.
+    slope = np.sum(y_extreme * x_centered, axis=1) / np.sum(x_centered * x_centered)
+    intercept = y_mean - slope * x_extreme.mean()
+
+    linear_fit = slope[:, np.newaxis] * x + intercept[:, np.newaxis]  # Baselines of all rows, shape (N, M).
+
+    if overwrite:
+        y -= linear_fit  # Subtract the baselines in place.
+        y_subtracted = y
+    else:
+        y_subtracted = y - linear_fit
+
+    return linear_fit, y_subtracted
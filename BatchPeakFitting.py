@@ -0,0 +1,279 @@
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+import time
+from itertools import repeat
+from RegionDataFrame import find_nearest
+from Residuals import residuals_lorentzian, residuals_gaussian, residuals_pseudo_voigt
+from CurveFitting import peak_shape, area_components
+from BaselineSubtractionFunction import baseline_subtraction_matrix
+from MultiRegionFitting import region_spec, fit_regions
+from SpectralStore import read_spectra_table
+
+# Scripted, non-interactive mode of GuidedSinglePeakFitting.py, for cluster jobs and for fitting many datasets
+# unattended. The answers to the prompts of the guided script are taken from a .json config file and/or command-line
+# flags instead, no plots are made, and all spectra are fitted through MultiRegionFitting.fit_regions, in parallel or
+# with the batched engine. The same _results.csv and _summary.csv files are written.
+#
+# With the lineshape 'auto', every candidate lineshape is fitted to every spectrum in the same pass, and the best
+# lineshape is chosen per spectrum by the BIC, the AIC or the R2 score, instead of one lineshape for the whole dataset.
+#
+# Example config file, with the keys of default_config:
+#     {"file": "spectra.csv", "left": 790, "right": 830, "baseline": true, "lineshape": "lorentzian",
+#      "amplitude": 20000, "center": 808, "half_width": 5}
+
+# Default settings, overridden by the config file, which is itself overridden by the command-line flags.
+default_config = {'file': None,  # .csv file or spectral store of the spectra, as asked by the guided script.
+                  'label_columns': 0,  # Number of leading label columns of the file, e.g. 2 for the df_t*.csv files.
+                  'left': None,  # Left-most x-value of the region of interest.
+                  'right': None,  # Right-most x-value of the region of interest.
+                  'baseline': True,  # Subtract a linear baseline from every spectrum before fitting.
+                  'lineshape': 'lorentzian',  # 'lorentzian', 'gaussian', 'pseudo_voigt' or 'auto'.
+                  'candidates': ['lorentzian', 'gaussian'],  # Lineshapes compared by 'auto', e.g. + 'pseudo_voigt'.
+                  'criterion': 'bic',  # 'bic', 'aic' or 'r2', used by 'auto' to choose the lineshape of each spectrum.
+                  'amplitude': None,  # Initial guess of the amplitude of the peak.
+                  'center': None,  # Initial guess of the center of the peak.
+                  'half_width': None,  # Initial guess of the half-width at half-maximum of the peak.
+                  'fraction': 0.5,  # Initial guess of the Lorentzian fraction of a pseudo-Voigt peak.
+                  'engine': 'lmfit',  # 'lmfit' fits every spectrum with its own Minimizer, 'batched' all at once.
+                  'workers': 1,  # Number of worker processes of the 'lmfit' engine.
+                  'output': None}  # Output filename without the extension. Defaults to the filename of the spectra.
+
+# Residual function of every lineshape, as in the guided script.
+objective_functions = {'lorentzian': residuals_lorentzian,
+                       'gaussian': residuals_gaussian,
+                       'pseudo_voigt': residuals_pseudo_voigt}
+
+criteria = ('bic', 'aic', 'r2')
+
+
+def read_config(filename=None, **overrides):
+    """
+    Read the settings of a batch fit from a .json config file, and apply the overrides, e.g. the command-line flags.
+
+    :param filename: Optional string of the .json config filename. None uses the defaults.
+    :param overrides: Settings which replace the values of the config file. None values are ignored.
+
+    :return: config - Dictionary of all settings of default_config.
+    """
+    config = dict(default_config)
+
+    if filename is not None:
+        with open(filename) as f:
+            file_config = json.load(f)
+        unknown = [key for key in file_config if key not in default_config]
+        if unknown:
+            raise ValueError('Unknown settings in ' + filename + ': ' + ', '.join(unknown))
+        config.update(file_config)
+
+    config.update({key: value for key, value in overrides.items() if value is not None})
+
+    missing = [key for key in ('file', 'left', 'right', 'amplitude', 'center', 'half_width') if config[key] is None]
+    if missing:
+        raise ValueError('The settings ' + ', '.join(missing) + ' are required for a batch fit')
+    if config['lineshape'] != 'auto' and config['lineshape'] not in objective_functions:
+        raise ValueError("Please specify in strings whether the lineshape is 'lorentzian', 'gaussian', "
+                         "'pseudo_voigt' or 'auto'")
+    if any(candidate not in objective_functions for candidate in config['candidates']):
+        raise ValueError('Unknown candidate lineshapes ' + ', '.join(config['candidates']))
+    if config['criterion'] not in criteria:
+        raise ValueError("Please specify in strings whether the criterion is 'bic', 'aic' or 'r2'")
+
+    return config
+
+
+def fit_dataset(config):
+    """
+    Fit the single peak of the region of interest of every spectrum of a dataset, as the guided script does after its
+    prompts, and write the _results.csv file of the fit results of every spectrum and the _summary.csv file of their
+    summary statistics.
+
+    The columns of the _results.csv file are those of the guided script: the best fit p1_amplitude, p1_center and
+    p1_half_width (and p1_fraction for pseudo-Voigt peaks), the r2_score, fwhm, height and auc, followed by the status
+    of every fit ('ok', 'capped' or 'failed', see IterativeFitting.fit_array). The auc is integrated from the best fit
+    lineshape rather than from the y-values plus the residuals, which is the same curve up to rounding.
+
+    If the lineshape is 'auto', all candidate lineshapes are fitted to every spectrum in a single pass over the
+    spectra, and the columns are those of the lineshape chosen for each spectrum, i.e. the converged fit with the
+    lowest BIC or AIC, or the highest R2 score. The chosen lineshape is recorded in a lineshape column, and the
+    criterion of every candidate in a <criterion>_<lineshape> column.
+
+    :param config: Dictionary of settings, as returned by read_config.
+    :return: results - DataFrame of the fit results of every spectrum.
+    """
+    output_name = config['output'] or os.path.splitext(config['file'])[0]
+
+    df = read_spectra_table(config['file'])
+    df = df.iloc[:, config['label_columns']:]
+    x = np.array(df.columns, dtype=float)
+
+    # Slice the region of interest between the columns nearest to the left-most and right-most x-values.
+    leftmost_index = find_nearest(x, config['left'])[0]
+    rightmost_index = find_nearest(x, config['right'])[0]
+    region = df.iloc[:, leftmost_index: rightmost_index]
+    region.index = range(len(region))  # Number the spectra from 0, as the guided script does.
+
+    auto = config['lineshape'] == 'auto'
+    lineshapes = list(config['candidates']) if auto else [config['lineshape']]
+
+    # Fit every lineshape as a separate region of the same spectra, so that all of them are fitted in one pass.
+    specs = [region_spec(lineshape, (leftmost_index, rightmost_index), objective_functions[lineshape],
+                         peak_parameters(lineshape, config)) for lineshape in lineshapes]
+    records = fit_regions(region_frames={lineshape: region for lineshape in lineshapes},
+                          region_specs=specs,
+                          workers=config['workers'],
+                          engine=config['engine'],
+                          baseline=config['baseline'])
+
+    fits = {lineshape: fit_results(lineshape, [record[lineshape] for record in records]) for lineshape in lineshapes}
+
+    if not auto:
+        results = fits[config['lineshape']]
+    else:
+        region_x = np.array(region.columns, dtype=float)
+        y = region.to_numpy(dtype=float)
+        if config['baseline']:
+            linear_fit, y = baseline_subtraction_matrix(region_x, y)
+
+        # Score every lineshape, leaving out the fits which did not converge, and choose the best one per spectrum.
+        scores = np.array([selection_scores(config['criterion'], region_x, y, lineshape, fits[lineshape])
+                           for lineshape in lineshapes])
+        choice = np.argmin(scores, axis=0)
+
+        # Take the rows of every spectrum from the table of its chosen lineshape. The p1_fraction column is only filled
+        # for the spectra with a pseudo-Voigt peak.
+        columns = list(dict.fromkeys(column for lineshape in lineshapes for column in fits[lineshape].columns))
+        tables = [fits[lineshape].reindex(columns=columns) for lineshape in lineshapes]
+        results = tables[0].copy()
+        for position in range(1, len(lineshapes)):
+            chosen = choice == position
+            results.loc[chosen] = tables[position].loc[chosen]
+        results['lineshape'] = np.array(lineshapes)[choice]
+        for position, lineshape in enumerate(lineshapes):
+            score = scores[position]
+            results[config['criterion'] + '_' + lineshape] = -score if config['criterion'] == 'r2' else score
+
+    results.to_csv(output_name + '_results.csv')
+    results.describe().to_csv(output_name + '_summary.csv')
+
+    return results
+
+
+def peak_parameters(lineshape, config):
+    """
+    Create the Parameters object of a lineshape from the initial guesses of the config, as the guided script does.
+
+    :param lineshape: String indicating either 'lorentzian', 'gaussian' or 'pseudo_voigt'.
+    :param config: Dictionary of settings, as returned by read_config.
+    :return: parameters - Parameters object of the peak.
+    """
+    from lmfit import Parameters
+
+    parameters = Parameters()
+    parameters.add(name='p1_amplitude', value=config['amplitude'], min=0)
+    parameters.add(name='p1_center', value=config['center'], min=0)
+    parameters.add(name='p1_half_width', value=config['half_width'], min=0)
+    if lineshape == 'pseudo_voigt':
+        parameters.add(name='p1_fraction', value=config['fraction'], min=0, max=1)
+
+    return parameters
+
+
+def fit_results(lineshape, region_records):
+    """
+    Tabulate the fits of one lineshape with the columns of the _results.csv file.
+
+    :param lineshape: String indicating either 'lorentzian', 'gaussian' or 'pseudo_voigt'.
+    :param region_records: List of the (bestfit_params, r2_score, area, status) tuple of every spectrum.
+    :return: results - DataFrame of the fit results of every spectrum.
+    """
+    bestfit_params_list, r2_score_list, area_list, status_list = zip(*region_records)
+
+    results = pd.DataFrame(list(bestfit_params_list))
+    results['r2_score'] = r2_score_list
+    fractions = results['p1_fraction'].to_numpy() if 'p1_fraction' in results else repeat(None)
+    fwhm, height = zip(*[peak_shape(lineshape, amplitude, half_width, fraction) for amplitude, half_width, fraction
+                         in zip(results['p1_amplitude'].to_numpy(), results['p1_half_width'].to_numpy(), fractions)])
+    results['fwhm'] = fwhm
+    results['height'] = height
+    results['auc'] = area_list
+    results['status'] = status_list
+
+    return results
+
+
+def selection_scores(criterion, x, y, lineshape, results):
+    """
+    Score the fits of one lineshape for the automatic lineshape selection, such that the lowest score is the best.
+
+    The AIC and BIC are those of lmfit for a least-squares fit of N points with k varying parameters:
+    AIC = N ln(chi2 / N) + 2 k and BIC = N ln(chi2 / N) + ln(N) k, where chi2 is the sum of squared residuals. Unlike
+    the R2 score, they penalise the extra parameter of the pseudo-Voigt lineshape. Fits which did not converge, and
+    fits without a result, are given an infinite score so that they are never chosen over a converged fit.
+
+    :param criterion: String indicating either 'bic', 'aic' or 'r2'.
+    :param x: Numpy array of the x-values of the region, of shape (M,)
+    :param y: Numpy array of the fitted y-values of shape (N, M), i.e. after the baseline subtraction, if any.
+    :param lineshape: String indicating either 'lorentzian', 'gaussian' or 'pseudo_voigt'.
+    :param results: DataFrame of the fit results of the lineshape, as returned by fit_results.
+
+    :return: scores - Numpy array of shape (N,) of the score of every fit. For the R2 criterion, the negative R2 score.
+    """
+    function, names = area_components[lineshape]
+
+    if criterion == 'r2':
+        scores = -results['r2_score'].to_numpy(dtype=float)
+    else:
+        # Evaluate the best fit lineshapes of all spectra at once, with one column of parameters per spectrum.
+        y_model = function(x, *[results[name].to_numpy(dtype=float)[:, np.newaxis] for name in names])
+        n_points = y.shape[1]
+        chi_square = np.sum((y_model - y) ** 2, axis=1)
+        penalty = 2 if criterion == 'aic' else np.log(n_points)
+        with np.errstate(divide='ignore'):
+            scores = n_points * np.log(chi_square / n_points) + penalty * len(names)
+
+    return np.where((results['status'] == 'ok').to_numpy() & np.isfinite(scores), scores, np.inf)
+
+
+# The worker processes re-import this script, so the batch fit must only run in the main process.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit a single peak in every spectrum of a dataset without prompts, '
+                                                 'with the settings of GuidedSinglePeakFitting.py taken from a .json '
+                                                 'config file and/or the flags below.')
+    parser.add_argument('config', nargs='?', default=None, help='.json config file with the keys of default_config')
+    parser.add_argument('--file', help='.csv file or spectral store of the spectra')
+    parser.add_argument('--label-columns', type=int, help='number of leading label columns of the file (default: 0)')
+    parser.add_argument('--left', type=float, help='left-most x-value of the region of interest')
+    parser.add_argument('--right', type=float, help='right-most x-value of the region of interest')
+    parser.add_argument('--baseline', dest='baseline', action='store_const', const=True,
+                        help='subtract a linear baseline from every spectrum (default)')
+    parser.add_argument('--no-baseline', dest='baseline', action='store_const', const=False,
+                        help='fit the spectra without baseline subtraction')
+    parser.add_argument('--lineshape', choices=sorted(objective_functions) + ['auto'],
+                        help="lineshape of the peak, or 'auto' to choose the best candidate for every spectrum")
+    parser.add_argument('--candidates', nargs='+', choices=sorted(objective_functions),
+                        help="lineshapes compared by 'auto' (default: lorentzian gaussian)")
+    parser.add_argument('--criterion', choices=criteria, help="criterion used by 'auto' (default: bic)")
+    parser.add_argument('--amplitude', type=float, help='initial guess of the amplitude of the peak')
+    parser.add_argument('--center', type=float, help='initial guess of the center of the peak')
+    parser.add_argument('--half-width', type=float, help='initial guess of the half-width of the peak')
+    parser.add_argument('--fraction', type=float,
+                        help='initial guess of the Lorentzian fraction of a pseudo-Voigt peak (default: 0.5)')
+    parser.add_argument('--engine', choices=['lmfit', 'batched'], help='fitting engine (default: lmfit)')
+    parser.add_argument('--workers', type=int, help='number of worker processes of the lmfit engine (default: 1)')
+    parser.add_argument('--output', help='output filename without the extension')
+    args = vars(parser.parse_args())
+
+    config = read_config(args.pop('config'), **args)
+
+    start = time.perf_counter()
+    results = fit_dataset(config)
+
+    counts = results['status'].value_counts().to_dict()
+    print('Fitted ' + str(len(results)) + ' spectra in {:.1f} s: '.format(time.perf_counter() - start) +
+          ', '.join(str(count) + ' ' + status for status, count in counts.items()) + '.')
+    if 'lineshape' in results:
+        print('Chosen lineshapes: ' + ', '.join(str(count) + ' ' + lineshape for lineshape, count
+                                                in results['lineshape'].value_counts().items()) + '.')
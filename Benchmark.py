@@ -0,0 +1,336 @@
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from BaselineSubtractionFunction import baseline_subtraction_function, baseline_subtraction_matrix
+from BatchedFitting import region_models, lineshapes
+from Consolidate import aggregate_ratio, area_dataframe
+from CurveFitting import area_components, peak_area
+from MultiRegionFitting import region_spec, fit_regions
+from Parameters import define_region_parameters
+from RegionDataFrame import region_windows, read_regions
+from Residuals import residuals_vinyl, residuals_pxylene
+
+vinyl_parameter = 'vinyl_parameters.xlsx'
+pxylene_parameter = 'pxylene_parameters.xlsx'
+column_indices = 'column_indices.xlsx'
+
+# Raw data file whose header line provides the wavenumber axis of the synthetic spectra, so that the column indices
+# of column_indices.xlsx select the same regions as in the real data.
+template = 'df_t0.csv'
+
+
+def synthetic_spectra(n_spectra, wavenumbers, region_parameters, noise=40.0, jitter=0.05, n_conditions=9,
+                      baseline=(1000.0, -0.3), seed=0):
+    """
+    Generate synthetic Raman spectra in the layout of the df_t*.csv files: one spectrum per row, with the original
+    index as the index, a Condition column, and one column per wavenumber label.
+
+    The peaks of every region are the components of the region models of BatchedFitting.region_models, centred on
+    the initial guesses of the parameter spreadsheets. The amplitudes and widths of every spectrum are scattered by a
+    relative standard deviation of jitter, and the centers by jitter times the width, clipped to the bounds of the
+    parameters. The amplitudes of the first region decrease with the condition number, so that the ratio of the peak
+    areas varies from condition to condition as it does during a reaction. A sloping linear baseline and Gaussian
+    noise are added to every spectrum.
+
+    :param n_spectra: Integer number of spectra (rows).
+    :param wavenumbers: List of the wavenumber column labels, as strings.
+    :param region_parameters: Dictionary mapping each region name of region_models to its Parameters object.
+    :param noise: Float standard deviation of the Gaussian noise added to the intensities.
+    :param jitter: Float relative standard deviation of the peak parameters between spectra.
+    :param n_conditions: Integer number of conditions, assigned to the spectra in contiguous blocks.
+    :param baseline: Tuple of the (intercept, slope) of the linear baseline.
+    :param seed: Integer seed of the random number generator, so that the same spectra can be generated again.
+
+    :return: df - DataFrame of the synthetic spectra.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.array(wavenumbers, dtype=float)
+    condition = np.arange(n_spectra) * n_conditions // max(n_spectra, 1) + 1
+
+    y = baseline[0] + baseline[1] * x + rng.normal(0.0, noise, size=(n_spectra, len(x)))
+
+    for number, (region, parameters) in enumerate(region_parameters.items()):
+        for shape, names in region_models[region]['components']:
+            function = lineshapes[shape][0]
+            arguments = []
+            for name in names:
+                parameter = parameters[name]
+                if 'center' in name:
+                    width = parameters[names[2]].value
+                    value = parameter.value + jitter * width * rng.normal(size=(n_spectra, 1))
+                else:
+                    value = parameter.value * (1 + jitter * rng.normal(size=(n_spectra, 1)))
+                    if 'amp' in name and number == 0:
+                        value = value * (1 - 0.05 * (condition[:, np.newaxis] - 1))  # Consumed as the reaction runs.
+                lower = -np.inf if parameter.min is None else parameter.min
+                upper = np.inf if parameter.max is None else parameter.max
+                arguments.append(np.clip(value, lower, upper))
+            y += function(x, *arguments)
+
+    df = pd.DataFrame(y, columns=wavenumbers)
+    df.insert(0, 'Condition', condition)
+    return df
+
+
+def write_synthetic_csv(filename, n_spectra, template_filename=template, **kwargs):
+    """
+    Write synthetic spectra to a .csv file in the layout of the df_t*.csv files, with the wavenumber axis of the
+    template file and the vinyl and p-xylene peaks of the parameter spreadsheets.
+
+    :param filename: String of the .csv filename to write.
+    :param n_spectra: Integer number of spectra (rows).
+    :param template_filename: String of the raw data filename whose header provides the wavenumber labels.
+    :param kwargs: Keyword arguments passed on to synthetic_spectra, e.g. noise, jitter or seed.
+    """
+    wavenumbers = list(pd.read_csv(template_filename, nrows=0).columns[2:])  # Read only the header line.
+    region_parameters = {'vinyl': define_region_parameters(vinyl_parameter),
+                         'pxylene': define_region_parameters(pxylene_parameter)}
+    df = synthetic_spectra(n_spectra, wavenumbers, region_parameters, **kwargs)
+    df.to_csv(filename)
+
+
+def run_benchmark(n_spectra, engine='lmfit', workers=1, memory=True, **kwargs):
+    """
+    Benchmark every stage of the extraction pipeline on a synthetic file of n_spectra spectra, and return the timings.
+
+    The stages are run in the order of the pipeline, each on the output of the previous one:
+    io - parsing the label and region columns of the .csv file with RegionDataFrame.read_regions.
+    slicing - extracting the x-values and float64 intensity blocks of every region.
+    baseline - subtracting the baselines of every region with baseline_subtraction_matrix.
+    baseline_per_spectrum - the same with baseline_subtraction_function, one spectrum at a time.
+    fit - fitting every region with MultiRegionFitting.fit_regions, which includes its own slicing and baselines, and
+          the R2 scores and areas of every fit.
+    area - computing the areas of the best fits again on their own, as done within each fit.
+    aggregation - building the per-spectrum results and the aggregate ratio of every condition.
+
+    If memory is True, the stages are run a second time under tracemalloc to record the peak memory allocated by each
+    stage, since tracemalloc slows down the code it traces. Only the memory of the current process is traced, so the
+    memory of the worker processes is not included when workers is larger than 1.
+
+    :param n_spectra: Integer number of synthetic spectra.
+    :param engine: String indicating either 'lmfit' or 'batched'.
+    :param workers: Integer number of worker processes used by the fit stage.
+    :param memory: Boolean. If True, record the peak memory of every stage.
+    :param kwargs: Keyword arguments passed on to synthetic_spectra, e.g. noise, jitter or seed.
+
+    :return: results - Dictionary of the configuration, the environment and the seconds, spectra per second and peak
+                       memory of every stage, which can be written to a JSON file.
+    """
+    windows = region_windows(column_indices, regions=('vinyl', 'pxylene'))
+    specs = [region_spec('vinyl', windows['vinyl'], residuals_vinyl, define_region_parameters(vinyl_parameter)),
+             region_spec('pxylene', windows['pxylene'], residuals_pxylene, define_region_parameters(pxylene_parameter))]
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'df_synthetic.csv')
+        write_synthetic_csv(filename, n_spectra, **kwargs)
+
+        seconds = _run_stages(filename, windows, specs, engine, workers)
+        peak_memory = _run_stages(filename, windows, specs, engine, workers, traced=True) if memory else {}
+
+    stages = {}
+    for stage, elapsed in seconds.items():
+        stages[stage] = {'seconds': elapsed,
+                         'spectra_per_second': n_spectra / elapsed if elapsed > 0 else float('inf'),
+                         'peak_memory_mb': peak_memory[stage] / 2 ** 20 if stage in peak_memory else None}
+
+    # The end-to-end path of AutomatedRatioExtraction, which does its own slicing and baselines within the fit stage.
+    total = seconds['io'] + seconds['fit'] + seconds['aggregation']
+
+    return {'config': dict(kwargs, n_spectra=n_spectra, engine=engine, workers=workers),
+            'environment': {'timestamp': datetime.now().isoformat(timespec='seconds'),
+                            'python': platform.python_version(),
+                            'numpy': np.__version__,
+                            'pandas': pd.__version__,
+                            'platform': platform.platform(),
+                            'cpu_count': os.cpu_count()},
+            'stages': stages,
+            'total': {'seconds': total, 'spectra_per_second': n_spectra / total}}
+
+
+def _run_stages(filename, windows, specs, engine, workers, traced=False):
+    """
+    Run the stages of run_benchmark once. Returns the seconds taken by every stage, or the peak memory in bytes
+    allocated by every stage if traced is True.
+    """
+    measurements = {}
+    if traced:
+        tracemalloc.start()
+
+    def measure(stage, function, *args):
+        if traced:
+            tracemalloc.reset_peak()
+            baseline_memory = tracemalloc.get_traced_memory()[0]
+            output = function(*args)
+            measurements[stage] = tracemalloc.get_traced_memory()[1] - baseline_memory
+        else:
+            start = time.perf_counter()
+            output = function(*args)
+            measurements[stage] = time.perf_counter() - start
+        return output
+
+    try:
+        df_labels, region_frames = measure('io', read_regions, filename, windows)
+
+        blocks = measure('slicing', lambda: {region: (np.array(df_region.columns, dtype=float),
+                                                      np.array(df_region.to_numpy(), dtype=float))
+                                             for region, df_region in region_frames.items()})
+
+        subtracted = measure('baseline', lambda: {region: baseline_subtraction_matrix(x, y)[1]
+                                                  for region, (x, y) in blocks.items()})
+
+        measure('baseline_per_spectrum', lambda: [baseline_subtraction_function(row)
+                                                  for df_region in region_frames.values()
+                                                  for index, row in df_region.iterrows()])
+
+        records = measure('fit', fit_regions, region_frames, specs, workers, False, engine)
+
+        def areas():
+            # Compute the area of the peak of every best fit, one spectrum at a time as in curve_fit.
+            area_list = {}
+            for region, (x, y) in blocks.items():
+                lineshape, names = area_components[region]
+                area_list[region] = [peak_area(lineshape, x, *[record[region][0][name] for name in names])
+                                     for record in records]
+            return area_list
+        measure('area', areas)
+
+        def aggregation():
+            df_area = area_dataframe(df_labels,
+                                     vinyl_area=[record['vinyl'][2] for record in records],
+                                     vinyl_r2_score=[record['vinyl'][1] for record in records],
+                                     pxylene_area=[record['pxylene'][2] for record in records],
+                                     pxylene_r2_score=[record['pxylene'][1] for record in records])
+            return aggregate_ratio(df_area,
+                                   vinyl_area=df_area['Vinyl Peak AUC'].values,
+                                   vinyl_r2_score=df_area['Vinyl R2 Score'].values,
+                                   pxylene_area=df_area['p-xylene Peak AUC'].values,
+                                   pxylene_r2_score=df_area['p-xylene R2 Score'].values,
+                                   filename=os.path.splitext(filename)[0])
+        measure('aggregation', aggregation)
+    finally:
+        if traced:
+            tracemalloc.stop()
+
+    return measurements
+
+
+def compare_benchmarks(old_filename, new_filename):
+    """
+    Compare two JSON files written by this script, e.g. before and after a change, and print the speed-up of every
+    stage of every benchmark configuration found in both files.
+
+    :param old_filename: String of the JSON filename of the reference run.
+    :param new_filename: String of the JSON filename of the new run.
+
+    :return: df_comparison - DataFrame of the seconds of both runs and the speed-up of every stage.
+    """
+    rows = []
+    with open(old_filename) as old_file, open(new_filename) as new_file:
+        old_runs, new_runs = json.load(old_file), json.load(new_file)
+
+    for old, new in zip(old_runs, new_runs):
+        old_stages = dict(old['stages'], total=old['total'])
+        new_stages = dict(new['stages'], total=new['total'])
+        for stage in old_stages:
+            if stage not in new_stages:
+                continue  # Stage added or removed between the two runs.
+            old_seconds, new_seconds = old_stages[stage]['seconds'], new_stages[stage]['seconds']
+            rows.append({'n_spectra': old['config']['n_spectra'], 'stage': stage, 'old_seconds': old_seconds,
+                         'new_seconds': new_seconds, 'speed_up': old_seconds / new_seconds})
+
+    df_comparison = pd.DataFrame(rows)
+    print(df_comparison.to_string(index=False))
+    return df_comparison
+
+
+def compare_engines(filenames, workers=1):
+    """
+    Fit real data files with both the 'lmfit' and the 'batched' engines, and compare the status of every fit and the
+    areas of the fits with the status 'ok' in both engines. The batched engine must flag the same fits as not
+    converged as lmfit does, otherwise Consolidate.good_fits keeps different spectra in the aggregate ratio of each
+    engine.
+
+    :param filenames: List of the .csv filenames of the data, e.g. the df_t*.csv files.
+    :param workers: Integer number of worker processes of the fits.
+
+    :return: df_comparison - DataFrame with one row per file and region, of the number of spectra, the numbers of fits
+                             of every status with both engines, the number of spectra whose status differs and the
+                             largest relative difference of the areas.
+    """
+    windows = region_windows(column_indices, regions=('vinyl', 'pxylene'))
+    specs = [region_spec('vinyl', windows['vinyl'], residuals_vinyl, define_region_parameters(vinyl_parameter)),
+             region_spec('pxylene', windows['pxylene'], residuals_pxylene, define_region_parameters(pxylene_parameter))]
+
+    rows = []
+    for filename in filenames:
+        df_labels, region_frames = read_regions(filename, windows)
+        records = {engine: fit_regions(region_frames, specs, workers, False, engine) for engine in ('lmfit', 'batched')}
+        for spec in specs:
+            region = spec['region']
+            status = {engine: np.array([record[region][3] for record in records[engine]], dtype=object)
+                      for engine in records}
+            area = {engine: np.array([record[region][2] for record in records[engine]], dtype=float)
+                    for engine in records}
+            both_ok = (status['lmfit'] == 'ok') & (status['batched'] == 'ok')
+            relative = np.abs(area['batched'] - area['lmfit'])[both_ok] / np.abs(area['lmfit'][both_ok])
+            rows.append({'file': filename, 'region': region, 'n_spectra': len(status['lmfit']),
+                         'lmfit': dict(pd.Series(status['lmfit']).value_counts()),
+                         'batched': dict(pd.Series(status['batched']).value_counts()),
+                         'status_differs': int(np.sum(status['lmfit'] != status['batched'])),
+                         'max_relative_area_difference': relative.max() if relative.size else np.nan})
+
+    df_comparison = pd.DataFrame(rows)
+    print(df_comparison.to_string(index=False))
+    return df_comparison
+
+
+# The worker processes re-import this script, so the benchmark must only run in the main process.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the extraction pipeline on synthetic spectra '
+                                                 'and save the results to a JSON file.')
+    parser.add_argument('--spectra', type=int, nargs='+', default=[100, 1000],
+                        help='numbers of synthetic spectra to benchmark (default: 100 1000)')
+    parser.add_argument('--engine', choices=['lmfit', 'batched'], default='lmfit', help='fitting engine')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes of the fit stage')
+    parser.add_argument('--noise', type=float, default=40.0, help='standard deviation of the noise')
+    parser.add_argument('--jitter', type=float, default=0.05, help='relative scatter of the peak parameters')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random number generator')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass of peak memory')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file of the results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two JSON files of results instead of running the benchmark')
+    parser.add_argument('--check-engines', nargs='+', metavar='CSV',
+                        help='check that both engines give the same fit status on data files, e.g. df_t*.csv, '
+                             'instead of running the benchmark. Exits with status 1 if any status differs')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_benchmarks(*args.compare)
+    elif args.check_engines:
+        df_engines = compare_engines(args.check_engines, workers=args.workers)
+        if df_engines['status_differs'].any():
+            parser.exit(1, 'The lmfit and batched engines disagree on the status of ' +
+                        str(df_engines['status_differs'].sum()) + ' fits.\n')
+    else:
+        runs = []
+        for n_spectra in args.spectra:
+            print('Benchmarking ' + str(n_spectra) + ' synthetic spectra.')
+            results = run_benchmark(n_spectra, engine=args.engine, workers=args.workers, memory=not args.no_memory,
+                                    noise=args.noise, jitter=args.jitter, seed=args.seed)
+            for stage, stage_results in results['stages'].items():
+                print('  {:<22}{:>10.3f} s{:>12.1f} spectra/s'.format(stage, stage_results['seconds'],
+                                                                      stage_results['spectra_per_second']))
+            print('  {:<22}{:>10.3f} s{:>12.1f} spectra/s'.format('total', results['total']['seconds'],
+                                                                  results['total']['spectra_per_second']))
+            runs.append(results)
+
+        with open(args.output, 'w') as f:
+            json.dump(runs, f, indent=2)
+        print('Results written to ' + args.output)
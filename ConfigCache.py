@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+
+# Parsed configuration spreadsheets are cached in a JSON sidecar file next to each spreadsheet, e.g.
+# vinyl_parameters_cache.json next to vinyl_parameters.xlsx, so that the spreadsheet is only parsed again after it was
+# edited. Set to False to always parse the spreadsheets, e.g. on a read-only file system.
+sidecar = True
+
+# Version of the parsed configurations, which is stored in every sidecar. It is increased whenever a change of the
+# parsers or of their validation changes the configuration parsed from the same spreadsheet, so that the sidecars
+# written by earlier versions are parsed again.
+cache_version = 1
+
+# Configurations already loaded by the current process, keyed by the absolute filename of the spreadsheet, with the
+# modification time and size of the spreadsheet they were loaded from.
+_loaded = {}
+
+
+def load_config(filename, parse):
+    """
+    Load a configuration spreadsheet through the cache. The spreadsheet is parsed at most once per process, and at most
+    once per edit across processes and runs, as the parsed configuration is also written to a JSON sidecar file.
+
+    The sidecar is used while the modification time and size of the spreadsheet are unchanged. If either changed, the
+    SHA-256 hash of the spreadsheet is compared with the hash stored in the sidecar, so a spreadsheet that was saved
+    again without any change is not parsed again either. Otherwise the spreadsheet is parsed and the sidecar rewritten.
+    A sidecar written by another parser or another cache_version is never used.
+
+    :param filename: String of the spreadsheet filename with the file extension.
+    :param parse: Function which parses and validates the spreadsheet, returning a JSON serialisable configuration.
+    :return: config - The parsed configuration. It is shared by all callers, so it must not be modified.
+    """
+    path = os.path.abspath(filename)
+    status = os.stat(path)
+    signature = [status.st_mtime_ns, status.st_size]
+
+    loaded = _loaded.get(path)
+    if loaded is not None and loaded[0] == signature:
+        return loaded[1]
+
+    sidecar_filename = os.path.splitext(path)[0] + '_cache.json'
+    cached = _read_sidecar(sidecar_filename, parse) if sidecar else None
+
+    if cached is not None and cached['signature'] == signature:
+        config = cached['config']
+    else:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        if cached is not None and cached['sha256'] == digest:
+            config = cached['config']  # The spreadsheet was saved again, but its contents are unchanged.
+        else:
+            config = parse(filename)
+        if sidecar:
+            _write_sidecar(sidecar_filename, parse, signature, digest, config)
+
+    _loaded[path] = (signature, config)
+
+    return config
+
+
+def clear():
+    """
+    Forget the configurations loaded by the current process. The sidecar files are kept.
+    """
+    _loaded.clear()
+
+
+def _read_sidecar(sidecar_filename, parse):
+    """
+    :return: Dictionary of the sidecar, or None if it does not exist, cannot be read or was written by another parser
+             or another cache_version.
+    """
+    try:
+        with open(sidecar_filename) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(cached, dict) or cached.get('parser') != parse.__module__ + '.' + parse.__name__ or \
+            cached.get('version') != cache_version:
+        return None
+    return cached
+
+
+def _write_sidecar(sidecar_filename, parse, signature, digest, config):
+    """
+    Write the sidecar atomically, so that concurrent processes never read a partially written file. A sidecar which
+    cannot be written, e.g. in a read-only directory, is skipped silently.
+    """
+    cached = {'parser': parse.__module__ + '.' + parse.__name__, 'version': cache_version, 'signature': signature,
+              'sha256': digest, 'config': config}
+    temporary_filename = sidecar_filename + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(temporary_filename, 'w') as f:
+            json.dump(cached, f, indent=2)
+        os.replace(temporary_filename, sidecar_filename)
+    except OSError:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
@@ -1,7 +1,14 @@
 import pandas as pd
+import numpy as np
 
 
-def aggregate_ratio(df, vinyl_area, vinyl_r2_score, pxylene_area, pxylene_r2_score, filename):
+# Relative accuracy of the quantile sketches of the ratio, see update_ratio_statistics. Every quantile is reported to
+# within this fraction of the ratio of the spectrum at the requested rank.
+sketch_accuracy = 0.01
+
+
+def aggregate_ratio(df, vinyl_area, vinyl_r2_score, pxylene_area, pxylene_r2_score, filename, vinyl_status=None,
+                    pxylene_status=None, quantiles=None):
     """
     A function which calculates the aggregate mean AUC ratio and the standard deviation of the AUC ratio of multiple
     Raman spectra associated to their respective conditions.
@@ -12,9 +19,39 @@ def aggregate_ratio(df, vinyl_area, vinyl_r2_score, pxylene_area, pxylene_r2_sco
     :param pxylene_area: List of all pxylene peak AUC.
     :param pxylene_r2_score: List of all pxylene region R2 scores.
     :param filename: String of the filename WITHOUT the extension.
+    :param vinyl_status: Optional list of the fit status of all vinyl fits, see IterativeFitting.fit_array.
+    :param pxylene_status: Optional list of the fit status of all pxylene fits.
+    :param quantiles: Optional list of the quantiles of the ratio to add as columns, e.g. [0.25, 0.5, 0.75], see
+                      finalise_ratio_statistics.
 
     :return: df_ratio - DataFrame consisting only of the condition label, the mean ratio and the standard deviation of the ratio.
     """
+    df_area = area_dataframe(df, vinyl_area, vinyl_r2_score, pxylene_area, pxylene_r2_score, vinyl_status,
+                             pxylene_status)
+
+    # Accumulate the count, mean and M2 of the ratio of every condition in a single pass over the spectra, in the same
+    # way as when the spectra are streamed, so both give the same results.
+    statistics = update_ratio_statistics({}, df_area, sketch=quantiles is not None)
+
+    return finalise_ratio_statistics(statistics, filename=filename, quantiles=quantiles)
+
+
+def area_dataframe(df, vinyl_area, vinyl_r2_score, pxylene_area, pxylene_r2_score, vinyl_status=None,
+                   pxylene_status=None):
+    """
+    Create a DataFrame of the per-spectrum fitting results, labelled with the original index and condition.
+
+    :param df: DataFrame of the excel file containing the original index and condition labels as its first two columns.
+    :param vinyl_area: List of all vinyl peak AUC.
+    :param vinyl_r2_score: List of all vinyl region R2 scores.
+    :param pxylene_area: List of all pxylene peak AUC.
+    :param pxylene_r2_score: List of all pxylene region R2 scores.
+    :param vinyl_status: Optional list of the fit status of all vinyl fits, added as a 'Vinyl Fit Status' column.
+    :param pxylene_status: Optional list of the fit status of all pxylene fits, added as a 'p-xylene Fit Status'
+                           column.
+
+    :return: df_area - DataFrame with one row per spectrum.
+    """
     # Extract original index and condition labels from the raw DataFrame into an array of values
     original_index = df.iloc[:, 0].values
     condition = df.iloc[:, 1].values
@@ -33,33 +70,195 @@ def aggregate_ratio(df, vinyl_area, vinyl_r2_score, pxylene_area, pxylene_r2_sco
          }
     df_area = pd.DataFrame(d)
 
-    # Filter out poorly fitted spectra. Only spectra with R2 score of fit for both vinyl and pxylene regions
-    # above 0.95 should be kept for further calculations.
-    # Create a column for the ratio between the vinyl peak AUC and the pxylene peak AUC.
-    # Use the pandas .groupby() operation to cluster spectra of the same condition together, and use the .describe()
-    # method to obtain summary statistics of the ratios.
-    # The DataFrame arising from this operation has hierarchical indexes.
-    # The total number of rows in this DataFrame should now be equal to the total number of conditions.
-    df_area = df_area[(df_area['Vinyl R2 Score'] > 0.95) & (df_area['p-xylene R2 Score'] > 0.95)]
-    df_area['Vinyl Divide p-xylene'] = df_area['Vinyl Peak AUC'] / df_area['p-xylene Peak AUC']
-    df_area_stats = df_area[['Condition', 'Vinyl Divide p-xylene']].groupby('Condition').describe()
-
-    # Instantiate a list of conditions to contain the condition labels without repeats, sorted in ascending order.
-    condition = list(set(condition))  # Remove repeats using the set object, then convert it to list.
-    condition.sort()  # Modifies list in place.
-
-    # Extract the mean and standard deviation of the ratios using pandas multi-indexing.
-    # The mean and standard deviation of the ratios will be used for further conversion and error calculations.
-    mean = df_area_stats.loc[:, ('Vinyl Divide p-xylene', 'mean')].values
-    std = df_area_stats.loc[:, ('Vinyl Divide p-xylene', 'std')].values
-
-    # Create a DataFrame consisting only of the condition label, the mean ratio and the standard deviation of the ratio.
+    # Flag fits which were capped, failed or skipped explicitly, rather than only through their R2 score.
+    if vinyl_status is not None:
+        df_area['Vinyl Fit Status'] = np.asarray(vinyl_status)
+    if pxylene_status is not None:
+        df_area['p-xylene Fit Status'] = np.asarray(pxylene_status)
+
+    return df_area
+
+
+def good_fits(df_area):
+    """
+    Select the spectra whose fits are kept for the aggregate ratio: the R2 scores of the fits of both regions must be
+    above 0.95, and the fits must have converged ('ok' status) when the status columns are present.
+
+    :param df_area: DataFrame of per-spectrum fitting results, as created by area_dataframe.
+    :return: mask - Boolean Series, True for the spectra to keep.
+    """
+    mask = (df_area['Vinyl R2 Score'] > 0.95) & (df_area['p-xylene R2 Score'] > 0.95)
+    for column in ('Vinyl Fit Status', 'p-xylene Fit Status'):
+        if column in df_area:
+            mask &= df_area[column] == 'ok'
+    return mask
+
+
+def update_ratio_statistics(statistics, df_area, sketch=False):
+    """
+    Update running per-condition statistics of the AUC ratio with a block of per-spectrum fitting results, as they come
+    out of the fitter. Only the count, the mean and the sum of squared deviations from the mean (M2) of every condition
+    are kept, so the memory use does not grow with the number of spectra, and the statistics of the block are merged
+    into them with merge_ratio_statistics.
+
+    The filter of good_fits is applied before the ratios are accumulated. Conditions whose spectra are all filtered out
+    are still recorded, with a count of zero.
+
+    :param statistics: Dictionary mapping each condition to a list of [count, mean, M2], followed by the quantile sketch
+                       of the condition if sketch is True. Updated in place.
+    :param df_area: DataFrame of per-spectrum fitting results of the block, as created by area_dataframe.
+    :param sketch: Boolean. If True, also keep a quantile sketch of the ratios of every condition, see ratio_sketches.
+
+    :return: statistics - The updated dictionary.
+    """
+    for condition in df_area['Condition'].unique():
+        statistics.setdefault(condition, [0, 0.0, 0.0, {}] if sketch else [0, 0.0, 0.0])
+
+    df_area = df_area[good_fits(df_area)]
+    ratio = df_area['Vinyl Peak AUC'] / df_area['p-xylene Peak AUC']
+    grouped = ratio.groupby(df_area['Condition'])
+
+    # Count, mean and M2 of the ratios of every condition within the block.
+    count = grouped.count()
+    block_statistics = {condition: [int(count_b), mean_b, m2_b] for condition, count_b, mean_b, m2_b in
+                        zip(count.index, count.to_numpy(), grouped.mean().to_numpy(),
+                            (grouped.var(ddof=0) * count).to_numpy())}
+
+    if sketch:
+        for condition, block_sketch in ratio_sketches(df_area['Condition'], ratio).items():
+            block_statistics[condition].append(block_sketch)
+
+    return merge_ratio_statistics(statistics, block_statistics)
+
+
+def merge_ratio_statistics(statistics, other):
+    """
+    Merge the running per-condition statistics of another set of spectra into statistics, e.g. the statistics of a
+    block of spectra, or the partial statistics of the spectra aggregated by another worker process. The counts, means
+    and M2 are combined with the parallel form of Welford's algorithm (Chan et al.), so the merged mean and standard
+    deviation are those of all spectra aggregated at once, whatever the order and grouping of the merges. The quantile
+    sketches are merged by adding their bucket counts, which is exact.
+
+    :param statistics: Dictionary mapping each condition to a list of [count, mean, M2(, sketch)]. Updated in place.
+    :param other: Dictionary of the same form. It is not modified.
+
+    :return: statistics - The updated dictionary.
+    """
+    for condition, (count_b, mean_b, m2_b, *sketch_b) in other.items():
+        if condition not in statistics:
+            statistics[condition] = [count_b, mean_b, m2_b] + [dict(sketch) for sketch in sketch_b]
+            continue
+
+        count_a, mean_a, m2_a, *sketch_a = statistics[condition]
+        if len(sketch_a) != len(sketch_b):
+            raise ValueError('Cannot merge the statistics of condition ' + str(condition) + ', as only one of them has '
+                             'a quantile sketch')
+
+        if count_b == 0:
+            continue
+
+        # Combine the two sets of statistics. The combined M2 gains a term for the difference in means.
+        count = count_a + count_b
+        delta = mean_b - mean_a
+        mean = mean_a + delta * count_b / count
+        m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+        statistics[condition][:3] = [count, mean, m2]
+
+        for sketch, other_sketch in zip(sketch_a, sketch_b):
+            for bucket, bucket_count in other_sketch.items():
+                sketch[bucket] = sketch.get(bucket, 0) + bucket_count
+
+    return statistics
+
+
+def ratio_sketches(condition, ratio):
+    """
+    Build the quantile sketch of the ratios of every condition. A sketch counts the ratios falling in logarithmically
+    spaced buckets, whose bounds grow by a factor of (1 + sketch_accuracy) / (1 - sketch_accuracy), so that the
+    midpoint of every bucket is within sketch_accuracy of every ratio in the bucket (the DDSketch of Masson et al.).
+    Unlike the ratios themselves, the sketches take a bounded amount of memory and can be merged exactly.
+
+    :param condition: Series of the condition of every spectrum.
+    :param ratio: Series of the ratio of every spectrum, with the same index.
+
+    :return: sketches - Dictionary mapping each condition to its sketch, a dictionary mapping each bucket, a tuple of
+                        the sign of the ratios and the bucket index, to the number of ratios in the bucket.
+    """
+    gamma = (1 + sketch_accuracy) / (1 - sketch_accuracy)
+
+    values = ratio.to_numpy(dtype=float)
+    sign = np.sign(values).astype(int)
+    with np.errstate(divide='ignore'):
+        index = np.where(sign != 0, np.ceil(np.log(np.abs(values)) / np.log(gamma)), 0).astype(int)
+
+    bucket_counts = pd.Series(1, index=ratio.index).groupby([condition.to_numpy(), sign, index]).sum()
+
+    sketches = {}
+    for (key, bucket_sign, bucket_index), bucket_count in bucket_counts.items():
+        sketches.setdefault(key, {})[(int(bucket_sign), int(bucket_index))] = int(bucket_count)
+
+    return sketches
+
+
+def sketch_quantile(sketch, quantile):
+    """
+    Estimate a quantile of the ratios counted in a quantile sketch, see ratio_sketches.
+
+    :param sketch: Dictionary mapping each bucket to the number of ratios in the bucket.
+    :param quantile: Float between 0 and 1.
+
+    :return: Float estimate of the quantile, within sketch_accuracy of the floor(quantile * (count - 1))-th smallest
+             ratio, counting from 0, without the interpolation between neighbouring ratios of pandas. NaN if the
+             sketch is empty.
+    """
+    gamma = (1 + sketch_accuracy) / (1 - sketch_accuracy)
+
+    # Order the buckets by value: the negative buckets from the largest index down, zero, then the positive buckets.
+    buckets = sorted(sketch, key=lambda bucket: (bucket[0], bucket[0] * bucket[1]))
+    counts = np.cumsum([sketch[bucket] for bucket in buckets])
+    if len(counts) == 0:
+        return np.nan
+
+    rank = quantile * (counts[-1] - 1)
+    bucket_sign, bucket_index = buckets[int(np.searchsorted(counts, rank, side='right'))]
+
+    return bucket_sign * 2 * gamma ** bucket_index / (gamma + 1)
+
+
+def finalise_ratio_statistics(statistics, filename, quantiles=None):
+    """
+    Convert running per-condition statistics accumulated by update_ratio_statistics into the DataFrame and _ratio.csv
+    file of the aggregate ratio.
+
+    :param statistics: Dictionary mapping each condition to a list of [count, mean, M2(, sketch)].
+    :param filename: String of the filename WITHOUT the extension.
+    :param quantiles: Optional list of the quantiles of the ratio to add as columns after the std column, named in the
+                      same way as the pandas .describe() method, e.g. [0.25, 0.5, 0.75] adds the '25%', '50%' and '75%'
+                      columns. The statistics must have been accumulated with sketch=True.
+
+    :return: df_ratio - DataFrame consisting only of the condition label, the mean ratio and the standard deviation of the ratio.
+    """
+    condition = sorted(statistics)
+    count = np.array([statistics[key][0] for key in condition], dtype=float)
+    m2 = np.array([statistics[key][2] for key in condition], dtype=float)
+
+    # Conditions without any spectra have no mean, and conditions with a single spectrum have no sample standard
+    # deviation, in the same way as the pandas .describe() method.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(count > 0, [statistics[key][1] for key in condition], np.nan)
+        std = np.where(count > 1, np.sqrt(m2 / (count - 1)), np.nan)
+
     df_ratio = pd.DataFrame({
         'condition': condition,
         'mean': mean,
         'std': std
     })
 
+    for quantile in quantiles or []:
+        if any(len(statistics[key]) < 4 for key in condition):
+            raise ValueError('Quantiles need the ratio statistics to be accumulated with sketch=True')
+        df_ratio['{:g}%'.format(quantile * 100)] = [sketch_quantile(statistics[key][3], quantile) for key in condition]
+
     df_ratio.to_csv(filename + '_ratio.csv', index=False)  # Write the DataFrame to a .csv file.
 
     return df_ratio
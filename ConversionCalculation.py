@@ -1,177 +1,208 @@
 import numpy as np
 import pandas as pd
-from uncertainties import ufloat
+import argparse
+import os
+from Manifest import manifest, read_manifest
 
-# Create list of filenames to be read. Ensure that the files are listed in the correct order!
-filenames = ['df_t0_ratio.csv', 'df_t0_repeat_ratio.csv', 'df_t30_ratio.csv',
-             'df_t60_ratio.csv', 'df_t90_ratio.csv', 'df_t120_ratio.csv']
+# The runs to convert are listed in the manifest, see Manifest.manifest. The _ratio.csv file of every file of the
+# manifest is read, every run with a reference is converted against the run of that label, and the conversions are
+# reported under the time of every run. For example, t0, t30, t60 and t90 use t0 as the benchmark, t120 uses t0_repeat
+# as the benchmark, and t0_repeat is only used as a benchmark.
 
-dataframes = [pd.read_csv(file) for file in filenames]  # # Use list comprehension to generate list of read dataframes
+# Correlation coefficient between the ratio of a residence time and the ratio of its benchmark, e.g. when both were
+# measured against the same reference. 0 treats them as independent. A residence time converted against itself
+# (t0 against t0) is always fully correlated, so its conversion is exactly 0 +/- 0.
+correlation = 0.0
 
 
-def create_mean_df(dataframes):
+def read_ratios(df_manifest):
     """
-    Create a dataframe to store the mean AUC ratio values of each condition across residence times.
+    Read the _ratio.csv file of every file of the manifest into a single long DataFrame.
 
-    :param dataframes: List of DataFrames containing the mean AUC ratio of conditions in the different residence times.
+    :param df_manifest: DataFrame of the manifest, see Manifest.read_manifest.
 
-    :return: df_mean: DataFrame containing the mean ratio of the AUCs associated with each condition across
-                      residence times.
+    :return: df_ratios - DataFrame with the label, condition, mean and std columns, with one row per condition of
+                         every run.
     """
-    # Create an initial dataframe condition and mean columns of the t0 dataframe
-    df_mean = dataframes[0][['condition', 'mean']]
+    # Collect the columns of every file, and build the DataFrame once at the end.
+    label, condition, mean, std = [], [], [], []
+    for file, run in zip(df_manifest['file'], df_manifest['label']):
+        df_ratio = pd.read_csv(os.path.splitext(file)[0] + '_ratio.csv')
+        label.append(np.full(len(df_ratio), run, dtype=object))
+        condition.append(df_ratio['condition'].to_numpy())
+        mean.append(df_ratio['mean'].to_numpy(dtype=float))
+        std.append(df_ratio['std'].to_numpy(dtype=float))
+
+    df_ratios = pd.DataFrame({'label': np.concatenate(label), 'condition': np.concatenate(condition),
+                              'mean': np.concatenate(mean), 'std': np.concatenate(std)})
 
-    # Concatenate subsequent dataframe's mean columns along the columns axis and ignore the index.
-    for file in dataframes[1:]:
-        df_mean = pd.concat([df_mean, file['mean']], axis=1, ignore_index=True)
+    return df_ratios
 
-    # Define the column headers.
-    col_names = {0: 'Condition',
-                 1: 't0_mean',
-                 2: 't0_mean_repeat',
-                 3: 't30_mean',
-                 4: 't60_mean',
-                 5: 't90_mean',
-                 6: 't120_mean'}
-    # Rename columns
-    df_mean.rename(columns=col_names, inplace=True)
 
-    return df_mean
+def create_mean_df(df_ratios, labels):
+    """
+    Create a dataframe to store the mean AUC ratio values of each condition across residence times.
+
+    :param df_ratios: DataFrame of the ratios of all runs, see read_ratios.
+    :param labels: List of the labels of the runs, in the order of the columns.
+
+    :return: df_mean: DataFrame containing the mean ratio of the AUCs associated with each condition across
+                      residence times, with a Condition column and one column per label.
+    """
+    return _wide_dataframe(df_ratios, 'mean', labels)
 
 
-def create_std_df(dataframes):
+def create_std_df(df_ratios, labels):
     """
     Create a dataframe to store the standard deviation of the AUC ratio values of each condition across residence times.
 
-    :param dataframes: List of DataFrames containing the standard deviation of the AUC ratio of conditions in the
-                       different residence times.
+    :param df_ratios: DataFrame of the ratios of all runs, see read_ratios.
+    :param labels: List of the labels of the runs, in the order of the columns.
 
     :return: df_std: DataFrame containing the standard deviation of the AUC ratios associated with each condition across
-                     residence times.
+                     residence times, with a Condition column and one column per label.
     """
-    # Create an initial dataframe condition and std columns of the t0 dataframe
-    df_std = dataframes[0][['condition', 'std']]
+    return _wide_dataframe(df_ratios, 'std', labels)
 
-    # Concatenate subsequent dataframe's std columns along the columns axis and ignore the index.
-    for file in dataframes[1:]:
-        df_std = pd.concat([df_std, file['std']], axis=1, ignore_index=True)
 
-    # Define the column headers.
-    col_names = {0: 'Condition',
-                 1: 't0_std',
-                 2: 't0_std_repeat',
-                 3: 't30_std',
-                 4: 't60_std',
-                 5: 't90_std',
-                 6: 't120_std'}
-    # Rename columns
-    df_std.rename(columns=col_names, inplace=True)
+def _wide_dataframe(df_ratios, values, labels):
+    """
+    Join the values of all runs by condition in a single pivot, with the conditions along the rows and the runs along
+    the columns. A condition missing from a run is NaN in that run.
+    """
+    if df_ratios.duplicated(['label', 'condition']).any():
+        raise ValueError('A condition appears more than once in the _ratio.csv file of a run')
 
-    return df_std
+    df_wide = df_ratios.pivot(index='condition', columns='label', values=values).reindex(columns=labels)
+    df_wide.columns.name = None
+    df_wide = df_wide.rename_axis('Condition').reset_index()
 
+    return df_wide
 
-def create_ufloat_df(df_mean, df_std):
-    """
-    A function that takes in both df_mean and df_std and creates a single df_ufloat containing the mean with
-    standard deviation as a single object in each DataFrame entry. In this ufloat format, conversion calculation and
-    error propagation would be immensely simpler.
 
-    df_mean, df_std and df_ufloat are of the same shape.
+def conversion_references(df_manifest):
+    """
+    Map every run of the manifest which has a reference to the label of its benchmark run.
 
-    :param df_mean: DataFrame containing the mean AUC ratios.
-    :param df_std: DataFrame containing the standard deviation of the AUC ratios.
+    :param df_manifest: DataFrame of the manifest, see Manifest.read_manifest.
 
-    :return: df_ufloat - DataFrame containing the mean with standard deviation as a single object
-                         in each DataFrame entry.
+    :return: references - Dictionary of the label of the benchmark of every converted run, in the order of the manifest.
+             times - Dictionary of the time of every converted run, used as the column headers of the results.
     """
-    for file in filenames:  # Iterate through each file in their stated order.
-        l1 = []  # Create a list called l1 to store lists, eventually becoming a list of lists
-        for column_index in range(1, 7):  # Iterate through each column, ignoring the 0th column for condition
-            l2 = []  # Create a temporary list l2, to store mean with std object
-            for row_index in range(0, 9):  # Iterate through each row
-                mean_with_std = ufloat(df_mean.iloc[row_index, column_index], df_std.iloc[row_index, column_index])
-                # Combine mean and std into a single object using the ufloat function
-                l2.append(mean_with_std)
-                # Append mean_with_std into l2 list, and do this for each row
-            l1.append(l2)  # Append l2 list into l1 list, and do this for each column
-
-    array = np.array(l1).T  # Convert to numpy array and transpose
-    columns = [0, '0_repeat', 30, 60, 90, 120]  # Create the column headers
-    df_ufloat = pd.DataFrame(array, columns=columns)  # Create the DataFrame
-    df_ufloat.insert(loc=0, column='Condition', value=df_mean.Condition.values)  # Add back in the conditions column
-    return df_ufloat
-
-
-def calc_conv_and_error(df_ufloat):
-    """
-    Calculate the conversion and propagate the error leveraging upon the ufloat package.
-    pandas broadcasting is used for conversion calculation and error propagation.
+    labels = set(df_manifest['label'])
+    df_converted = df_manifest[df_manifest['reference'].notna()]
+
+    unknown = sorted(set(df_converted['reference']) - labels)
+    if unknown:
+        raise ValueError('The references ' + ', '.join(map(str, unknown)) + ' are not labels of the manifest')
+    if df_converted['time'].duplicated().any():
+        raise ValueError('More than one run with a reference has the same time, so their conversions would have the '
+                         'same column header')
+
+    references = dict(zip(df_converted['label'], df_converted['reference']))
+    times = dict(zip(df_converted['label'], df_converted['time']))
+
+    return references, times
 
-    :param df_ufloat:  DataFrame containing the mean and std object in each entry.
 
-    :return:  df_conv_and_error - DataFrame containing the conversion and propagated error object in each entry.
+def propagate_conversion(ratio, ratio_std, reference, reference_std, covariance=None):
     """
-    # Create a DataFrame skeleton first and then define the columns as the Series values are calculated.
-    df_conv_and_error = pd.DataFrame()
-    df_conv_and_error = pd.concat([df_conv_and_error, df_ufloat['Condition']], axis=1)
+    Calculate the conversion (1 - r_t / r_0) * 100 of the ratios r_t against the benchmark ratios r_0, and propagate
+    their standard deviations to first order, as whole-array operations on arrays of any (broadcastable) shape:
 
-    # Pre-define the t0 and t0_repeat pandas Series, as they will be used as the benchmark for conversion calculations.
-    # t0, t30, t60 and t90 will use t0 as the benchmark
-    # t120 will use t0_repeat for the benchmark
-    t0 = df_ufloat.iloc[:, 1]
-    t0_repeat = df_ufloat.iloc[:, 2]
+        error = 100 / |r_0| * sqrt(s_t^2 + (r_t / r_0)^2 * s_0^2 - 2 * (r_t / r_0) * cov(r_t, r_0))
 
-    df_conv_and_error[0] = ((1 - (df_ufloat.iloc[:, 1] / t0)) * 100)  # Calculate t0 conversion. Should be 0+/-0.
+    This is the linear error propagation of the uncertainties package, and gives the same values up to rounding.
 
-    i = 3  # Calculate the t30, t60 and t90 conversions. Start from column index 3.
-    for time in [30, 60, 90]:
-        df_conv_and_error[time] = ((1 - (df_ufloat.iloc[:, i] / t0)) * 100)
-        i += 1
+    :param ratio: Array of the mean ratios r_t.
+    :param ratio_std: Array of the standard deviations s_t of the ratios.
+    :param reference: Array of the mean benchmark ratios r_0.
+    :param reference_std: Array of the standard deviations s_0 of the benchmark ratios.
+    :param covariance: Array of the covariances cov(r_t, r_0), or None if the ratios and benchmarks are independent.
+                       Use reference_std ** 2 where a ratio is its own benchmark.
 
-    df_conv_and_error[120] = ((1 - (df_ufloat.iloc[:, -1] / t0_repeat)) * 100)  # Calculate t120 conversion.
+    :return: conversion - Array of the conversions in %.
+             error - Array of the propagated standard deviations of the conversions in %.
+    """
+    ratio, ratio_std, reference, reference_std = [np.asarray(array, dtype=float) for array in
+                                                  (ratio, ratio_std, reference, reference_std)]
+
+    quotient = ratio / reference
+    conversion = (1 - quotient) * 100
+
+    variance = ratio_std ** 2 + quotient ** 2 * reference_std ** 2
+    if covariance is not None:
+        variance = variance - 2 * quotient * np.asarray(covariance, dtype=float)
+    # Clip the rounding errors of fully correlated ratios, whose variance cancels out exactly.
+    error = 100 / np.abs(reference) * np.sqrt(np.maximum(variance, 0))
 
-    return df_conv_and_error
+    return conversion, error
 
 
-def conversion_and_error(df_conv_and_error):
+def calc_conv_and_error(df_mean, df_std, references, correlation=correlation):
     """
-    Create separate conversion and error DataFrames from df_conv_and_error for plotting purposes.
+    Calculate the conversion and propagate the error of every condition and residence time at once, see
+    propagate_conversion.
 
-    :param df_conv_and_error: DataFrame containing the conversion and propagated error object in each entry.
+    :param df_mean: DataFrame containing the mean AUC ratios, with a Condition column and one column per label, see
+                    create_mean_df.
+    :param df_std: DataFrame containing the standard deviation of the AUC ratios, of the same shape as df_mean.
+    :param references: Dictionary of the label of the benchmark of every converted run, in the order of the results,
+                       see conversion_references.
+    :param correlation: Float, or array of one value per converted run, of the correlation coefficient between the
+                        ratios and their benchmarks. A run converted against itself is fully correlated.
 
     :return: conversion_df - DataFrame containing only conversion floats.
              error_df - DataFrame containing only error floats.
     """
-    conversion = []
-    error = []
-    for index, column in df_conv_and_error.iloc[:, 1:].items():  # df.items() iterate via columns
-        conversion_temp = []
-        error_temp = []
-
-        for item in column.values:
-            conversion_temp.append(item.nominal_value)
-            error_temp.append(item.std_dev)
-
-        conversion.append(conversion_temp)
-        error.append(error_temp)
-
-    # Create separate dataframs for conversion_df and error_df
-    columns = [0, 30, 60, 90, 120]
-    conversion_df = pd.DataFrame(np.array(conversion).T, columns=columns)
-    conversion_df.insert(loc=0, column='Condition', value=df_mean.Condition.values)
-    error_df = pd.DataFrame(np.array(error).T, columns=columns)
-    error_df.insert(loc=0, column='Condition', value=df_mean.Condition.values)
+    runs = list(references)
+    benchmarks = [references[run] for run in runs]
+
+    # Conditions along the rows, runs along the columns.
+    ratio = df_mean[runs].to_numpy(dtype=float)
+    ratio_std = df_std[runs].to_numpy(dtype=float)
+    reference = df_mean[benchmarks].to_numpy(dtype=float)
+    reference_std = df_std[benchmarks].to_numpy(dtype=float)
+
+    covariance = np.asarray(correlation, dtype=float) * ratio_std * reference_std
+    itself = np.array([run == benchmark for run, benchmark in zip(runs, benchmarks)])
+    covariance[:, itself] = reference_std[:, itself] ** 2
+
+    conversion, error = propagate_conversion(ratio, ratio_std, reference, reference_std, covariance)
+
+    conversion_df = pd.DataFrame(conversion, columns=runs)
+    conversion_df.insert(loc=0, column='Condition', value=df_mean['Condition'].values)
+    error_df = pd.DataFrame(error, columns=runs)
+    error_df.insert(loc=0, column='Condition', value=df_mean['Condition'].values)
 
-    # Save df to csv files
-    conversion_df.to_csv('df_conversion.csv', index=False)
-    error_df.to_csv('df_error.csv', index=False)
     return conversion_df, error_df
 
 
-df_mean = create_mean_df(dataframes)
-df_std = create_std_df(dataframes)
-df_ufloat = create_ufloat_df(df_mean, df_std)
-df_conv_and_error = calc_conv_and_error(df_ufloat)
-conversion_df, error_df = conversion_and_error(df_conv_and_error)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calculate the conversion and its propagated error of every condition '
+                                                 'from the _ratio.csv files of the runs of a manifest.')
+    parser.add_argument('manifest', nargs='?', default=manifest,
+                        help='manifest .csv file with the file, time, label and reference columns (default: ' +
+                             manifest + ')')
+    parser.add_argument('--correlation', type=float, default=correlation,
+                        help='correlation coefficient between the ratios of a run and of its benchmark (default: ' +
+                             str(correlation) + ')')
+    args = parser.parse_args()
+
+    df_manifest = read_manifest(args.manifest)
+    references, times = conversion_references(df_manifest)
+
+    df_ratios = read_ratios(df_manifest)
+    df_mean = create_mean_df(df_ratios, list(df_manifest['label']))
+    df_std = create_std_df(df_ratios, list(df_manifest['label']))
+    conversion_df, error_df = calc_conv_and_error(df_mean, df_std, references, correlation=args.correlation)
+
+    # Report the conversions under the time of every run.
+    conversion_df = conversion_df.rename(columns=times)
+    error_df = error_df.rename(columns=times)
+
+    # Save df to csv files
+    conversion_df.to_csv('df_conversion.csv', index=False)
+    error_df.to_csv('df_error.csv', index=False)
 
-print('df_conversion.csv and df_error.csv are saved.')
+    print('df_conversion.csv and df_error.csv are saved.')
@@ -7,10 +7,13 @@ error_df = pd.read_csv('df_error.csv')
 
 plt.figure(figsize=(15, 10))
 
-for index, rows in conversion_df.iterrows():
-    x = np.array(conversion_df.columns[1:], dtype=float)  # Ignore Condition column during plotting
+# Ignore Condition column during plotting. The time labels are parsed once, and the conversions and their errors are
+# iterated over as rows of float arrays.
+x = np.array(conversion_df.columns[1:], dtype=float)
+conversion = conversion_df.iloc[:, 1:].to_numpy(dtype=float)
+error = error_df.iloc[:, 1:].to_numpy(dtype=float)
 
-    y = rows[1:]  # Ignore Condition column during plotting
+for index, (y, yerr) in enumerate(zip(conversion, error)):
 
     plt.subplot(3, 3, (1 + index))
 
@@ -23,7 +26,7 @@ for index, rows in conversion_df.iterrows():
 
     plt.xticks(x)  # Set xticks to relevant time intervals.
 
-    plt.errorbar(x=x, y=y, yerr=error_df.iloc[index, 1:], capsize=5, fmt='bo')
+    plt.errorbar(x=x, y=y, yerr=yerr, capsize=5, fmt='bo')
 
 plt.tight_layout()
 plt.savefig('conversion_plots.png')
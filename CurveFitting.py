@@ -1,8 +1,29 @@
-from lmfit import Minimizer
-from scipy import integrate
-from sklearn.metrics import r2_score
 import numpy as np
-from lmfit.lineshapes import lorentzian, split_lorentzian
+from Lineshapes import lorentzian, split_lorentzian, gaussian, pseudo_voigt, areas
+from Residuals import jacobians
+from Instrumentation import stage
+
+# lmfit and scipy.integrate are imported inside the functions which use them rather than here, because importing them
+# takes over a second, which every process importing the extraction pipeline would pay, even to print its --help or to
+# schedule files. They are imported once, on the first use in a process, and the later imports are dictionary lookups.
+
+# Method of the peak areas (AUC), see peak_area. 'analytic' integrates the fitted lineshape exactly over the window of
+# the region, from the first to the last x-value, with its closed form integral, so the area does not depend on the
+# sampling of the x-values. 'simpson' evaluates the fitted lineshape on the x-values and integrates it with Simpson's
+# rule, which was the method of earlier versions and is kept as a cross-check. The analytic areas, and the ratios and
+# conversions derived from them, are not comparable with the outputs of earlier versions: on the df_t*.csv files the
+# mean ratios of the conditions differ by up to 1%, and their standard deviations by up to 15%, mostly lower. The
+# method is part of the key of the fit cache, see FitCache.fit_cache_keys.
+area_method = 'analytic'
+
+# Peak whose AUC is returned by curve_fit for each region, as a (lineshape, parameter names) tuple. The lineshape is
+# evaluated with the best fit values of the named parameters, in order. A new region is added with a new entry here.
+# The single peak regions 'lorentzian', 'gaussian' and 'pseudo_voigt' are the models of BatchPeakFitting.py.
+area_components = {'vinyl': (lorentzian, ('p2amp', 'p2center', 'p2width')),
+                   'pxylene': (split_lorentzian, ('p3amp', 'p3center', 'p3width_left', 'p3width_right')),
+                   'lorentzian': (lorentzian, ('p1_amplitude', 'p1_center', 'p1_half_width')),
+                   'gaussian': (gaussian, ('p1_amplitude', 'p1_center', 'p1_half_width')),
+                   'pseudo_voigt': (pseudo_voigt, ('p1_amplitude', 'p1_center', 'p1_half_width', 'p1_fraction'))}
 
 
 def lorentzian_curve_fit(residuals, parameters, x, y):
@@ -25,8 +46,12 @@ def lorentzian_curve_fit(residuals, parameters, x, y):
              6. Height
              7. AUC
     """
+    from lmfit import Minimizer  # Imported on first use, see the note on imports at the top of the module.
+
     mini = Minimizer(residuals, parameters, fcn_args=(x, y))  # Initialize Minimizer object
-    out = mini.leastsq()  # Use Levenberg-Marquardt minimization to perform a fit.
+    # Use Levenberg-Marquardt minimization to perform a fit, with the analytic Jacobian of the residuals if available.
+    out = mini.leastsq(Dfun=analytic_jacobian(residuals, parameters))
+    out.residual = out.residual.copy()  # The fused residual functions of Residuals reuse their output array.
     best_fit = y + out.residual
     # out.residual is a Numpy array of the minimized objective function when using the best-fit values
     # of the parameters. The best fit curve is therefore the y values plus the minimized residuals.
@@ -35,13 +60,11 @@ def lorentzian_curve_fit(residuals, parameters, x, y):
     fit_params = out.params.valuesdict()  # Returns an ordered dictionary of parameter values.
 
     fit_params['r2_score'] = r2_score(y, best_fit)
-    fit_params['fwhm'] = 2 * fit_params['p1_half_width']
-    fit_params['height'] = (1 / np.pi) * fit_params['p1_amplitude'] / max(np.finfo(float).eps,
-                                                                          fit_params['p1_half_width'])
-    fit_params['auc'] = integrate.simpson(best_fit, x)  # Integrate the area below best_fit to get the AUC.
-    # Height and FWHM equations are written according to the functional form in the documentation.
-    # np.finfo(float).eps is the non-zero value of machine limit for floating points. Non-zero value is used so that
-    # we do not divide by zero. eps = 2**-52, approximately 2.22e-16.
+    fit_params['fwhm'], fit_params['height'] = peak_shape('lorentzian', fit_params['p1_amplitude'],
+                                                          fit_params['p1_half_width'])
+    fit_params['auc'] = peak_area(lorentzian, x, fit_params['p1_amplitude'], fit_params['p1_center'],
+                                  fit_params['p1_half_width'])  # Integrate the area below the peak to get the AUC.
+    # Height and FWHM equations are written according to the functional form in the documentation, see peak_shape.
 
     return best_fit, fit_params
 
@@ -66,8 +89,12 @@ def gaussian_curve_fit(residuals, parameters, x, y):
              6. Height
              7. AUC
     """
+    from lmfit import Minimizer  # Imported on first use, see the note on imports at the top of the module.
+
     mini = Minimizer(residuals, parameters, fcn_args=(x, y))  # Initialize Minimizer object
-    out = mini.leastsq()  # Use Levenberg-Marquardt minimization to perform a fit.
+    # Use Levenberg-Marquardt minimization to perform a fit, with the analytic Jacobian of the residuals if available.
+    out = mini.leastsq(Dfun=analytic_jacobian(residuals, parameters))
+    out.residual = out.residual.copy()  # The fused residual functions of Residuals reuse their output array.
     best_fit = y + out.residual
     # out.residual is a Numpy array of the minimized objective function when using the best-fit values
     # of the parameters. The best fit curve is therefore the y values plus the minimized residuals.
@@ -76,19 +103,52 @@ def gaussian_curve_fit(residuals, parameters, x, y):
     fit_params = out.params.valuesdict()  # Returns an ordered dictionary of parameter values.
 
     fit_params['r2_score'] = r2_score(y, best_fit)  # Computes the r2 score between the best_fit and y.
-    fit_params['fwhm'] = 2 * ((2 * np.log(2)) ** 0.5) * fit_params['p1_half_width']
-    fit_params['height'] = (1 / (2 * np.pi) ** 0.5) * fit_params['p1_amplitude'] / max(np.finfo(float).eps,
-                                                                                       fit_params['p1_half_width'])
-    fit_params['auc'] = integrate.simpson(best_fit, x)  # Integrate the area below best_fit to get the AUC.
+    fit_params['fwhm'], fit_params['height'] = peak_shape('gaussian', fit_params['p1_amplitude'],
+                                                          fit_params['p1_half_width'])
+    fit_params['auc'] = peak_area(gaussian, x, fit_params['p1_amplitude'], fit_params['p1_center'],
+                                  fit_params['p1_half_width'])  # Integrate the area below the peak to get the AUC.
+
+    # Height and FWHM equations are written according to the functional form in the documentation, see peak_shape.
+
+    return best_fit, fit_params
+
+
+def peak_shape(lineshape, amplitude, half_width, fraction=None):
+    """
+    Compute the FWHM and the height of a single Lorentzian, Gaussian or pseudo-Voigt peak from its best fit parameters,
+    according to the functional forms in the documentation.
 
-    # Height and FWHM equations are written according to the functional form in the documentation.
+    :param lineshape: String indicating either 'lorentzian', 'gaussian' or 'pseudo_voigt'.
+    :param amplitude: Float amplitude of the peak.
+    :param half_width: Float half-width at half-maximum (Lorentzian and pseudo-Voigt) or standard deviation (Gaussian)
+                       of the peak.
+    :param fraction: Float Lorentzian fraction of a pseudo-Voigt peak.
+
+    :return: fwhm - Float full width at half maximum of the peak.
+             height - Float maximum y-value of the peak.
+    """
     # np.finfo(float).eps is the non-zero value of machine limit for floating points. Non-zero value is used so that
     # we do not divide by zero. eps = 2**-52, approximately 2.22e-16.
+    if lineshape == 'lorentzian':
+        fwhm = 2 * half_width
+        height = (1 / np.pi) * amplitude / max(np.finfo(float).eps, half_width)
+    elif lineshape == 'gaussian':
+        fwhm = 2 * ((2 * np.log(2)) ** 0.5) * half_width
+        height = (1 / (2 * np.pi) ** 0.5) * amplitude / max(np.finfo(float).eps, half_width)
+    elif lineshape == 'pseudo_voigt':
+        # Both components share the FWHM, and the standard deviation of the Gaussian is half_width / sqrt(2 ln 2).
+        fwhm = 2 * half_width
+        height = ((1 - fraction) * (1 / (2 * np.pi) ** 0.5) * amplitude /
+                  max(np.finfo(float).eps, half_width / (2 * np.log(2)) ** 0.5) +
+                  fraction * (1 / np.pi) * amplitude / max(np.finfo(float).eps, half_width))
+    else:
+        raise ValueError("Please specify in strings whether the lineshape is 'lorentzian', 'gaussian' or "
+                         "'pseudo_voigt'")
 
-    return best_fit, fit_params
+    return fwhm, height
 
 
-def curve_fit(residuals, parameters, x, y, region):
+def curve_fit(residuals, parameters, x, y, region, full_output=False, area_component=None, fit_options=None):
     """
     Fit a curve to the region of interest. This curve fitting function was specifically written for the vinyl
     and p-xylene regions of a Raman spectra. Therefore, the region of interest must be clearly stated in the region
@@ -106,37 +166,125 @@ def curve_fit(residuals, parameters, x, y, region):
     :param y: Numpy array of y-values
     :param region: String indicating either 'vinyl' or 'pxylene'. This parameter is crucial because it will
                    trigger different fitting functions for calculating the AUC.
+    :param full_output: Boolean. If True, the lmfit MinimizerResult of the fit is returned as a fourth value, which
+                        gives access to fit statistics such as the number of function evaluations (out.nfev).
+    :param area_component: Optional (lineshape, parameter names) tuple of the peak whose AUC is returned. If None, the
+                           peak of the region is looked up in area_components.
+    :param fit_options: Optional dictionary of convergence options passed to Minimizer.leastsq: xtol and ftol, the
+                        relative tolerances of the parameters and of the sum of squares, and max_nfev, the maximum
+                        number of function evaluations. Options which are not given keep the lmfit defaults.
 
     :return: fit_params - Ordered dictionary of best fit parameters that can best fit the data
              r2score - Float of the calculated r2 score between fitted curve and actual data
              area - Float of the calculated AUC of the selected peak
+             out - MinimizerResult of the fit, only returned if full_output is True.
     """
+    from lmfit import Minimizer  # Imported on first use, see the note on imports at the top of the module.
+
     mini = Minimizer(residuals, parameters, fcn_args=(x, y))  # Initialize Minimizer object
-    out = mini.leastsq()  # Use Levenberg-Marquardt minimization to perform a fit.
+    # Use Levenberg-Marquardt minimization to perform a fit, with the analytic Jacobian of the residuals if available.
+    with stage('leastsq'):
+        out = mini.leastsq(Dfun=analytic_jacobian(residuals, parameters), **(fit_options or {}))
+    out.residual = out.residual.copy()  # The fused residual functions of Residuals reuse their output array.
     best_fit = y + out.residual
     # out.residual is a Numpy array of the minimized objective function when using the best-fit values
     # of the parameters. The best fit curve is therefore the y values plus the minimized residuals.
     # best_fit is also a Numpy array.
 
     fit_params = out.params.valuesdict()  # Returns an ordered dictionary of parameter values.
-    r2score = r2_score(y, best_fit)  # Computes the r2 score between the best_fit and y.
-
-    # Use a try-except clause to test whether region was set to 'vinyl' or 'pxylene'
-    # If region was set to vinyl, use the lorentzian lineshape and the relevant peak parameters
-    # If region was set to pxylene, use the split-lorentzian lineshape and the relevant peak parameters
-    # If region was set to neither, raise an exception.
-    try:
-        if region == 'vinyl':
-            y_fit = lorentzian(x, fit_params['p2amp'], fit_params['p2center'], fit_params['p2width'])
-        elif region == 'pxylene':
-            y_fit = split_lorentzian(x, fit_params['p3amp'], fit_params['p3center'], fit_params['p3width_left'],
-                                     fit_params['p3width_right'])
-        elif region != 'vinyl' or region != 'pxylene':
-            raise Exception
-    except Exception as e:
-        print('Please specify in strings whether the region is vinyl or pxylene in curve_fit function')
-
-    # Integrate the area below y_fit to get the AUC.
-    area = integrate.simpson(y_fit, x)
+    with stage('r2_score'):
+        r2score = r2_score(y, best_fit)  # Computes the r2 score between the best_fit and y.
+
+    # Look up the peak of the region whose AUC is returned, unless it was given explicitly.
+    # If region is neither a key of area_components nor given an explicit area component, raise an exception.
+    if area_component is None:
+        if region not in area_components:
+            print('Please specify in strings whether the region is vinyl or pxylene in curve_fit function')
+            raise ValueError('Unknown region ' + repr(region) + ' in curve_fit')
+        area_component = area_components[region]
+
+    with stage('area'):
+        lineshape, names = area_component
+        area = peak_area(lineshape, x, *[fit_params[name] for name in names])  # Integrate the peak to get the AUC.
+
+    if full_output:
+        return fit_params, r2score, area, out
 
     return fit_params, r2score, area
+
+
+def peak_area(lineshape, x, *values, method=None):
+    """
+    Area under a peak over the window of the x-values, from the first to the last x-value, with the method of
+    area_method. Lineshapes without a closed form integral in Lineshapes.areas are always integrated with Simpson's rule.
+
+    :param lineshape: Lineshape function of the Lineshapes module, e.g. lorentzian.
+    :param x: Numpy array of x-values of shape (M,)
+    :param values: Floats, or Numpy arrays of shape (N,) to compute the areas of N peaks at once, of the parameters of
+                   the lineshape after x, in order.
+    :param method: String 'analytic' or 'simpson', or None to use area_method.
+
+    :return: Float area, or Numpy array of shape (N,) of the areas.
+    """
+    method = method or area_method
+    if method not in ('analytic', 'simpson'):
+        raise ValueError("Unknown area method " + repr(method) + ", use 'analytic' or 'simpson'")
+
+    if method == 'analytic' and lineshape in areas:
+        area = areas[lineshape](x[0], x[-1], *values)
+    else:
+        from scipy.integrate import simpson  # Imported on first use, see the note on imports at the top of the module.
+
+        # Evaluate the lineshape of every peak on the x-values, with one row per peak.
+        area = simpson(lineshape(x, *[np.asarray(value, dtype=float)[..., np.newaxis] for value in values]), x=x)
+
+    return float(area) if np.ndim(area) == 0 else area
+
+
+def r2_score(y_true, y_pred):
+    """
+    Coefficient of determination R2 of predicted y-values, as computed by sklearn.metrics.r2_score for a single output,
+    without importing scikit-learn.
+
+    :param y_true: Numpy array of the measured y-values
+    :param y_pred: Numpy array of the predicted y-values, e.g. of the best fit lineshape
+
+    :return: Float R2 score, 1 - SS_res / SS_tot.
+    """
+    ss_res = np.sum((y_true - y_pred) ** 2)
+    ss_tot = np.sum((y_true - np.mean(y_true)) ** 2)
+
+    return float(1 - ss_res / ss_tot)
+
+
+def fit_status(out):
+    """
+    Classify the outcome of a fit from its lmfit MinimizerResult.
+
+    :param out: MinimizerResult of a Minimizer.leastsq fit.
+    :return: status - String 'ok' if the fit converged, 'capped' if it was stopped by the maximum number of function
+                      evaluations, or 'failed' if it did not converge for another reason.
+    """
+    if out.aborted or out.ier == 5:  # ier 5 is the evaluation limit of MINPACK itself.
+        return 'capped'
+    if not out.success:
+        return 'failed'
+    return 'ok'
+
+
+def analytic_jacobian(residuals, parameters):
+    """
+    Look up the analytic Jacobian of a residual function in Residuals.jacobians, to be passed as the Dfun of the
+    Minimizer.leastsq method. With an analytic Jacobian, MINPACK does not need to evaluate the residuals once per
+    varying parameter at every iteration to estimate the derivatives by finite differences.
+
+    The analytic Jacobians only differentiate with respect to the varying parameters themselves, so None is returned
+    when a parameter is constrained by an expression, and the derivatives are then estimated by finite differences.
+
+    :param residuals: Function imported from Residuals module which is the objective function to be minimized.
+    :param parameters: Parameter Object which contains all the relevant parameters for curve fitting.
+    :return: Jacobian function, or None if the residual function has none or the parameters use expressions.
+    """
+    if any(parameter.expr is not None for parameter in parameters.values()):
+        return None
+    return jacobians.get(residuals)
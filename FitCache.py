@@ -0,0 +1,181 @@
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+# Default maximum number of fits kept in a cache file before the least recently used fits are evicted.
+default_max_entries = 1000000
+
+# Version of the cached results, which is part of every cache key. It is increased whenever a change of the code
+# changes the results of a fit with the same inputs, so that fits cached by earlier versions are never returned. They
+# are left to be evicted as the least recently used fits.
+# Version 2: closed form peak areas, see CurveFitting.peak_area.
+cache_version = 2
+
+
+def open_fit_cache(cache_filename):
+    """
+    Open (and create if necessary) an on-disk cache of fit results, stored as a SQLite database. Each entry is keyed by
+    a hash of everything that determines the fit, and stores the best fit parameters, the R2 score and the AUC, so that
+    spectra which were already fitted in a previous run do not have to be fitted again.
+
+    :param cache_filename: String of the cache filename, e.g. 'fit_cache.sqlite'.
+    :return: connection - sqlite3 Connection to the cache.
+    """
+    # A generous timeout lets several worker processes share the same cache file.
+    connection = sqlite3.connect(cache_filename, timeout=60)
+    connection.execute('CREATE TABLE IF NOT EXISTS fits ('
+                       'key TEXT PRIMARY KEY, '
+                       'region TEXT, '
+                       'parameters_hash TEXT, '
+                       'bestfit_params TEXT, '
+                       'r2_score REAL, '
+                       'area REAL, '
+                       'last_access REAL)')
+    connection.commit()
+    return connection
+
+
+def parameters_hash(parameters):
+    """
+    Hash the contents of a Parameters object, i.e. the initial guesses, bounds and constraints read from a parameter
+    spreadsheet. Any change to the spreadsheet changes the hash, and therefore the cache keys of all of its fits.
+
+    :param parameters: Parameters object containing the initial guesses and bounds of the region.
+    :return: String of the hexadecimal SHA-256 hash.
+    """
+    contents = [[name, parameter.value, parameter.vary, parameter.min, parameter.max, parameter.expr]
+                for name, parameter in parameters.items()]
+    return hashlib.sha256(json.dumps(contents).encode()).hexdigest()
+
+
+def fit_cache_keys(x, y, region, residuals, parameters, engine, area_component=None, fit_options=None,
+                   area_method=None):
+    """
+    Compute the cache key of every spectrum. The key is a SHA-256 hash of the spectrum's intensities, the x-values of
+    the window, the region, the residual model, the contents of the Parameters object, the fitting engine, the peak
+    whose AUC is cached and the method of its area, the convergence options of the fit and the cache_version.
+
+    Warm starts are not part of the key, so a fit cached from a warm start can be returned for a static start and vice
+    versa. Both converge to the same minimum within the tolerance of the fit.
+
+    :param x: Numpy array of x-values of shape (M,)
+    :param y: Numpy array of y-values of shape (N, M), one spectrum per row.
+    :param region: String indicating the region of interest.
+    :param residuals: Function which acts as the objective function to be minimised.
+    :param parameters: Parameters object containing the initial guesses and bounds of the region.
+    :param engine: String indicating the fitting engine.
+    :param area_component: Optional (lineshape, parameter names) tuple of the peak whose AUC is cached, or None for the
+                           default peak of the region, see CurveFitting.curve_fit.
+    :param fit_options: Optional dictionary of the convergence options of the fit, e.g. xtol, ftol and max_nfev. Options
+                        set to None are left out, as they keep the defaults of the engine.
+    :param area_method: String method of the cached AUC, see CurveFitting.area_method.
+
+    :return: keys - List of N strings.
+    """
+    # Hash everything that is shared by all spectra once, then extend a copy of it with the bytes of every spectrum.
+    common = hashlib.sha256()
+    common.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    model = residuals.__module__ + '.' + residuals.__qualname__
+    if area_component is not None:
+        lineshape, names = area_component
+        area_component = [lineshape.__module__ + '.' + lineshape.__qualname__, list(names)]
+    # Normalise the options, so that e.g. a max_nfev of 300 and 300.0 or a missing and a None option give the same key.
+    options = sorted((name, float(value)) for name, value in (fit_options or {}).items() if value is not None)
+    common.update(json.dumps([cache_version, region, model, parameters_hash(parameters), engine, area_component,
+                              area_method, options]).encode())
+
+    keys = []
+    for row in np.ascontiguousarray(y, dtype=np.float64):
+        key = common.copy()
+        key.update(row.tobytes())
+        keys.append(key.hexdigest())
+
+    return keys
+
+
+def fetch_fits(connection, keys):
+    """
+    Look up cached fits and mark them as recently used.
+
+    :param connection: sqlite3 Connection to the cache.
+    :param keys: List of cache keys.
+    :return: cached - Dictionary mapping the keys found in the cache to (bestfit_params, r2_score, area) tuples.
+    """
+    cached = {}
+    unique_keys = list(set(keys))
+
+    # Query in batches to stay below the SQLite limit on the number of query parameters.
+    for start in range(0, len(unique_keys), 500):
+        batch = unique_keys[start:start + 500]
+        placeholders = ','.join('?' * len(batch))
+        rows = connection.execute('SELECT key, bestfit_params, r2_score, area FROM fits WHERE key IN (' +
+                                  placeholders + ')', batch).fetchall()
+        for key, bestfit_params, r2_score, area in rows:
+            cached[key] = (json.loads(bestfit_params), r2_score, area)
+
+        now = time.time()
+        connection.executemany('UPDATE fits SET last_access = ? WHERE key = ?', [(now, row[0]) for row in rows])
+
+    connection.commit()
+    return cached
+
+
+def store_fits(connection, keys, region, parameters, bestfit_params_list, r2_score_list, area_list):
+    """
+    Store new fit results in the cache.
+
+    :param connection: sqlite3 Connection to the cache.
+    :param keys: List of cache keys of the fitted spectra.
+    :param region: String indicating the region of interest.
+    :param parameters: Parameters object used for the fits.
+    :param bestfit_params_list: List of Dictionary of Best fit parameters.
+    :param r2_score_list: List of R2 scores of the fits.
+    :param area_list: List of AUC of the fits.
+
+    :return: None
+    """
+    parameter_hash = parameters_hash(parameters)
+    now = time.time()
+    connection.executemany('INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           [(key, region, parameter_hash, json.dumps(dict(bestfit_params)), float(r2_score),
+                             float(area), now)
+                            for key, bestfit_params, r2_score, area in zip(keys, bestfit_params_list, r2_score_list,
+                                                                            area_list)])
+    connection.commit()
+
+
+def evict_fits(connection, max_entries=default_max_entries):
+    """
+    Bound the size of the cache by deleting the least recently used fits beyond max_entries.
+
+    :param connection: sqlite3 Connection to the cache.
+    :param max_entries: Integer maximum number of fits kept in the cache.
+    :return: Integer number of evicted fits.
+    """
+    n_entries = connection.execute('SELECT COUNT(*) FROM fits').fetchone()[0]
+    if n_entries <= max_entries:
+        return 0
+
+    connection.execute('DELETE FROM fits WHERE key IN '
+                       '(SELECT key FROM fits ORDER BY last_access ASC LIMIT ?)', (n_entries - max_entries,))
+    connection.commit()
+    return n_entries - max_entries
+
+
+def invalidate_stale_fits(connection, region, parameters):
+    """
+    Delete the fits of a region which were made with different parameters than the current ones, e.g. after the
+    parameter spreadsheet of the region was edited. Such fits can never be hit again, because the parameters are part
+    of the cache key, so this only reclaims their space.
+
+    :param connection: sqlite3 Connection to the cache.
+    :param region: String indicating the region of interest.
+    :param parameters: Parameters object read from the current parameter spreadsheet of the region.
+    :return: Integer number of deleted fits.
+    """
+    cursor = connection.execute('DELETE FROM fits WHERE region = ? AND parameters_hash != ?',
+                                (region, parameters_hash(parameters)))
+    connection.commit()
+    return cursor.rowcount
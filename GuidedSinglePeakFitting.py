@@ -1,15 +1,20 @@
 from Plotting import simple_line_plot, subplot_2_by_1, baseline_subtraction_plot, \
     fitting_comparison
 from RegionDataFrame import find_nearest
-from BaselineSubtractionFunction import baseline_subtraction_function
+from BaselineSubtractionFunction import baseline_subtraction_function, baseline_subtraction_matrix
 from Residuals import residuals_lorentzian, residuals_gaussian
 from CurveFitting import lorentzian_curve_fit, gaussian_curve_fit
+from SpectralStore import read_spectra_table
 from lmfit import Parameters, Minimizer
 import pandas as pd
 import numpy as np
 import sys
+import os
 import matplotlib.pyplot as plt
 
+# This script is interactive. BatchPeakFitting.py runs the same fit unattended, with the answers to the prompts taken
+# from a config file or command-line flags, e.g. in cluster jobs.
+
 error_comment = 'Please refer to the documentation and ensure that your data is ' \
                 'structured properly before running this package.'
 
@@ -30,10 +35,12 @@ else:
     print(error_comment)
     sys.exit()
 
-prompt2 = str(input('Please fill in the file name (including extension) of the .csv file that contains your data: '))
+prompt2 = str(input('Please fill in the file name (including extension) of the .csv file that contains your data, '
+                    'or the directory of a spectral store converted from it with SpectralStore.py: '))
+output_name = os.path.splitext(prompt2)[0]  # File name without the extension, used to name the output files.
 
 try:
-    df = pd.read_csv(prompt2)
+    df = read_spectra_table(prompt2)
     x = np.array(df.columns, dtype=float)
     y = np.array(df.iloc[0, :], dtype=float)
     title = 'Plot of first spectrum (first row) in dataset'
@@ -193,9 +200,9 @@ prompt9 = str(input('\nProceed to do peak fitting for all spectra in the dataset
 if prompt9 == 'y' and prompt5 == 'n':
     print('\nPeak fitting for all spectra without baseline subtraction commencing.')
     results = []
-    for index, row in region.iterrows():
+    # Fit the spectra as rows of a single float array, without building a pandas Series for every spectrum.
+    for index, y in zip(region.index, region.to_numpy(dtype=float)):
         print('Currently Fitting Spectra Number ' + str(index) + ' out of ' + str(len(region)))
-        y = np.array(row.values, dtype=float)
 
         best_fit, fit_params = curve_fitting_function[prompt8](objective_function[prompt8], parameters,
                                                                region_x, y)
@@ -208,16 +215,16 @@ if prompt9 == 'y' and prompt5 == 'n':
     results = pd.DataFrame(results)
     pd.set_option('display.max_columns', None)  # Print full dataframe without truncation.
 
-    results.to_csv(prompt2[:-4] + '_results.csv')
-    results.describe().to_csv(prompt2[:-4] + '_summary.csv')
+    results.to_csv(output_name + '_results.csv')
+    results.describe().to_csv(output_name + '_summary.csv')
 
 elif prompt9 == 'y' and prompt5 == 'y':
     print('\nPeak fitting for all spectra with baseline subtraction commencing.')
     results = []
-    for index, row in region.iterrows():
+    # Subtract the baselines of all spectra at once, then fit the baseline-corrected spectra one by one.
+    linear_fits, y_subtracted_all = baseline_subtraction_matrix(region_x, region.to_numpy(dtype=float))
+    for index, y_subtracted in zip(region.index, y_subtracted_all):
         print('Currently Fitting Spectra Number ' + str(index) + ' out of ' + str(len(region)))
-        y = np.array(row.values, dtype=float)
-        linear_fit, y_subtracted = baseline_subtraction_function(region.iloc[index, :])
 
         best_fit, fit_params = curve_fitting_function[prompt8](objective_function[prompt8], parameters,
                                                                region_x, y_subtracted)
@@ -230,8 +237,8 @@ elif prompt9 == 'y' and prompt5 == 'y':
     results = pd.DataFrame(results)
     pd.set_option('display.max_columns', None)  # Print full dataframe without truncation.
 
-    results.to_csv(prompt2[:-4] + '_results.csv')
-    results.describe().to_csv(prompt2[:-4] + '_summary.csv')
+    results.to_csv(output_name + '_results.csv')
+    results.describe().to_csv(output_name + '_summary.csv')
 
 elif prompt9 == 'n':
     print('User does not want to continue with peak fitting for all spectra.')
@@ -263,7 +270,7 @@ if prompt10 == 'y':
         axs[1, index].set_xlabel(str(column))
 
     plt.tight_layout()
-    plt.savefig(prompt2[:-4] + '_summary_plot.png')
+    plt.savefig(output_name + '_summary_plot.png')
     plt.show()
 
     print('Summary plot will be saved in a .csv file.\n')
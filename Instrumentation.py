@@ -0,0 +1,187 @@
+import json
+import time
+import pandas as pd
+from contextlib import contextmanager, nullcontext
+
+# Profile of the current process: a dictionary of the wall time and call count of every stage, and the statistics of
+# every fit. None while instrumentation is disabled, which is the default, so that the hooks in the pipeline cost a
+# single comparison.
+_profile = None
+
+_null_stage = nullcontext()  # Shared context manager returned by stage while instrumentation is disabled.
+_exhausted = object()  # Sentinel returned by next when a timed iterator is exhausted.
+
+
+def enable():
+    """
+    Enable the instrumentation of the extraction pipeline in the current process, starting from an empty profile.
+    """
+    global _profile
+    _profile = _new_profile()
+
+
+def disable():
+    """
+    Disable the instrumentation of the extraction pipeline in the current process.
+
+    :return: profile - Dictionary of the stages and fits recorded since instrumentation was enabled, or None.
+    """
+    global _profile
+    profile, _profile = _profile, None
+    return profile
+
+
+def is_enabled():
+    """
+    :return: Boolean. True if the instrumentation is enabled in the current process.
+    """
+    return _profile is not None
+
+
+def stage(name):
+    """
+    Context manager which adds the wall time of its block to the stage of the given name, and counts one call.
+
+        with stage('baseline'):
+            linear_fit, y_subtracted = baseline_subtraction_matrix(x, y)
+
+    :param name: String name of the stage.
+    :return: Context manager. While instrumentation is disabled, a shared no-op context manager is returned.
+    """
+    if _profile is None:
+        return _null_stage
+    return _timed_stage(name)
+
+
+@contextmanager
+def _timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        totals = _profile['stages'].setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += time.perf_counter() - start
+
+
+def timed_iterator(iterable, name):
+    """
+    Wrap an iterator, e.g. a pandas chunked reader, so that the time taken to produce every item is added to the stage
+    of the given name.
+
+    :param iterable: Iterable of items.
+    :param name: String name of the stage.
+    :return: The iterable itself while instrumentation is disabled, otherwise a generator of its items.
+    """
+    if _profile is None:
+        return iterable
+    return _timed_iterator(iter(iterable), name)
+
+
+def _timed_iterator(iterator, name):
+    while True:
+        with stage(name):
+            item = next(iterator, _exhausted)
+        if item is _exhausted:
+            return
+        yield item
+
+
+def record_fits(fit_log):
+    """
+    Record the statistics of fits, e.g. the fit_log entries of MultiRegionFitting.fit_regions, which contain the
+    region, the row, the number of function evaluations, the convergence status and the seconds of every fit.
+
+    :param fit_log: List of dictionaries, one per fit.
+    """
+    if _profile is not None:
+        _profile['fits'].extend(fit_log)
+
+
+def start_collection():
+    """
+    Start collecting a separate profile, e.g. in a worker process, whose profile would otherwise be lost.
+
+    :return: previous - The profile that was being collected before, to be passed to stop_collection.
+    """
+    global _profile
+    previous, _profile = _profile, _new_profile()
+    return previous
+
+
+def stop_collection(previous):
+    """
+    Stop collecting the profile started by start_collection, and restore the previous profile.
+
+    :param previous: The profile returned by start_collection.
+    :return: profile - The profile collected since start_collection, to be passed to merge in the main process.
+    """
+    global _profile
+    profile, _profile = _profile, previous
+    return profile
+
+
+def merge(profile):
+    """
+    Add a profile collected elsewhere, e.g. by a worker process, to the profile of the current process.
+
+    :param profile: Dictionary returned by stop_collection or disable, or None.
+    """
+    if _profile is None or profile is None:
+        return
+
+    for name, (count, seconds) in profile['stages'].items():
+        totals = _profile['stages'].setdefault(name, [0, 0.0])
+        totals[0] += count
+        totals[1] += seconds
+    _profile['fits'].extend(profile['fits'])
+
+
+def report(filename=None, slowest=10):
+    """
+    Summarise the profile of the current process. If a filename is given, the summary is written to a _profile.json
+    file and the statistics of every fit to a _profile.csv file.
+
+    Stages recorded in worker processes are summed over all workers, so their total may exceed the wall time of the
+    run when the spectra are fitted in parallel.
+
+    :param filename: Optional string of the filename WITHOUT the extension.
+    :param slowest: Integer number of the slowest fits listed in the summary.
+
+    :return: summary - Dictionary of the seconds, calls and mean seconds per call of every stage, the number of fits,
+                       the count of every fit status, the function evaluations and failed fits of every region, and
+                       the slowest fits.
+    """
+    if _profile is None:
+        return None
+
+    stages = {name: {'calls': count, 'seconds': seconds, 'mean_seconds': seconds / count}
+              for name, (count, seconds) in sorted(_profile['stages'].items(), key=lambda item: -item[1][1])}
+
+    df_fits = pd.DataFrame(_profile['fits'])
+    fits = {}
+    slowest_fits = []
+    if not df_fits.empty and 'seconds' in df_fits:
+        df_timed = df_fits.dropna(subset=['seconds'])  # Cached and skipped fits have no timing.
+        for region, df_region in df_timed.groupby('region'):
+            fits[region] = {'fits': int(len(df_region)),
+                            'status': df_fits.loc[df_fits['region'] == region, 'status'].value_counts().to_dict(),
+                            'nfev': int(df_region['nfev'].sum()),
+                            'mean_nfev': float(df_region['nfev'].mean()),
+                            'max_nfev': int(df_region['nfev'].max()),
+                            'failed': int((~df_region['success'].astype(bool)).sum()),
+                            'seconds': float(df_region['seconds'].sum())}
+        slowest_fits = json.loads(df_timed.nlargest(slowest, 'seconds').to_json(orient='records'))
+
+    summary = {'stages': stages, 'fits': fits, 'slowest_fits': slowest_fits}
+
+    if filename is not None:
+        with open(filename + '_profile.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        df_fits.to_csv(filename + '_profile.csv', index=False)
+
+    return summary
+
+
+def _new_profile():
+    return {'stages': {}, 'fits': []}
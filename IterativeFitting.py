@@ -1,43 +1,326 @@
 import numpy as np
-from BaselineSubtractionFunction import baseline_subtraction_function
-from Parameters import define_region_parameters
-from CurveFitting import curve_fit
+import time
+from functools import partial
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from BaselineSubtractionFunction import baseline_subtraction_matrix
+from Parameters import define_region_parameters, copy_parameters
+import CurveFitting
+from CurveFitting import curve_fit, fit_status
+from BatchedFitting import batched_curve_fit
+from FitCache import open_fit_cache, fit_cache_keys, fetch_fits, store_fits, evict_fits, default_max_entries
+from Instrumentation import stage
 
 
-def iterative_fitting(df_region, parameter_filename, region, residuals):
+def iterative_fitting(df_region, parameter_filename, region, residuals, workers=None, engine='lmfit',
+                      warm_start=False, r2_threshold=0.95, fit_log=None, cache=None, cache_size=default_max_entries,
+                      fit_options=None, baseline=True):
     """
     Iterate through every row of the region of interest and execute the curve fitting.
 
+    If workers is larger than 1, the rows of the region of interest are split into contiguous chunks and the chunks are
+    fitted in parallel on a pool of worker processes. Every chunk is fitted with exactly the same serial code path,
+    and the results are stitched back together in the original row order, so the output is identical to the serial
+    path.
+
+    Note that scripts calling iterative_fitting with workers larger than 1 must guard their top-level code with
+    if __name__ == '__main__': because the worker processes re-import the calling script on Windows and macOS.
+
+    If engine is 'batched', the baseline-subtracted rows are fitted together by BatchedFitting.batched_curve_fit
+    instead of one lmfit minimisation per row. The residuals function is then only used by the 'lmfit' engine, as the
+    batched engine selects the model of the region from the region string.
+
+    If warm_start is True, every fit is seeded with the best fit parameters of the previous row, since neighbouring
+    spectra of a time-resolved dataset are nearly identical and fewer iterations are then needed to converge. The fit
+    falls back to the initial guesses of the parameter file when the previous fit has an R2 score below r2_threshold,
+    and for the first row (of every chunk, when fitting in parallel). Warm starts are only available with the 'lmfit'
+    engine.
+
+    If a list is passed as fit_log, one dictionary is appended to it for every fitted row, containing the row index,
+    the start strategy ('warm' or 'static'), the number of function evaluations used by the fit, its convergence
+    status (the success flag and the MINPACK ier code of the MinimizerResult, and the status of fit_array) and the
+    seconds taken by the fit. The evaluations
+    used by each start strategy can then be compared with pd.DataFrame(fit_log).groupby('start')['nfev'].sum().
+
+    If a cache filename is given, the fit results are stored in a persistent on-disk cache (see FitCache), keyed by a
+    hash of the baseline-corrected intensities, the x-values, the residual model, the parameters and the engine. Rows
+    whose fit is already in the cache are not fitted again, and are recorded in fit_log with the start strategy 'cache'
+    and no function evaluations. The least recently used fits are evicted once the cache holds cache_size fits.
+
     :param df_region: pandas DataFrame already truncated to contain the region of interest
-    :param parameter_filename: String of filename with file extension
+    :param parameter_filename: String of filename with file extension, or a Parameters object which was already read
+                               with define_region_parameters (e.g. when fitting a file chunk by chunk).
     :param region: String indicating the region of interest
     :param residuals: Function which acts as the objective function to be minimised.
+    :param workers: Integer number of worker processes. None or 1 fits all rows in the current process.
+    :param engine: String indicating either 'lmfit' (one Minimizer per row) or 'batched' (all rows fitted at once).
+    :param warm_start: Boolean. If True, seed every fit with the best fit parameters of the previous row.
+    :param r2_threshold: Float R2 score that the previous fit must exceed to be used as a warm start.
+    :param fit_log: Optional list to which the start strategy and function evaluations of every fit are appended.
+    :param cache: Optional string of the fit cache filename, e.g. 'fit_cache.sqlite'. None disables the cache.
+    :param cache_size: Integer maximum number of fits kept in the fit cache.
+    :param fit_options: Optional dictionary of xtol, ftol, max_nfev and min_snr, see fit_array.
+    :param baseline: Boolean. If False, the rows are fitted without subtracting a linear baseline first.
 
     :return: bestfit_params_list - List of Ordered Dictionary of Best fit parameters that can best fit the curve
              r2_score_list - List of R2 scores of the fit
              area_list - List of AUC of Vinyl Peak
     """
+    if warm_start and engine != 'lmfit':
+        raise ValueError("Warm starts are only available with the 'lmfit' engine in iterative_fitting")
+
+    if isinstance(parameter_filename, str):
+        parameters = define_region_parameters(parameter_filename)
+    else:
+        parameters = parameter_filename
+
+    fit_rows = partial(fit_array, parameters=parameters, region=region, residuals=residuals, engine=engine,
+                       warm_start=warm_start, r2_threshold=r2_threshold, cache=cache, cache_size=cache_size,
+                       fit_options=fit_options, baseline=baseline)
+
+    # Leave pandas at the boundary: the wavenumber labels are parsed once, and the rows are fitted from a float array.
+    x = np.array(df_region.columns, dtype=float)
+    y = df_region.to_numpy(dtype=float)
+    index = df_region.index.to_numpy()
+
+    if workers is None or workers <= 1 or len(df_region) <= 1:
+        bestfit_params_list, r2_score_list, area_list, status_list, chunk_log = fit_rows(x, y, index)
+        if fit_log is not None:
+            fit_log.extend(chunk_log)
+        return bestfit_params_list, r2_score_list, area_list
+
+    # Split the rows into one contiguous chunk per worker. np.array_split keeps the chunks in order and allows the
+    # number of rows to not be an exact multiple of the number of workers. The chunks are views on the array.
+    n_chunks = min(workers, len(df_region))
+    y_chunks = np.array_split(y, n_chunks)
+    index_chunks = np.array_split(index, n_chunks)
+
     bestfit_params_list = []  # List of Ordered Dictionary of Best fit parameters that can best fit the curve
     r2_score_list = []  # List of R2 scores of the fit
     area_list = []  # List of AUC of Vinyl Peak
 
-    parameters = define_region_parameters(parameter_filename)
+    # executor.map returns the results in the order of the submitted chunks, regardless of which chunk finishes first.
+    with ProcessPoolExecutor(max_workers=n_chunks) as executor:
+        for chunk_params, chunk_r2, chunk_area, chunk_status, chunk_log in executor.map(fit_rows, repeat(x), y_chunks,
+                                                                                       index_chunks):
+            bestfit_params_list.extend(chunk_params)
+            r2_score_list.extend(chunk_r2)
+            area_list.extend(chunk_area)
+            if fit_log is not None:
+                fit_log.extend(chunk_log)
+
+    return bestfit_params_list, r2_score_list, area_list
+
 
-    for index, series in df_region.iterrows():  # Iterate over DataFrame rows as (index, Series) pairs.
+def fit_array(x, y, index, parameters, region, residuals, engine='lmfit', warm_start=False, r2_threshold=0.95,
+              cache=None, cache_size=default_max_entries, area_component=None, fit_options=None, baseline=True):
+    """
+    Serially fit every row of a 2-D array of spectra of the region of interest. This is the array-based core of
+    iterative_fitting and MultiRegionFitting.fit_regions, and the unit of work executed by each worker process when
+    they are run in parallel, so it must stay a module-level function to be picklable.
 
-        x = np.array(series.index, dtype=float)
-        y = series
+    The baselines of all rows are subtracted at once with baseline_subtraction_matrix, on a float64 copy of the rows
+    which is made once for the whole array. The rows are then fitted as views on that copy, without building a pandas
+    Series or parsing the x-values for every row. Rows found in the fit cache are skipped, and with the 'batched'
+    engine the remaining rows are fitted together in a single call.
 
-        linear_fit, y_subtracted = baseline_subtraction_function(region=y)
+    The convergence of the fits is controlled by the fit_options dictionary, whose keys are all optional:
+    'xtol' and 'ftol' - Float relative tolerances of the parameters and of the sum of squares.
+    'max_nfev' - Integer maximum number of function evaluations (iterations with the 'batched' engine) of each fit.
+    'min_snr' - Float minimum signal-to-noise ratio of a baseline-corrected row, below which the row is not fitted.
 
-        bestfit_params, r2score, area = curve_fit(residuals=residuals,
-                                                  parameters=parameters,
-                                                  x=x,
-                                                  y=y_subtracted,
-                                                  region=region)
+    Every row is given a status: 'ok' for a converged fit, 'capped' for a fit stopped by max_nfev, 'failed' for a fit
+    which did not converge for another reason, and 'skipped' for a row below min_snr. Skipped rows are returned with
+    NaN parameters, R2 score and area, so they are dropped by the R2 filter of the aggregation. Only fits with the
+    status 'ok' are stored in the fit cache, under a key which includes xtol, ftol and max_nfev, so that a run with
+    other convergence options fits the rows again and re-evaluates their status.
 
-        bestfit_params_list.append(bestfit_params)
-        r2_score_list.append(r2score)
-        area_list.append(area)
+    :param x: Numpy array of the x-values (wavenumbers) of the region, of shape (M,)
+    :param y: Numpy array of the y-values of the region, of shape (N, M), one spectrum per row.
+    :param index: Sequence of N row labels, e.g. the original index of the spectra, used in the fit log.
+    :param parameters: Parameters object containing the initial guesses and bounds of the region
+    :param region: String indicating the region of interest
+    :param residuals: Function which acts as the objective function to be minimised.
+    :param engine: String indicating either 'lmfit' or 'batched'.
+    :param warm_start: Boolean. If True, seed every fit with the best fit parameters of the previous row.
+    :param r2_threshold: Float R2 score that the previous fit must exceed to be used as a warm start.
+    :param cache: Optional string of the fit cache filename.
+    :param cache_size: Integer maximum number of fits kept in the fit cache.
+    :param area_component: Optional (lineshape, parameter names) tuple of the peak whose AUC is returned by the
+                           'lmfit' engine, see CurveFitting.curve_fit.
+    :param fit_options: Optional dictionary of the convergence options of the region, as described above.
+    :param baseline: Boolean. If False, the rows are fitted as they are, without subtracting a linear baseline.
 
-    return bestfit_params_list, r2_score_list, area_list
+    :return: bestfit_params_list, r2_score_list, area_list as described in iterative_fitting.
+             status_list - List of the status of every fit.
+             fit_log - List of dictionaries with the start strategy, function evaluations and status of every fit.
+    """
+    if engine not in ('lmfit', 'batched'):
+        raise ValueError("Please specify in strings whether the engine is 'lmfit' or 'batched' in iterative_fitting")
+
+    fit_options = dict(fit_options or {})
+    min_snr = fit_options.pop('min_snr', None)
+    leastsq_options = {key: value for key, value in fit_options.items() if value is not None}
+
+    x = np.asarray(x, dtype=float)
+    index = np.asarray(index).tolist()  # Plain Python labels for the fit log.
+
+    # Subtract the linear baselines of all rows at once. A float64 copy of the rows is made, so it is overwritten.
+    with stage('baseline'):
+        y_block = np.array(y, dtype=float)
+        if baseline:
+            linear_fit, y_subtracted_block = baseline_subtraction_matrix(x=x, y=y_block, overwrite=True)
+        else:
+            y_subtracted_block = y_block
+
+    # Pre-screen the rows, so that rows without a peak above the noise do not spend the longest fits of the run
+    # before being dropped by the R2 filter anyway.
+    if min_snr is not None:
+        with stage('pre-screen'):
+            skipped = signal_to_noise(y_subtracted_block) < min_snr
+    else:
+        skipped = np.zeros(len(y_block), dtype=bool)
+
+    # Look up the rows which were already fitted in a previous run.
+    cached = {}
+    if cache is not None:
+        with stage('cache'):
+            connection = open_fit_cache(cache)
+            keys = fit_cache_keys(x, y_subtracted_block, region, residuals, parameters, engine, area_component,
+                                  leastsq_options, CurveFitting.area_method)
+            cached = fetch_fits(connection, keys)
+    else:
+        keys = [None] * len(y_block)
+
+    bestfit_params_list = []  # List of Ordered Dictionary of Best fit parameters that can best fit the curve
+    r2_score_list = []  # List of R2 scores of the fit
+    area_list = []  # List of AUC of Vinyl Peak
+    status_list = []  # List of the status of every fit
+    fit_log = []  # List of start strategy and function evaluations of every fit
+    fitted = []  # Positions of the rows which were fitted rather than found in the cache or skipped
+
+    skipped_fit = ({name: np.nan for name in parameters}, np.nan, np.nan)  # Result of every skipped row.
+
+    if engine == 'batched':
+        # Fit all rows missing from the cache in one call, then merge them with the cached rows in the original order.
+        fitted = [position for position, key in enumerate(keys) if key not in cached and not skipped[position]]
+        batched_options = {'max_iterations' if key == 'max_nfev' else key: value
+                           for key, value in leastsq_options.items()}
+        with stage('batched_fit'):
+            batch_results = iter(zip(*batched_curve_fit(parameters=parameters, x=x, y=y_subtracted_block[fitted],
+                                                        region=region, full_output=True,
+                                                        **batched_options))) if fitted else iter(())
+        for position, key in enumerate(keys):
+            if skipped[position]:
+                result, status = skipped_fit, 'skipped'
+            elif key in cached:
+                result, status = cached[key], 'ok'
+            else:
+                bestfit_params, r2score, area, status = next(batch_results)
+                result = (bestfit_params, r2score, area)
+            bestfit_params_list.append(result[0])
+            r2_score_list.append(result[1])
+            area_list.append(result[2])
+            status_list.append(status)
+            fit_log.append({'row': index[position], 'start': 'batched', 'status': status})
+
+    else:
+        warm_parameters = None  # Copy of the parameters seeded in place for every warm start.
+
+        # Iterate over the row labels and views on the baseline-corrected rows.
+        for position, (label, y_subtracted) in enumerate(zip(index, y_subtracted_block)):
+
+            if skipped[position] or keys[position] in cached:
+                result, status = (skipped_fit, 'skipped') if skipped[position] else (cached[keys[position]], 'ok')
+                bestfit_params_list.append(result[0])
+                r2_score_list.append(result[1])
+                area_list.append(result[2])
+                status_list.append(status)
+                fit_log.append({'row': label, 'start': 'cache' if status == 'ok' else 'skipped', 'nfev': 0,
+                                'status': status})
+                continue
+
+            # Seed the fit with the previous best fit parameters if they are available and the previous fit was good.
+            if warm_start and r2_score_list and r2_score_list[-1] > r2_threshold:
+                start = 'warm'
+                warm_parameters = warm_start_parameters(parameters, bestfit_params_list[-1], warm_parameters)
+                initial_parameters = warm_parameters
+            else:
+                start = 'static'
+                initial_parameters = parameters
+
+            fit_start = time.perf_counter()
+            bestfit_params, r2score, area, out = curve_fit(residuals=residuals,
+                                                           parameters=initial_parameters,
+                                                           x=x,
+                                                           y=y_subtracted,
+                                                           region=region,
+                                                           full_output=True,
+                                                           area_component=area_component,
+                                                           fit_options=leastsq_options)
+            status = fit_status(out)
+
+            bestfit_params_list.append(bestfit_params)
+            r2_score_list.append(r2score)
+            area_list.append(area)
+            status_list.append(status)
+            fit_log.append({'row': label, 'start': start, 'nfev': out.nfev, 'success': out.success, 'ier': out.ier,
+                            'status': status, 'seconds': time.perf_counter() - fit_start})
+            fitted.append(position)
+
+    # Store the new converged fits in the cache and keep the cache within its size bound.
+    if cache is not None:
+        stored = [position for position in fitted if status_list[position] == 'ok']
+        with stage('cache'):
+            store_fits(connection, [keys[position] for position in stored], region, parameters,
+                       [bestfit_params_list[position] for position in stored],
+                       [r2_score_list[position] for position in stored],
+                       [area_list[position] for position in stored])
+            evict_fits(connection, cache_size)
+            connection.close()
+
+    return bestfit_params_list, r2_score_list, area_list, status_list, fit_log
+
+
+def signal_to_noise(y):
+    """
+    Estimate the signal-to-noise ratio of baseline-corrected spectra, as the maximum intensity of each spectrum divided
+    by the standard deviation of its noise. The noise is estimated from the median absolute deviation of the
+    differences between neighbouring points, which is hardly affected by the peaks as they span many points.
+
+    :param y: Numpy array of baseline-corrected y-values of shape (N, M), one spectrum per row.
+    :return: snr - Numpy array of shape (N,) of the signal-to-noise ratio of every spectrum.
+    """
+    differences = np.diff(y, axis=1)
+    deviation = np.median(np.abs(differences - np.median(differences, axis=1, keepdims=True)), axis=1)
+    noise = 1.4826 * deviation / np.sqrt(2)  # Standard deviation of the noise of a single point.
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.max(y, axis=1) / noise
+
+
+def warm_start_parameters(parameters, bestfit_params, initial_parameters=None):
+    """
+    Create a copy of the Parameters object with its values replaced by the best fit parameters of a previous fit.
+
+    Best fit values lying exactly on a min/max bound keep the initial guess from the Parameters object instead, because
+    the bounds transformation of lmfit has a zero gradient on the bounds and the fit could not move away from them.
+
+    A copy made for a previous fit can be passed as initial_parameters to be seeded again in place, which avoids a copy
+    per fit. This is safe because the lmfit Minimizer works on its own copy of the parameters it is given.
+
+    :param parameters: Parameters object containing the initial guesses and bounds of the region
+    :param bestfit_params: Ordered Dictionary of Best fit parameters of the previous fit
+    :param initial_parameters: Optional copy of the Parameters object to seed in place.
+
+    :return: initial_parameters - Copy of the Parameters object seeded with the previous best fit parameters.
+    """
+    if initial_parameters is None:
+        initial_parameters = copy_parameters(parameters)
+
+    for name, value in bestfit_params.items():
+        parameter = initial_parameters[name]
+        if parameter.expr is None:
+            parameter.value = value if parameter.min < value < parameter.max else parameters[name].value
+
+    return initial_parameters
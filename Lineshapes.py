@@ -0,0 +1,289 @@
+import numpy as np
+import math
+
+tiny = 1.0e-15  # Same floor as lmfit.lineshapes, used to avoid dividing by a zero width.
+s2pi = np.sqrt(2 * np.pi)
+
+# The lineshapes below are written with the same floating point operations as lmfit.lineshapes, so that they give the
+# same values, bit for bit, for float parameters. They are used instead of lmfit.lineshapes by the fitting code, as
+# importing lmfit.lineshapes imports all of lmfit.
+
+
+def lorentzian(x, amplitude, center, sigma):
+    """
+    Broadcasting version of the lmfit Lorentzian lineshape.
+
+    lorentzian(x, amplitude, center, sigma) = (amplitude / pi) * sigma / ((x - center)**2 + sigma**2)
+
+    The parameters may be floats or Numpy arrays of shape (N, 1), in which case the lineshape of N spectra is
+    evaluated at once on the shared x-values and a Numpy array of shape (N, M) is returned.
+
+    :param x: Numpy array of x-values of shape (M,)
+    :param amplitude: Float or Numpy array of amplitudes.
+    :param center: Float or Numpy array of centers.
+    :param sigma: Float or Numpy array of half-widths at half-maximum.
+
+    :return: Numpy array containing the y-values of the lineshape.
+    """
+    return (amplitude / (1 + ((1.0 * x - center) / np.maximum(tiny, sigma)) ** 2)) / np.maximum(tiny, np.pi * sigma)
+
+
+def lorentzian_derivatives(x, amplitude, center, sigma):
+    """
+    Analytic partial derivatives of the Lorentzian lineshape with respect to its parameters.
+
+    :param x: Numpy array of x-values of shape (M,)
+    :param amplitude: Float or Numpy array of amplitudes.
+    :param center: Float or Numpy array of centers.
+    :param sigma: Float or Numpy array of half-widths at half-maximum.
+
+    :return: d_amplitude, d_center, d_sigma - Numpy arrays of the same shape as the lineshape.
+    """
+    sigma = np.maximum(tiny, sigma)
+    dx = x - center
+    denominator = dx ** 2 + sigma ** 2
+
+    d_amplitude = sigma / (np.pi * denominator)
+    d_center = (amplitude / np.pi) * 2 * sigma * dx / denominator ** 2
+    d_sigma = (amplitude / np.pi) * (dx ** 2 - sigma ** 2) / denominator ** 2
+
+    return d_amplitude, d_center, d_sigma
+
+
+def split_lorentzian(x, amplitude, center, sigma, sigma_r):
+    """
+    Broadcasting version of the lmfit split-Lorentzian lineshape, which uses the half-width sigma to the left of the
+    center and the half-width sigma_r to the right of the center.
+
+    split_lorentzian(x, amplitude, center, sigma, sigma_r) =
+        [2 * amplitude / (pi * (sigma + sigma_r))] * w**2 / ((x - center)**2 + w**2),
+        with w = sigma for x < center and w = sigma_r for x >= center.
+
+    :param x: Numpy array of x-values of shape (M,)
+    :param amplitude: Float or Numpy array of amplitudes.
+    :param center: Float or Numpy array of centers.
+    :param sigma: Float or Numpy array of left half-widths.
+    :param sigma_r: Float or Numpy array of right half-widths.
+
+    :return: Numpy array containing the y-values of the lineshape.
+    """
+    sigma = np.maximum(tiny, sigma)
+    sigma_r = np.maximum(tiny, sigma_r)
+    squared_distance = (x - center) ** 2
+    # The half-width that applies on each side of the center is selected by multiplying with the masks of both sides.
+    amplitude_scale = 2 * amplitude / (np.pi * (sigma + sigma_r))
+    return amplitude_scale * (sigma * sigma * (x < center) / (sigma * sigma + squared_distance)
+                              + sigma_r * sigma_r * (x >= center) / (sigma_r * sigma_r + squared_distance))
+
+
+def split_lorentzian_derivatives(x, amplitude, center, sigma, sigma_r):
+    """
+    Analytic partial derivatives of the split-Lorentzian lineshape with respect to its parameters.
+
+    :param x: Numpy array of x-values of shape (M,)
+    :param amplitude: Float or Numpy array of amplitudes.
+    :param center: Float or Numpy array of centers.
+    :param sigma: Float or Numpy array of left half-widths.
+    :param sigma_r: Float or Numpy array of right half-widths.
+
+    :return: d_amplitude, d_center, d_sigma, d_sigma_r - Numpy arrays of the same shape as the lineshape.
+    """
+    sigma = np.maximum(tiny, sigma)
+    sigma_r = np.maximum(tiny, sigma_r)
+    dx = x - center
+    left = dx < 0
+    width = np.where(left, sigma, sigma_r)
+    denominator = dx ** 2 + width ** 2
+
+    scale = 2 / (np.pi * (sigma + sigma_r))  # Normalisation factor, without the amplitude.
+    shape = width ** 2 / denominator  # Unnormalised lineshape, equal to 1 at the center.
+    value = amplitude * scale * shape
+
+    d_amplitude = scale * shape
+    d_center = amplitude * scale * 2 * width ** 2 * dx / denominator ** 2
+    d_width = amplitude * scale * 2 * width * dx ** 2 / denominator ** 2  # Derivative with respect to the active width.
+    d_sigma = -value / (sigma + sigma_r) + np.where(left, d_width, 0)
+    d_sigma_r = -value / (sigma + sigma_r) + np.where(left, 0, d_width)
+
+    return d_amplitude, d_center, d_sigma, d_sigma_r
+
+
+def gaussian(x, amplitude, center, sigma):
+    """
+    Broadcasting version of the lmfit Gaussian lineshape.
+
+    gaussian(x, amplitude, center, sigma) = (amplitude / (sqrt(2 * pi) * sigma)) * exp(-(x - center)**2 / (2 * sigma**2))
+
+    :param x: Numpy array of x-values of shape (M,)
+    :param amplitude: Float or Numpy array of amplitudes.
+    :param center: Float or Numpy array of centers.
+    :param sigma: Float or Numpy array of standard deviations.
+
+    :return: Numpy array containing the y-values of the lineshape.
+    """
+    return ((amplitude / np.maximum(tiny, s2pi * sigma))
+            * np.exp(-(1.0 * x - center) ** 2 / np.maximum(tiny, 2 * sigma ** 2)))
+
+
+def gaussian_derivatives(x, amplitude, center, sigma):
+    """
+    Analytic partial derivatives of the Gaussian lineshape with respect to its parameters.
+
+    :param x: Numpy array of x-values of shape (M,)
+    :param amplitude: Float or Numpy array of amplitudes.
+    :param center: Float or Numpy array of centers.
+    :param sigma: Float or Numpy array of standard deviations.
+
+    :return: d_amplitude, d_center, d_sigma - Numpy arrays of the same shape as the lineshape.
+    """
+    sigma = np.maximum(tiny, sigma)
+    dx = x - center
+    d_amplitude = np.exp(-dx ** 2 / (2 * sigma ** 2)) / (np.sqrt(2 * np.pi) * sigma)
+    value = amplitude * d_amplitude
+
+    d_center = value * dx / sigma ** 2
+    d_sigma = value * (dx ** 2 - sigma ** 2) / sigma ** 3
+
+    return d_amplitude, d_center, d_sigma
+
+
+def pseudo_voigt(x, amplitude, center, sigma, fraction):
+    """
+    Broadcasting version of the lmfit pseudo-Voigt lineshape (lmfit.lineshapes.pvoigt), a weighted sum of a Lorentzian
+    and a Gaussian of the same amplitude, center and full width at half maximum.
+
+    pseudo_voigt(x, amplitude, center, sigma, fraction) =
+        (1 - fraction) * gaussian(x, amplitude, center, sigma_g) + fraction * lorentzian(x, amplitude, center, sigma),
+        with sigma_g = sigma / sqrt(2 * ln(2)).
+
+    :param x: Numpy array of x-values of shape (M,)
+    :param amplitude: Float or Numpy array of amplitudes.
+    :param center: Float or Numpy array of centers.
+    :param sigma: Float or Numpy array of half-widths at half-maximum.
+    :param fraction: Float or Numpy array of the Lorentzian fractions, between 0 and 1.
+
+    :return: Numpy array containing the y-values of the lineshape.
+    """
+    sigma_g = sigma / np.sqrt(2 * np.log(2))
+    return ((1 - fraction) * gaussian(x, amplitude, center, sigma_g) +
+            fraction * lorentzian(x, amplitude, center, sigma))
+
+
+def pseudo_voigt_derivatives(x, amplitude, center, sigma, fraction):
+    """
+    Analytic partial derivatives of the pseudo-Voigt lineshape with respect to its parameters.
+
+    :param x: Numpy array of x-values of shape (M,)
+    :param amplitude: Float or Numpy array of amplitudes.
+    :param center: Float or Numpy array of centers.
+    :param sigma: Float or Numpy array of half-widths at half-maximum.
+    :param fraction: Float or Numpy array of the Lorentzian fractions, between 0 and 1.
+
+    :return: d_amplitude, d_center, d_sigma, d_fraction - Numpy arrays of the same shape as the lineshape.
+    """
+    scale = 1 / np.sqrt(2 * np.log(2))  # Derivative of sigma_g with respect to sigma.
+    g_amplitude, g_center, g_sigma = gaussian_derivatives(x, amplitude, center, sigma * scale)
+    l_amplitude, l_center, l_sigma = lorentzian_derivatives(x, amplitude, center, sigma)
+
+    d_amplitude = (1 - fraction) * g_amplitude + fraction * l_amplitude
+    d_center = (1 - fraction) * g_center + fraction * l_center
+    d_sigma = (1 - fraction) * g_sigma * scale + fraction * l_sigma
+    d_fraction = amplitude * (l_amplitude - g_amplitude)  # The lineshapes are linear in the amplitude.
+
+    return d_amplitude, d_center, d_sigma, d_fraction
+
+
+# Error function of NumPy arrays, from the error function of the math module, so that the Gaussian areas need neither
+# SciPy nor a compiled extension.
+_erf = np.vectorize(math.erf, otypes=[float])
+
+
+def lorentzian_area(lower, upper, amplitude, center, sigma):
+    """
+    Closed form integral of the Lorentzian lineshape from lower to upper.
+
+    integral = (amplitude / pi) * (arctan((upper - center) / sigma) - arctan((lower - center) / sigma))
+
+    The parameters may be floats or Numpy arrays of shape (N,), in which case the areas of N peaks are computed at once.
+
+    :param lower: Float lower limit of the integral, e.g. the first x-value of the region.
+    :param upper: Float upper limit of the integral, e.g. the last x-value of the region.
+    :param amplitude: Float or Numpy array of amplitudes.
+    :param center: Float or Numpy array of centers.
+    :param sigma: Float or Numpy array of half-widths at half-maximum.
+
+    :return: Float or Numpy array of the areas.
+    """
+    sigma = np.maximum(tiny, sigma)
+    return (amplitude / np.pi) * (np.arctan((upper - center) / sigma) - np.arctan((lower - center) / sigma))
+
+
+def split_lorentzian_area(lower, upper, amplitude, center, sigma, sigma_r):
+    """
+    Closed form integral of the split-Lorentzian lineshape from lower to upper. The half of the peak to the left of the
+    center contributes an arctan term of width sigma, and the half to the right an arctan term of width sigma_r, each
+    over the part of the interval on its side of the center.
+
+    :param lower: Float lower limit of the integral, e.g. the first x-value of the region.
+    :param upper: Float upper limit of the integral, e.g. the last x-value of the region.
+    :param amplitude: Float or Numpy array of amplitudes.
+    :param center: Float or Numpy array of centers.
+    :param sigma: Float or Numpy array of left half-widths.
+    :param sigma_r: Float or Numpy array of right half-widths.
+
+    :return: Float or Numpy array of the areas.
+    """
+    sigma = np.maximum(tiny, sigma)
+    sigma_r = np.maximum(tiny, sigma_r)
+
+    def antiderivative(limit):
+        # Antiderivative of the lineshape without its normalisation factor, continuous at the center.
+        distance = limit - center
+        return (sigma * np.arctan(np.minimum(distance, 0) / sigma) +
+                sigma_r * np.arctan(np.maximum(distance, 0) / sigma_r))
+
+    return 2 * amplitude / (np.pi * (sigma + sigma_r)) * (antiderivative(upper) - antiderivative(lower))
+
+
+def gaussian_area(lower, upper, amplitude, center, sigma):
+    """
+    Closed form integral of the Gaussian lineshape from lower to upper.
+
+    integral = (amplitude / 2) * (erf((upper - center) / (sqrt(2) * sigma)) - erf((lower - center) / (sqrt(2) * sigma)))
+
+    :param lower: Float lower limit of the integral, e.g. the first x-value of the region.
+    :param upper: Float upper limit of the integral, e.g. the last x-value of the region.
+    :param amplitude: Float or Numpy array of amplitudes.
+    :param center: Float or Numpy array of centers.
+    :param sigma: Float or Numpy array of standard deviations.
+
+    :return: Float or Numpy array of the areas.
+    """
+    scale = np.sqrt(2) * np.maximum(tiny, sigma)
+    return (amplitude / 2) * (_erf((upper - center) / scale) - _erf((lower - center) / scale))
+
+
+def pseudo_voigt_area(lower, upper, amplitude, center, sigma, fraction):
+    """
+    Closed form integral of the pseudo-Voigt lineshape from lower to upper, the weighted sum of the integrals of its
+    Gaussian and Lorentzian components.
+
+    :param lower: Float lower limit of the integral, e.g. the first x-value of the region.
+    :param upper: Float upper limit of the integral, e.g. the last x-value of the region.
+    :param amplitude: Float or Numpy array of amplitudes.
+    :param center: Float or Numpy array of centers.
+    :param sigma: Float or Numpy array of half-widths at half-maximum.
+    :param fraction: Float or Numpy array of the Lorentzian fractions, between 0 and 1.
+
+    :return: Float or Numpy array of the areas.
+    """
+    sigma_g = sigma / np.sqrt(2 * np.log(2))
+    return ((1 - fraction) * gaussian_area(lower, upper, amplitude, center, sigma_g) +
+            fraction * lorentzian_area(lower, upper, amplitude, center, sigma))
+
+
+# Closed form integral of every lineshape, used by CurveFitting.peak_area.
+areas = {lorentzian: lorentzian_area,
+         split_lorentzian: split_lorentzian_area,
+         gaussian: gaussian_area,
+         pseudo_voigt: pseudo_voigt_area}
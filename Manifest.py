@@ -0,0 +1,34 @@
+import pandas as pd
+import os
+
+# Manifest of the raw data files to process: a .csv file with a 'file' column of the raw data filenames (or spectral
+# stores), a 'time' column of the residence time of every file in minutes, an optional 'label' column of the name of
+# every file, e.g. 't0_repeat', and an optional 'reference' column of the label of the benchmark run every file is
+# converted against in ConversionCalculation. Files without a reference are only used as benchmarks.
+# The manifest is read by Scheduler.py, which extracts the ratios of its files, and by ConversionCalculation.py, which
+# converts them. This module only depends on pandas, so the conversion does not import the fitting pipeline.
+manifest = 'manifest.csv'
+
+
+def read_manifest(filename):
+    """
+    Read the manifest of the raw data files to process.
+
+    :param filename: String of the manifest filename with the .csv extension.
+    :return: df_manifest - DataFrame with the 'file', 'time', 'label' and 'reference' columns, in the order of the
+                           manifest. Missing labels default to the filename without the 'df_' prefix and the extension,
+                           and missing references are None.
+    """
+    df_manifest = pd.read_csv(filename)
+
+    for column in ['label', 'reference']:
+        if column not in df_manifest:
+            df_manifest[column] = None
+    default_labels = [os.path.splitext(os.path.basename(file))[0].removeprefix('df_') for file in df_manifest['file']]
+    df_manifest['label'] = df_manifest['label'].fillna(pd.Series(default_labels, index=df_manifest.index))
+    df_manifest['reference'] = df_manifest['reference'].astype(object).where(df_manifest['reference'].notna(), None)
+
+    if df_manifest['label'].duplicated().any():
+        raise ValueError('The labels of the manifest ' + filename + ' are not unique')
+
+    return df_manifest[['file', 'time', 'label', 'reference']]
@@ -0,0 +1,169 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from Parameters import define_region_parameters
+from IterativeFitting import fit_array
+from FitCache import default_max_entries
+import Instrumentation
+
+
+def region_spec(region, window, residuals, parameters, area_component=None, fit_options=None):
+    """
+    Describe one region of interest of the spectra for fit_regions.
+
+    :param region: String name of the region, e.g. 'vinyl' or 'pxylene'. It selects the model of the 'batched' engine
+                   and the default area component, and it is the key of the region in the per-spectrum records.
+    :param window: Tuple of the (left, right) column indices of the region in the raw data file.
+    :param residuals: Function which acts as the objective function to be minimised.
+    :param parameters: String of the parameter filename with file extension, or a Parameters object.
+    :param area_component: Optional (lineshape, parameter names) tuple of the peak whose AUC is returned. If None, the
+                           peak of the region in CurveFitting.area_components is used.
+    :param fit_options: Optional dictionary of the convergence options of the region: xtol, ftol, max_nfev and min_snr,
+                        as described in IterativeFitting.fit_array.
+
+    :return: spec - Dictionary describing the region.
+    """
+    return {'region': region, 'window': window, 'residuals': residuals, 'parameters': parameters,
+            'area_component': area_component, 'fit_options': fit_options}
+
+
+def fit_regions(region_frames, region_specs, workers=None, concurrent_regions=False, engine='lmfit', warm_start=False,
+                r2_threshold=0.95, fit_log=None, cache=None, cache_size=default_max_entries, baseline=True):
+    """
+    Fit every region of interest of a block of spectra in a single pass, and return one record per spectrum with the
+    fit results of all regions.
+
+    The spectra are split into contiguous chunks, and each chunk is visited once: the baselines of every region of the
+    chunk are subtracted at once, and the regions are fitted one after the other with the same serial code path as
+    IterativeFitting.iterative_fitting. The parameter files of the regions are read once, before any chunk is fitted.
+
+    If workers is larger than 1, the chunks are fitted in parallel on a pool of worker processes, one chunk per worker.
+    If concurrent_regions is True, each (chunk, region) pair is submitted as a separate task instead, so the regions
+    of a chunk are also fitted concurrently. This balances the load better when one region is much slower to fit than
+    the others. In both cases the results are identical to the serial path.
+
+    Note that scripts calling fit_regions with workers larger than 1 must guard their top-level code with
+    if __name__ == '__main__': because the worker processes re-import the calling script on Windows and macOS.
+
+    :param region_frames: Dictionary mapping each region name to the DataFrame of the region, with the same rows in
+                          every DataFrame, e.g. from RegionDataFrame.read_regions.
+    :param region_specs: List of region specs created by region_spec.
+    :param workers: Integer number of worker processes. None or 1 fits all spectra in the current process.
+    :param concurrent_regions: Boolean. If True, fit the regions of every chunk concurrently.
+    :param engine: String indicating either 'lmfit' (one Minimizer per row) or 'batched' (all rows fitted at once).
+    :param warm_start: Boolean. If True, seed every fit with the best fit parameters of the previous row.
+    :param r2_threshold: Float R2 score that the previous fit must exceed to be used as a warm start.
+    :param fit_log: Optional list to which the start strategy, function evaluations, convergence status and seconds of
+                    every fit are appended, with the region name added to every entry. The entries are also recorded
+                    by Instrumentation.record_fits, together with the stages timed in the worker processes, when the
+                    instrumentation is enabled.
+    :param cache: Optional string of the fit cache filename, e.g. 'fit_cache.sqlite'. None disables the cache.
+    :param cache_size: Integer maximum number of fits kept in the fit cache.
+    :param baseline: Boolean. If False, the spectra are fitted without subtracting a linear baseline first.
+
+    :return: records - List with one dictionary per spectrum, mapping each region name to the
+                       (bestfit_params, r2_score, area, status) tuple of its fit, where status is 'ok',
+                       'capped', 'failed' or 'skipped' as described in IterativeFitting.fit_array.
+    """
+    if warm_start and engine != 'lmfit':
+        raise ValueError("Warm starts are only available with the 'lmfit' engine in fit_regions")
+
+    # Read the parameter files once, so that the worker processes receive ready Parameters objects.
+    specs = []
+    for spec in region_specs:
+        spec = dict(spec)
+        if isinstance(spec['parameters'], str):
+            spec['parameters'] = define_region_parameters(spec['parameters'])
+        specs.append(spec)
+
+    options = {'engine': engine, 'warm_start': warm_start, 'r2_threshold': r2_threshold, 'cache': cache,
+               'cache_size': cache_size, 'baseline': baseline}
+
+    # Leave pandas at the boundary: parse the wavenumber labels of every region once, and fit the rows from arrays.
+    arrays = {}
+    for spec in specs:
+        df_region = region_frames[spec['region']]
+        arrays[spec['region']] = (np.array(df_region.columns, dtype=float), df_region.to_numpy(),
+                                  df_region.index.to_numpy())
+
+    n_spectra = len(region_frames[specs[0]['region']])
+    if workers is None or workers <= 1 or n_spectra <= 1:
+        chunks = [slice(0, n_spectra)]
+    else:
+        # One contiguous chunk of rows per worker, kept in order as in iterative_fitting. Slicing the arrays with the
+        # chunks gives views rather than copies.
+        n_chunks = min(workers, n_spectra)
+        chunks = [slice(rows[0], rows[-1] + 1) for rows in np.array_split(np.arange(n_spectra), n_chunks)]
+
+    if concurrent_regions:
+        tasks = [([spec], rows) for rows in chunks for spec in specs]
+    else:
+        tasks = [(specs, rows) for rows in chunks]
+
+    profile = Instrumentation.is_enabled()
+    arguments = [({spec['region']: _chunk_arrays(arrays[spec['region']], rows) for spec in task_specs}, task_specs,
+                  options, profile) for task_specs, rows in tasks]
+
+    if len(arguments) == 1:
+        results = [_fit_chunk(*arguments[0])]
+    else:
+        # executor.map returns the results in the order of the submitted tasks, regardless of which finishes first.
+        with ProcessPoolExecutor(max_workers=min(workers, len(arguments))) as executor:
+            results = list(executor.map(_fit_chunk, *zip(*arguments)))
+
+    # Stitch the results of every region of every chunk back into one record per spectrum, in the original order.
+    records = [{} for _ in range(n_spectra)]
+    for (task_specs, rows), (chunk_results, chunk_log, chunk_profile) in zip(tasks, results):
+        for region, region_results in chunk_results.items():
+            for row, result in zip(range(n_spectra)[rows], zip(*region_results)):
+                records[row][region] = result
+        if fit_log is not None:
+            fit_log.extend(chunk_log)
+        Instrumentation.merge(chunk_profile)
+        Instrumentation.record_fits(chunk_log)
+
+    return records
+
+
+def _chunk_arrays(region_arrays, rows):
+    """
+    Select the rows of a chunk from the (x, y, index) arrays of a region. The x-values are shared by all rows.
+    """
+    x, y, index = region_arrays
+    return x, y[rows], index[rows]
+
+
+def _fit_chunk(chunk_arrays, specs, options, profile=False):
+    """
+    Serially fit every region of a chunk of spectra, given as an (x, y, index) tuple of arrays per region. This is the
+    unit of work executed by each worker process when fit_regions is run in parallel, so it must stay a module-level
+    function to be picklable.
+
+    If profile is True, the stages of the chunk are collected in a separate profile which is returned to the main
+    process, since the instrumentation state of a worker process is otherwise lost.
+
+    :return: chunk_results - Dictionary mapping each region name to its bestfit_params_list, r2_score_list, area_list
+                             and status_list, as returned by IterativeFitting.fit_array.
+             fit_log - List of dictionaries with the region, start strategy and function evaluations of every fit.
+             chunk_profile - Instrumentation profile of the chunk, or None if profile is False.
+    """
+    previous = Instrumentation.start_collection() if profile else None
+
+    chunk_results = {}
+    fit_log = []
+
+    for spec in specs:
+        region = spec['region']
+        x, y, index = chunk_arrays[region]
+        *region_results, region_log = fit_array(x, y, index,
+                                                parameters=spec['parameters'],
+                                                region=region,
+                                                residuals=spec['residuals'],
+                                                area_component=spec['area_component'],
+                                                fit_options=spec.get('fit_options'),
+                                                **options)
+        chunk_results[region] = region_results
+        fit_log.extend(dict(entry, region=region) for entry in region_log)
+
+    chunk_profile = Instrumentation.stop_collection(previous) if profile else None
+
+    return chunk_results, fit_log, chunk_profile
@@ -1,6 +1,9 @@
 import pandas as pd
 import numpy as np
-from lmfit import Parameters
+from ConfigCache import load_config
+
+# Columns of the parameter spreadsheets, in the order of the arguments of Parameters.add.
+parameter_columns = ['name', 'value', 'vary', 'min', 'max', 'expr', 'brute_step']
 
 
 def define_region_parameters(filename):
@@ -8,16 +11,68 @@ def define_region_parameters(filename):
     Reads an Excel file and imports the user defined parameter values and bounds within the excel file
     into a Parameter object, amenable for usage during curve fitting using the lmfit library.
 
+    The spreadsheet is parsed once and cached, see ConfigCache.load_config, and every call returns a new Parameters
+    object built from the cached rows, which the caller is free to modify.
+
     :param filename: String containing the excel filename with the file extension
     :return: parameters - Parameters object which contains all relevant use defined parameters
     """
-    df = pd.read_excel(filename)  # Read excel file with parameters filled in.
-    df = df.replace(np.nan, None)  # Replace empty cells with None.
+    from lmfit import Parameters  # Imported on first use, see the note on imports in CurveFitting.
+
+    rows = load_config(filename, read_parameter_rows)
 
     parameters = Parameters()  # Instantiate Parameters object
 
-    # Iterate through the rows of the DataFrame and add defined parameters to parameters object.
-    for index, series in df.iterrows():
-        parameters.add(*series.values)
+    # Add the rows of the table to parameters object.
+    parameters.add_many(*[tuple(row) for row in rows])
 
     return parameters
+
+
+def read_parameter_rows(filename):
+    """
+    Parse and validate a parameter spreadsheet, with one row per parameter and the columns of parameter_columns.
+
+    :param filename: String containing the excel filename with the file extension
+    :return: rows - List of the [name, value, vary, min, max, expr, brute_step] list of every parameter, with None for
+                    the empty cells.
+    """
+    df = pd.read_excel(filename)  # Read excel file with parameters filled in.
+    df = df.replace(np.nan, None)  # Replace empty cells with None.
+
+    missing = [column for column in parameter_columns if column not in df.columns]
+    if missing:
+        raise ValueError('The parameter file ' + filename + ' is missing the columns ' + ', '.join(missing))
+
+    rows = []
+    for row in df[parameter_columns].to_numpy(dtype=object):
+        # Convert Numpy scalars into Python scalars, which are JSON serialisable.
+        name, value, vary, minimum, maximum, expr, brute_step = [cell.item() if isinstance(cell, np.generic) else cell
+                                                                 for cell in row]
+        if not isinstance(name, str) or not name.isidentifier():
+            raise ValueError('Invalid parameter name ' + repr(name) + ' in the parameter file ' + filename)
+        if value is None and expr is None:
+            raise ValueError('The parameter ' + name + ' in the parameter file ' + filename + ' has no value')
+        if minimum is not None and maximum is not None and minimum > maximum:
+            raise ValueError('The min of the parameter ' + name + ' in the parameter file ' + filename +
+                             ' is larger than its max')
+        rows.append([name, value, vary, minimum, maximum, expr, brute_step])
+
+    return rows
+
+
+def copy_parameters(parameters):
+    """
+    Copy a Parameters object without the deep copy of Parameters.copy, which also copies the fit statistics and the
+    user data of every parameter. Only the values, bounds, constraints and brute steps are copied.
+
+    :param parameters: Parameters object.
+    :return: Copy of the Parameters object.
+    """
+    from lmfit import Parameters
+
+    copy = Parameters()
+    copy.add_many(*[(parameter.name, parameter.value, parameter.vary, parameter.min, parameter.max, parameter.expr,
+                     parameter.brute_step) for parameter in parameters.values()])
+
+    return copy
@@ -1,5 +1,8 @@
 import pandas as pd
 import numpy as np
+from SpectralStore import is_store, open_store
+from Instrumentation import stage, timed_iterator
+from ConfigCache import load_config
 
 
 def find_nearest(array, value):
@@ -37,16 +40,218 @@ def region_df_slice(col_indices_filename, raw_data_filename):
     :return: df_vinyl: DataFrame truncated to be between the column indices for vinyl region set by the user.
              df_pxylene: DataFrame truncated to be between the column indices for pxylene region set by the user.
     """
-    df = pd.read_csv(raw_data_filename)  # Import raw Excel file
+    # Only the columns of the two regions are parsed from the raw file. See read_region_data.
+    df_labels, df_vinyl, df_pxylene = read_region_data(col_indices_filename, raw_data_filename)
 
-    # Import the excel file containing the column indices for slicing and convert the DataFrame into a dictionary
-    # amenable for usage in index slicing.
+    return df_vinyl, df_pxylene
+
+
+def read_column_indices(col_indices_filename):
+    """
+    Import the excel file containing the column indices for slicing and convert the DataFrame into a dictionary
+    amenable for usage in index slicing.
+
+    :param col_indices_filename: String containing the filename with extension of .xlsx containing
+                                 column indices set by the user.
+    :return: d - Dictionary of column indices, with the keys vinyl_left, vinyl_right, pxylene_left and pxylene_right.
+    """
+    # The spreadsheet is parsed once and cached, see ConfigCache.load_config.
+    d = dict(load_config(col_indices_filename, parse_column_indices))
+
+    return d
+
+
+def parse_column_indices(col_indices_filename):
+    """
+    Parse and validate the excel file of column indices, with the name of every index in the first column and the
+    index in the second column.
+
+    :param col_indices_filename: String containing the filename with extension of .xlsx containing
+                                 column indices set by the user.
+    :return: d - Dictionary of column indices.
+    """
     df_col_indices = pd.read_excel(col_indices_filename, header=None, index_col=0)
-    d = df_col_indices.to_dict()[1]
 
-    # Truncate DataFrame using pandas index slicing.
-    df_vinyl = df.iloc[:, d['vinyl_left']:d['vinyl_right']]
-    df_pxylene = df.iloc[:, d['pxylene_left']:d['pxylene_right']]
+    d = {}
+    for name, index in df_col_indices[1].items():
+        if not isinstance(name, str) or not float(index).is_integer() or index < 0:
+            raise ValueError('Invalid column index ' + repr(name) + ': ' + repr(index) + ' in ' + col_indices_filename)
+        d[name] = int(index)
 
-    return df_vinyl, df_pxylene
+    return d
+
+
+def region_windows(col_indices_filename, regions=('vinyl', 'pxylene')):
+    """
+    Read the column window of every region from the excel file of column indices, which contains a <region>_left and
+    a <region>_right row for every region. A new region can be added to the extraction pipeline by adding its two rows.
+
+    :param col_indices_filename: String containing the filename with extension of .xlsx containing
+                                 column indices set by the user.
+    :param regions: Iterable of region names.
+    :return: windows - Dictionary mapping each region name to its (left, right) column indices.
+    """
+    d = read_column_indices(col_indices_filename)
+
+    return {region: (d[region + '_left'], d[region + '_right']) for region in regions}
+
+
+def read_region_data(col_indices_filename, raw_data_filename, dtype=np.float64):
+    """
+    Parse the raw data file once and extract only the columns required by the extraction pipeline: the original index
+    and the Condition column (the first two columns), and the columns of the vinyl and p-xylene regions given by the
+    column indices set by the user. All other wavenumber columns are skipped by the CSV parser, so neither the I/O nor
+    the memory is spent on them.
+
+    The intensities of each region are converted into a single contiguous Numpy block of the requested dtype, and the
+    region DataFrames are thin wrappers around those blocks, so that df_vinyl.to_numpy() returns the block itself
+    without a copy. float32 halves the memory of the blocks, while the fitting itself is always done in float64.
+
+    :param col_indices_filename: String containing the filename with extension of .xlsx containing
+                                 column indices set by the user.
+    :param raw_data_filename: String containing the filename with extension of .csv containing all extracted
+                              Raman spectra, or the directory of a binary spectral store created from such a file by
+                              SpectralStore.convert_csv_to_store. The regions of a store are sliced out of its
+                              memory-mapped intensities without parsing any text.
+    :param dtype: Numpy float dtype of the region blocks, np.float64 (default) or np.float32.
+
+    :return: df_labels: DataFrame containing only the original index and Condition columns, for aggregate_ratio.
+             df_vinyl: DataFrame of the vinyl region, between the column indices set by the user.
+             df_pxylene: DataFrame of the pxylene region, between the column indices set by the user.
+    """
+    windows = region_windows(col_indices_filename)
+    df_labels, region_frames = read_regions(raw_data_filename, windows, dtype)
+
+    return df_labels, region_frames['vinyl'], region_frames['pxylene']
+
+
+def iter_region_data(col_indices_filename, raw_data_filename, chunksize, dtype=np.float64, start=0):
+    """
+    Streaming version of read_region_data, for raw data files larger than the available memory. The raw data file is
+    parsed in chunks of at most chunksize rows (spectra), and the label and region DataFrames of each chunk are yielded
+    one at a time, so only one chunk is held in memory at any time.
+
+    The first start spectra are skipped without being parsed, e.g. to resume a run from its last checkpoint.
+
+    :param col_indices_filename: String containing the filename with extension of .xlsx containing
+                                 column indices set by the user.
+    :param raw_data_filename: String containing the filename with extension of .csv containing all extracted
+                              Raman spectra, or the directory of a binary spectral store.
+    :param chunksize: Integer number of spectra in each chunk.
+    :param dtype: Numpy float dtype of the region blocks, np.float64 (default) or np.float32.
+    :param start: Integer number of spectra to skip at the start of the file.
+
+    :return: Generator of (df_labels, df_vinyl, df_pxylene) tuples, as returned by read_region_data, for each chunk.
+    """
+    windows = region_windows(col_indices_filename)
+
+    for df_labels, region_frames in iter_regions(raw_data_filename, windows, chunksize, dtype, start):
+        yield df_labels, region_frames['vinyl'], region_frames['pxylene']
+
+
+def read_regions(raw_data_filename, windows, dtype=np.float64):
+    """
+    Parse the raw data file once and extract only the label columns and the column window of every region. This is
+    the general form of read_region_data for any number of regions.
+
+    :param raw_data_filename: String containing the filename with extension of .csv containing all extracted
+                              Raman spectra, or the directory of a binary spectral store.
+    :param windows: Dictionary mapping each region name to its (left, right) column indices, e.g. from region_windows.
+    :param dtype: Numpy float dtype of the region blocks, np.float64 (default) or np.float32.
+
+    :return: df_labels: DataFrame containing only the original index and Condition columns.
+             region_frames: Dictionary mapping each region name to the DataFrame of the region.
+    """
+    if is_store(raw_data_filename):
+        with stage('read'):
+            return _store_regions(raw_data_filename, windows, dtype)
+
+    usecols, label_columns, region_columns = _region_columns(raw_data_filename, windows)
+    with stage('read'):
+        df = pd.read_csv(raw_data_filename,
+                         usecols=usecols,
+                         dtype={column: dtype for column in usecols[2:]})
+
+    with stage('slicing'):
+        return _split_regions(df, label_columns, region_columns, dtype)
+
+
+def iter_regions(raw_data_filename, windows, chunksize, dtype=np.float64, start=0):
+    """
+    Streaming version of read_regions, which yields the label and region DataFrames of chunks of at most chunksize
+    spectra, after skipping the first start spectra.
+
+    :return: Generator of (df_labels, region_frames) tuples, as returned by read_regions, for each chunk.
+    """
+    if is_store(raw_data_filename):
+        df_labels, region_frames = _store_regions(raw_data_filename, windows, dtype)
+        for row in range(start, len(df_labels), chunksize):
+            yield (df_labels.iloc[row:row + chunksize],
+                   {region: df_region.iloc[row:row + chunksize] for region, df_region in region_frames.items()})
+        return
+
+    usecols, label_columns, region_columns = _region_columns(raw_data_filename, windows)
+
+    with pd.read_csv(raw_data_filename,
+                     usecols=usecols,
+                     dtype={column: dtype for column in usecols[2:]},
+                     skiprows=range(1, start + 1),  # Skip the first spectra, but not the header line.
+                     chunksize=chunksize) as reader:
+        for df in timed_iterator(reader, 'read'):
+            with stage('slicing'):
+                regions = _split_regions(df, label_columns, region_columns, dtype)
+            yield regions
+
+
+def _region_columns(raw_data_filename, windows):
+    """
+    Find the labels of the columns required by the extraction pipeline from the header line of the raw data file.
+    The column indices are positions in the full raw file, exactly as used for iloc slicing in the full DataFrame.
+
+    :return: usecols - List of all column labels to parse, starting with the two label columns.
+             label_columns - List of the two label column labels.
+             region_columns - Dictionary mapping each region name to the column labels of the region.
+    """
+    columns = pd.read_csv(raw_data_filename, nrows=0).columns  # Read only the header line.
+    label_columns = list(columns[:2])
+    region_columns = {region: columns[left:right] for region, (left, right) in windows.items()}
+
+    # Parse every column only once, even if the windows of two regions overlap.
+    usecols = list(label_columns)
+    for region_column_labels in region_columns.values():
+        usecols += [column for column in region_column_labels if column not in usecols]
+
+    return usecols, label_columns, region_columns
+
+
+def _split_regions(df, label_columns, region_columns, dtype):
+    """
+    Split a DataFrame parsed with the columns of _region_columns into the label DataFrame and the region DataFrames.
+    Each region is copied once into a contiguous block and wrapped in a DataFrame without a further copy.
+    """
+    df_labels = df[label_columns]
+
+    region_frames = {}
+    for region, columns in region_columns.items():
+        block = np.ascontiguousarray(df[columns].to_numpy(dtype=dtype))
+        region_frames[region] = pd.DataFrame(block, columns=columns, index=df.index, copy=False)
+
+    return df_labels, region_frames
+
+
+def _store_regions(store_directory, windows, dtype):
+    """
+    Slice the label and region DataFrames out of a binary spectral store. The region DataFrames are views on the
+    memory-mapped intensities, so no intensities are read until the spectra are actually used, unless the dtype of the
+    store differs from the requested dtype.
+    """
+    df_labels, wavenumbers, intensities, n_label_columns = open_store(store_directory)
+
+    region_frames = {}
+    for region, (left, right) in windows.items():
+        # The column indices are positions in the original .csv file, which had the label columns in front.
+        columns = slice(left - n_label_columns, right - n_label_columns)
+        region_frames[region] = pd.DataFrame(intensities[:, columns].astype(dtype, copy=False),
+                                             columns=wavenumbers[columns], copy=False)
 
+    return df_labels, region_frames
@@ -1,4 +1,31 @@
-from lmfit.lineshapes import lorentzian, gaussian, split_lorentzian
+import numpy as np
+from Lineshapes import lorentzian, gaussian, pseudo_voigt, tiny
+from Lineshapes import lorentzian_derivatives, gaussian_derivatives, pseudo_voigt_derivatives
+
+# The residuals and Jacobians of the vinyl and p-xylene regions are the hot loop of the extraction pipeline, so they are
+# evaluated by fused region models instead of one lineshape at a time. Every Lorentzian peak, and every side of a
+# split-Lorentzian peak, is a term k * m / ((x - c)**2 + w2) of the model, with a numerator k, a mask m selecting the
+# side of the center, a center c and a squared half-width w2, and all terms of a region are evaluated together, with a
+# handful of array operations on a (terms, points) array. The arrays are allocated once per region and number of
+# x-values, and reused by every call with the same number of x-values, i.e. for every spectrum of a region of a file.
+# Only their shapes depend on x: the x-values themselves are read on every call, so x may be changed or replaced
+# between calls.
+#
+# The fused residuals equal those of the lineshapes of Lineshapes.py up to rounding. The returned arrays are
+# overwritten by the next call with the same x-values, so callers which keep them must copy them, as the curve fitting
+# functions of CurveFitting do with out.residual. The arrays belong to the process, so the fused functions must not be
+# called from several threads at once.
+
+# Peaks of the fused region models, as (lineshape, parameter names) tuples, for the 'lorentzian' and 'split_lorentzian'
+# lineshapes of Lineshapes.py.
+fused_models = {'vinyl': [('lorentzian', ('p1amp', 'p1center', 'p1width')),
+                          ('lorentzian', ('p2amp', 'p2center', 'p2width'))],
+                'pxylene': [('lorentzian', ('p1amp', 'p1center', 'p1width')),
+                            ('lorentzian', ('p2amp', 'p2center', 'p2width')),
+                            ('split_lorentzian', ('p3amp', 'p3center', 'p3width_left', 'p3width_right'))]}
+
+# Arrays of the fused region models, keyed by region, see _workspace.
+_workspaces = {}
 
 
 def residuals_lorentzian(parameters, x, y):
@@ -45,6 +72,28 @@ def residuals_gaussian(parameters, x, y):
     return residuals
 
 
+def residuals_pseudo_voigt(parameters, x, y):
+    """
+    A function which calculates the residuals between a set of fitted data points and the original data points.
+    This function will be called using the lmfit Minimizer object as an objective function to be minimized.
+
+    This residual function calculates the residuals based on fitting a pseudo-Voigt lineshape, a weighted sum of a
+    Lorentzian and a Gaussian, to the single peak. The Lorentzian fraction p1_fraction should be bounded between 0
+    and 1.
+
+    :param parameters: An lmfit Parameters object defined by the user.
+    :param x: Numpy array containing the x-values.
+    :param y: Numpy array containing the y-values.
+
+    :return: residuals - Numpy array containing the residuals between the fitted model’s
+                         y-values and the actual y-values.
+    """
+    model = pseudo_voigt(x, parameters['p1_amplitude'], parameters['p1_center'], parameters['p1_half_width'],
+                         parameters['p1_fraction'])
+    residuals = model - y
+    return residuals
+
+
 def residuals_vinyl(parameters, x, y):
     """
     A function which produces the residuals between a set of fitted data points and the original data points.
@@ -63,10 +112,7 @@ def residuals_vinyl(parameters, x, y):
     :return: residuals - Numpy array containing the residuals between the fitted model’s
                          y-values and the actual y-values.
     """
-    model = (lorentzian(x, parameters['p1amp'], parameters['p1center'], parameters['p1width']) +
-             lorentzian(x, parameters['p2amp'], parameters['p2center'], parameters['p2width']))
-    residuals = model - y
-    return residuals
+    return _fused_residuals('vinyl', parameters, x, y)
 
 
 def residuals_pxylene(parameters, x, y):
@@ -88,9 +134,311 @@ def residuals_pxylene(parameters, x, y):
     :return: residuals - Numpy array containing the residuals between the fitted model’s
                          y-values and the actual y-values.
     """
-    model = (lorentzian(x, parameters['p1amp'], parameters['p1center'], parameters['p1width']) +
-             lorentzian(x, parameters['p2amp'], parameters['p2center'], parameters['p2width']) +
-             split_lorentzian(x, parameters['p3amp'], parameters['p3center'], parameters['p3width_left'],
-                              parameters['p3width_right']))
-    residuals = model - y
+    return _fused_residuals('pxylene', parameters, x, y)
+
+
+def jacobian_lorentzian(parameters, x, y):
+    """
+    Analytic Jacobian of residuals_lorentzian, for use as the Dfun of the lmfit Minimizer.leastsq method.
+
+    :param parameters: An lmfit Parameters object defined by the user.
+    :param x: Numpy array containing the x-values.
+    :param y: Numpy array containing the y-values.
+
+    :return: jacobian - Numpy array of shape (len(x), number of varying parameters) containing the derivatives of the
+                        residuals with respect to the varying parameters, in the order of the Parameters object.
+    """
+    names = ('p1_amplitude', 'p1_center', 'p1_half_width')
+    derivatives = lorentzian_derivatives(x, *[parameters[name].value for name in names])
+    return _varying_columns(parameters, x, zip(names, derivatives))
+
+
+def jacobian_gaussian(parameters, x, y):
+    """
+    Analytic Jacobian of residuals_gaussian, for use as the Dfun of the lmfit Minimizer.leastsq method.
+
+    :param parameters: An lmfit Parameters object defined by the user.
+    :param x: Numpy array containing the x-values.
+    :param y: Numpy array containing the y-values.
+
+    :return: jacobian - Numpy array of shape (len(x), number of varying parameters), as in jacobian_lorentzian.
+    """
+    names = ('p1_amplitude', 'p1_center', 'p1_half_width')
+    derivatives = gaussian_derivatives(x, *[parameters[name].value for name in names])
+    return _varying_columns(parameters, x, zip(names, derivatives))
+
+
+def jacobian_pseudo_voigt(parameters, x, y):
+    """
+    Analytic Jacobian of residuals_pseudo_voigt, for use as the Dfun of the lmfit Minimizer.leastsq method.
+
+    :param parameters: An lmfit Parameters object defined by the user.
+    :param x: Numpy array containing the x-values.
+    :param y: Numpy array containing the y-values.
+
+    :return: jacobian - Numpy array of shape (len(x), number of varying parameters), as in jacobian_lorentzian.
+    """
+    names = ('p1_amplitude', 'p1_center', 'p1_half_width', 'p1_fraction')
+    derivatives = pseudo_voigt_derivatives(x, *[parameters[name].value for name in names])
+    return _varying_columns(parameters, x, zip(names, derivatives))
+
+
+def jacobian_vinyl(parameters, x, y):
+    """
+    Analytic Jacobian of residuals_vinyl, for use as the Dfun of the lmfit Minimizer.leastsq method.
+
+    :param parameters: An lmfit Parameters object defined by the user.
+    :param x: Numpy array containing the x-values.
+    :param y: Numpy array containing the y-values.
+
+    :return: jacobian - Numpy array of shape (len(x), number of varying parameters), as in jacobian_lorentzian.
+    """
+    return _fused_jacobian('vinyl', parameters, x)
+
+
+def jacobian_pxylene(parameters, x, y):
+    """
+    Analytic Jacobian of residuals_pxylene, for use as the Dfun of the lmfit Minimizer.leastsq method.
+
+    :param parameters: An lmfit Parameters object defined by the user.
+    :param x: Numpy array containing the x-values.
+    :param y: Numpy array containing the y-values.
+
+    :return: jacobian - Numpy array of shape (len(x), number of varying parameters), as in jacobian_lorentzian.
+    """
+    return _fused_jacobian('pxylene', parameters, x)
+
+
+# Analytic Jacobian of every residual function, used by the curve fitting functions of CurveFitting.
+jacobians = {residuals_lorentzian: jacobian_lorentzian,
+             residuals_gaussian: jacobian_gaussian,
+             residuals_pseudo_voigt: jacobian_pseudo_voigt,
+             residuals_vinyl: jacobian_vinyl,
+             residuals_pxylene: jacobian_pxylene}
+
+
+def check_jacobian(residuals, jacobian, parameters, x, y, step=1e-6):
+    """
+    Compare an analytic Jacobian with the central finite differences of its residual function, at the values of the
+    Parameters object. Use this to validate a new Jacobian before adding it to the jacobians dictionary.
+
+    :param residuals: Function which acts as the objective function to be minimised.
+    :param jacobian: Analytic Jacobian function of the residual function.
+    :param parameters: An lmfit Parameters object defined by the user.
+    :param x: Numpy array containing the x-values.
+    :param y: Numpy array containing the y-values.
+    :param step: Float relative step size of the finite differences.
+
+    :return: error - Float of the largest absolute difference between the analytic and the numeric derivatives,
+                     relative to the largest absolute numeric derivative of the same parameter.
+    """
+    analytic = np.array(jacobian(parameters, x, y))
+    names = [name for name, parameter in parameters.items() if parameter.vary and parameter.expr is None]
+
+    error = 0.0
+    for column, name in enumerate(names):
+        shifted = parameters.copy()
+        value = parameters[name].value
+        h = step * max(abs(value), 1.0)
+
+        shifted[name].value = value + h
+        forward = residuals(shifted, x, y).copy()  # Copied, as the fused residuals reuse their output array.
+        shifted[name].value = value - h
+        backward = residuals(shifted, x, y)
+
+        numeric = (forward - backward) / (2 * h)
+        scale = max(np.max(np.abs(numeric)), np.finfo(float).tiny)
+        error = max(error, np.max(np.abs(analytic[:, column] - numeric)) / scale)
+
+    return error
+
+
+def _varying_columns(parameters, x, columns):
+    """
+    Assemble the Jacobian matrix from the derivatives of the model with respect to each named parameter, keeping only
+    the parameters which are varied by the fit, in the order of the Parameters object as expected by lmfit. Parameters
+    which are not used by the model have zero derivatives.
+    """
+    derivatives = dict(columns)
+    varying = [name for name, parameter in parameters.items() if parameter.vary and parameter.expr is None]
+    return np.column_stack([np.broadcast_to(derivatives.get(name, 0.0), np.shape(x)) for name in varying])
+
+
+def _fused_residuals(region, parameters, x, y):
+    """
+    Residuals of the fused model of a region, see fused_models.
+
+    :return: residuals - Numpy array of shape (M,), overwritten by the next call with the same number of x-values.
+    """
+    x = np.asarray(x, dtype=float)
+    workspace = _workspace(region, x)
+    _evaluate_terms(workspace, parameters, x)
+
+    residuals = workspace['residual']
+    np.add.reduce(workspace['terms'], 0, None, residuals)  # Sum of the terms.
+    np.subtract(residuals, y, residuals)
     return residuals
+
+
+def _fused_jacobian(region, parameters, x):
+    """
+    Analytic Jacobian of the residuals of the fused model of a region, see fused_models.
+
+    The derivatives of every term with respect to its numerator, center and squared half-width are computed as arrays
+    of shape (terms, M), and combined into the derivatives with respect to the parameters by a single matrix product
+    with the chain rule matrix of _evaluate_terms.
+
+    :return: jacobian - Fortran-ordered Numpy array of shape (M, number of varying parameters), overwritten by the next
+                        call with the same number of x-values.
+    """
+    x = np.asarray(x, dtype=float)
+    workspace = _workspace(region, x)
+    _evaluate_terms(workspace, parameters, x, chain_rule=True)
+
+    dx, denominator, terms, mask = workspace['dx'], workspace['denominator'], workspace['terms'], workspace['mask']
+    d_numerator, d_center, d_width = workspace['term_derivatives']
+
+    # d term / d k = m / den, d term / d c = 2 * dx * term / den and d term / d w2 = -term / den. The factors 2 and -1
+    # are applied in the chain rule matrix.
+    np.divide(mask, denominator, d_numerator)
+    np.divide(terms, denominator, d_width)
+    np.multiply(dx, d_width, d_center)
+
+    np.matmul(workspace['chain'], workspace['term_derivatives_2d'], workspace['parameter_derivatives'])
+
+    varying = tuple(name for name, parameter in parameters.items() if parameter.vary and parameter.expr is None)
+    rows = workspace['rows'].get(varying)
+    if rows is None:
+        # Parameters which are not in the model have the zero derivatives of the last row.
+        rows = np.array([workspace['names'].index(name) if name in workspace['names'] else len(workspace['names'])
+                         for name in varying], dtype=int)
+        workspace['rows'][varying] = rows
+
+    if len(rows) > len(workspace['jacobian']):
+        workspace['jacobian'] = np.empty((len(rows), len(x)))
+    jacobian = workspace['jacobian'][:len(rows)]
+    np.take(workspace['parameter_derivatives'], rows, 0, jacobian)
+    return jacobian.T
+
+
+def _evaluate_terms(workspace, parameters, x, chain_rule=False):
+    """
+    Evaluate the terms k * m / ((x - c)**2 + w2) of the fused model of a region into the terms array of the workspace,
+    and if chain_rule is True, fill the chain rule matrix of the derivatives of the numerators, centers and squared
+    half-widths with respect to the parameters.
+
+    A Lorentzian with amplitude A, center c and half-width s is a single term with k = A * s / pi and w2 = s**2. A
+    split-Lorentzian with half-widths s and s_r is a left term with k = P * s**2 and w2 = s**2 and a right term with
+    k = P * s_r**2 and w2 = s_r**2, where P = 2 * A / (pi * (s + s_r)), masked to each side of the center.
+    """
+    center, width, numerator, chain = [], [], [], []
+
+    for lineshape, names in workspace['model']:
+        values = [parameters[name].value for name in names]
+        if lineshape == 'lorentzian':
+            amplitude, peak_center, sigma = values
+            sigma = tiny if sigma < tiny else sigma  # Same floor as Lineshapes.lorentzian.
+            center.append(peak_center)
+            width.append(sigma * sigma)
+            numerator.append(amplitude * sigma / np.pi)
+            if chain_rule:
+                # d k / d (A, s), d c / d c and d w2 / d s, the latter two with the factors of _fused_jacobian.
+                chain += [sigma / np.pi, amplitude / np.pi, 2.0, -2 * sigma]
+        else:
+            amplitude, peak_center, sigma, sigma_r = values
+            sigma = tiny if sigma < tiny else sigma
+            sigma_r = tiny if sigma_r < tiny else sigma_r
+            total = sigma + sigma_r
+            scale = 2 * amplitude / (np.pi * total)
+            center += [peak_center, peak_center]
+            width += [sigma * sigma, sigma_r * sigma_r]
+            numerator += [scale * sigma * sigma, scale * sigma_r * sigma_r]
+            if chain_rule:
+                # d k_left / d (A, s, s_r), d k_right / d (A, s, s_r), d c / d c twice, d w2_left / d s and
+                # d w2_right / d s_r.
+                chain += [2 * sigma * sigma / (np.pi * total),
+                          2 * scale * sigma - scale * sigma * sigma / total,
+                          -scale * sigma * sigma / total,
+                          2 * sigma_r * sigma_r / (np.pi * total),
+                          -scale * sigma_r * sigma_r / total,
+                          2 * scale * sigma_r - scale * sigma_r * sigma_r / total,
+                          2.0, 2.0, -2 * sigma, -2 * sigma_r]
+
+    workspace['center'][:] = center
+    workspace['width'][:] = width
+    workspace['numerator'][:] = numerator
+    if chain_rule:
+        workspace['chain'].flat[workspace['chain_index']] = chain
+
+    # Masks of the left and right terms of the split-Lorentzians, 1 on their side of the center and 0 elsewhere.
+    for row in workspace['split_rows']:
+        np.less(x, center[row], workspace['mask'][row])
+        np.greater_equal(x, center[row + 1], workspace['mask'][row + 1])
+
+    dx, denominator, terms = workspace['dx'], workspace['denominator'], workspace['terms']
+    np.subtract(x, workspace['center_column'], dx)
+    np.square(dx, denominator)
+    np.add(denominator, workspace['width_column'], denominator)
+    np.divide(workspace['numerator_column'], denominator, terms)
+    if workspace['split_rows']:
+        np.multiply(terms, workspace['mask'], terms)
+
+
+def _workspace(region, x):
+    """
+    Arrays of the fused model of a region for the x-values x, allocated on the first call with a new number of x-values
+    and reused while the same number of x-values is passed again. The arrays do not depend on the values of x.
+
+    :param region: String key of fused_models.
+    :param x: Numpy array containing the x-values.
+    :return: workspace - Dictionary of the arrays of the model, see _evaluate_terms and _fused_jacobian.
+    """
+    workspace = _workspaces.get(region)
+    if workspace is None or workspace['size'] != len(x):
+        model = fused_models[region]
+        names = [name for lineshape, peak_names in model for name in peak_names]
+
+        # Row of every term, and position in the flattened chain rule matrix of every value added by _evaluate_terms,
+        # which has one row per parameter, plus a last row of zeros, and one column per term and quantity (numerator,
+        # center, squared half-width), in blocks of the same quantity.
+        n_terms = sum(1 if lineshape == 'lorentzian' else 2 for lineshape, peak_names in model)
+        split_rows, chain_positions, row = [], [], 0
+        for lineshape, (amplitude, peak_center, *widths) in model:
+            if lineshape == 'lorentzian':
+                chain_positions += [(amplitude, row), (widths[0], row), (peak_center, n_terms + row),
+                                    (widths[0], 2 * n_terms + row)]
+                row += 1
+            else:
+                sigma, sigma_r = widths
+                split_rows.append(row)
+                chain_positions += [(amplitude, row), (sigma, row), (sigma_r, row),
+                                    (amplitude, row + 1), (sigma, row + 1), (sigma_r, row + 1),
+                                    (peak_center, n_terms + row), (peak_center, n_terms + row + 1),
+                                    (sigma, 2 * n_terms + row), (sigma_r, 2 * n_terms + row + 1)]
+                row += 2
+        chain_index = np.array([names.index(name) * 3 * n_terms + column for name, column in chain_positions])
+
+        center, width, numerator = np.zeros(n_terms), np.ones(n_terms), np.zeros(n_terms)
+        term_derivatives = np.empty((3, n_terms, len(x)))
+        workspace = {'size': len(x),
+                     'model': model,
+                     'names': names,
+                     'split_rows': split_rows,
+                     'center': center, 'center_column': center[:, np.newaxis],
+                     'width': width, 'width_column': width[:, np.newaxis],
+                     'numerator': numerator, 'numerator_column': numerator[:, np.newaxis],
+                     'mask': np.ones((n_terms, len(x))),
+                     'dx': np.empty((n_terms, len(x))),
+                     'denominator': np.empty((n_terms, len(x))),
+                     'terms': np.empty((n_terms, len(x))),
+                     'residual': np.empty(len(x)),
+                     'chain': np.zeros((len(names) + 1, 3 * n_terms)),
+                     'chain_index': chain_index,
+                     'term_derivatives': term_derivatives,
+                     'term_derivatives_2d': term_derivatives.reshape(3 * n_terms, len(x)),
+                     'parameter_derivatives': np.empty((len(names) + 1, len(x))),
+                     'jacobian': np.empty((len(names), len(x))),
+                     'rows': {}}
+        _workspaces[region] = workspace
+
+    return workspace
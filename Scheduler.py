@@ -0,0 +1,154 @@
+import pandas as pd
+import numpy as np
+import argparse
+import contextlib
+import io
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from SpectralStore import is_store
+from Manifest import manifest, read_manifest
+import AutomatedRatioExtraction
+
+
+def file_workload(file):
+    """
+    Estimate the work needed to process a raw data file from its size on disk, which is proportional to its number of
+    spectra as all files of a dataset have the same wavenumber columns.
+
+    :param file: String of the raw data filename, or the directory of a spectral store.
+    :return: Integer number of bytes of the file, or of the intensities of the spectral store.
+    """
+    if is_store(file):
+        return os.path.getsize(os.path.join(file, 'intensities.npy'))
+    return os.path.getsize(file)
+
+
+def schedule_files(files, processes=None, chunksize=None, resume=False, profile=False):
+    """
+    Process raw data files concurrently on a pool of worker processes, one file per process at a time, and write the
+    _ratio.csv file of every file as soon as the file is finished.
+
+    The files are submitted in order of decreasing workload (the longest-processing-time-first rule), so that the
+    largest files start first and the small files fill the gaps at the end, instead of a large file starting last and
+    leaving the other processes idle. The spectra of each file are fitted with cpu_count // processes worker
+    processes of its own, so the total number of processes stays close to the number of CPUs.
+
+    Everything a file prints while it is processed is captured and printed in one block together with its progress
+    line once the file is finished, so the output of concurrent files is never interleaved. A file which raises an
+    exception is reported with its traceback, and the other files carry on. This includes a file which is missing or
+    unreadable, which fails before the pool starts, when its workload is estimated, and a file whose worker process
+    dies. A dead worker breaks the whole pool, so the files which had not finished by then are reported as failed too,
+    and can be completed with a second run with --resume.
+
+    :param files: List of raw data filenames, or directories of spectral stores.
+    :param processes: Integer number of files processed at once. None uses one process per file, up to the number of
+                      CPUs.
+    :param chunksize: Integer number of spectra in each chunk when streaming, or None, see extract_ratio.
+    :param resume: Boolean. If True, continue from the checkpoints of a previous run, see extract_ratio.
+    :param profile: Boolean. If True, write the _profile.json and _profile.csv files of every file.
+
+    :return: df_schedule - DataFrame of the file, workload, status ('done' or 'failed') and seconds of every file, in
+                           the order of the input list. The workload of a file which could not be read is NaN.
+    """
+    cpu_count = os.cpu_count() or 1
+    if processes is None:
+        processes = min(len(files), cpu_count)
+    processes = max(1, min(processes, len(files)))
+
+    # Configuration of AutomatedRatioExtraction in the worker processes.
+    config = {'workers': max(1, cpu_count // processes), 'profile': profile}
+
+    results = {}
+    start = time.perf_counter()
+
+    def report(file, status, seconds, output):
+        # Print the progress line and the captured output of the file in a single write.
+        results[file] = (status, seconds)
+        elapsed = time.perf_counter() - start
+        progress = ('[{}/{}] {} {} in {:.1f} s ({:.1f} s elapsed)'.format(len(results), len(files), file, status,
+                                                                          seconds, elapsed))
+        print(progress + ('\n' + output.rstrip('\n') if output.strip() else ''), flush=True)
+
+    # A file which cannot be read, e.g. a missing file of the manifest, is reported as failed with its traceback and
+    # is not submitted, so that it does not stop the other files.
+    workloads = {}
+    for file in files:
+        try:
+            workloads[file] = file_workload(file)
+        except Exception:
+            workloads[file] = np.nan
+            report(file, 'failed', 0.0, traceback.format_exc())
+    order = sorted([file for file in files if file not in results], key=lambda file: -workloads[file])  # Largest first.
+
+    AutomatedRatioExtraction.invalidate_cache()
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(_extract_file, file, chunksize, resume, config): file for file in order}
+        for future in as_completed(futures):
+            # _extract_file catches the exceptions of the file itself, but a worker process killed e.g. by the OOM
+            # killer or a crash of a native library breaks the pool, and its files raise here instead.
+            try:
+                report(futures[future], *future.result())
+            except Exception:
+                report(futures[future], 'failed', 0.0, traceback.format_exc())
+
+    df_schedule = pd.DataFrame({'file': files,
+                                'workload': [workloads[file] for file in files],
+                                'status': [results[file][0] for file in files],
+                                'seconds': [results[file][1] for file in files]})
+
+    return df_schedule
+
+
+def _extract_file(file, chunksize, resume, config):
+    """
+    Process a single file in a worker process of schedule_files, capturing everything it prints. This must stay a
+    module-level function to be picklable.
+
+    :return: status - String 'done', or 'failed' if an exception was raised.
+             seconds - Float seconds taken by the file.
+             output - String of everything printed while processing the file, including the traceback of a failure.
+    """
+    for name, value in config.items():
+        setattr(AutomatedRatioExtraction, name, value)
+
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        try:
+            AutomatedRatioExtraction.extract_ratio(file, chunksize=chunksize, resume=resume)
+            status = 'done'
+        except Exception:
+            traceback.print_exc(file=output)
+            status = 'failed'
+
+    return status, time.perf_counter() - start, output.getvalue()
+
+
+# The worker processes re-import this script, so the scheduler must only run in the main process.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract the AUC ratio of every condition from the files of a '
+                                                 'manifest, processing the files concurrently.')
+    parser.add_argument('manifest', nargs='?', default=manifest,
+                        help='manifest .csv file with the file and time columns (default: ' + manifest + ')')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of files processed at once (default: one per file, up to the number of CPUs)')
+    parser.add_argument('--chunksize', type=int, default=AutomatedRatioExtraction.chunksize,
+                        help='number of spectra read at a time, to stream files larger than memory')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip files completed by a previous run and continue partial files from their last '
+                             'checkpoint')
+    parser.add_argument('--profile', action='store_true',
+                        help='write a _profile.json and a _profile.csv file of the stage timings and fit statistics '
+                             'of every file')
+    args = parser.parse_args()
+
+    df_manifest = read_manifest(args.manifest)
+    df_schedule = schedule_files(list(df_manifest['file']), processes=args.processes, chunksize=args.chunksize,
+                                 resume=args.resume, profile=args.profile or AutomatedRatioExtraction.profile)
+
+    n_failed = int(np.sum(df_schedule['status'] == 'failed'))
+    print('Finished Processing all Files.' if n_failed == 0 else
+          'Finished Processing all Files, ' + str(n_failed) + ' failed.')
@@ -0,0 +1,151 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+store_extension = '.store'  # Directory extension of binary spectral stores, e.g. df_t0.csv -> df_t0.store
+
+
+def convert_csv_to_store(raw_data_filename, store_directory=None, n_label_columns=2, dtype=np.float64,
+                         chunksize=10000):
+    """
+    Convert a text .csv file of extracted spectra into a binary spectral store, so that the text does not have to be
+    parsed again on every run. The store is a directory containing:
+    1. intensities.npy - Numpy array of shape (spectra, wavenumbers) of all intensities, which is memory-mapped when
+                         the store is opened.
+    2. wavenumbers.npy - Numpy array of the wavenumbers (x-values) parsed from the column labels.
+    3. labels.csv - The label columns (e.g. the original index and the Condition column), if there are any.
+    4. metadata.json - The names of the label columns, the number of spectra and the dtype of the intensities.
+
+    The .csv file is parsed in chunks of chunksize rows which are written directly into the memory-mapped intensities,
+    so files larger than the available memory can be converted.
+
+    :param raw_data_filename: String containing the filename with extension of .csv containing all extracted spectra.
+    :param store_directory: String of the store directory. Defaults to the .csv filename with the .store extension.
+    :param n_label_columns: Integer number of leading label columns before the wavenumber columns. This is 2 for the
+                            df_t*.csv files (original index and Condition) and 0 for files with only wavenumber columns.
+    :param dtype: Numpy float dtype of the stored intensities, np.float64 (default) or np.float32.
+    :param chunksize: Integer number of spectra parsed at a time.
+
+    :return: store_directory - String of the store directory.
+    """
+    if store_directory is None:
+        store_directory = os.path.splitext(raw_data_filename)[0] + store_extension
+    os.makedirs(store_directory, exist_ok=True)
+
+    columns = pd.read_csv(raw_data_filename, nrows=0).columns  # Read only the header line.
+    label_columns = list(columns[:n_label_columns])
+    wavenumbers = np.array(columns[n_label_columns:], dtype=float)
+
+    # Count the spectra without parsing them, so that the memory-mapped intensities can be allocated up front.
+    with open(raw_data_filename, 'rb') as f:
+        n_rows = sum(1 for line in f if line.strip()) - 1  # Do not count the header line.
+
+    intensities = np.lib.format.open_memmap(os.path.join(store_directory, 'intensities.npy'), mode='w+',
+                                            dtype=dtype, shape=(n_rows, len(wavenumbers)))
+    labels = []
+
+    row = 0
+    with pd.read_csv(raw_data_filename, chunksize=chunksize) as reader:
+        for df in reader:
+            intensities[row:row + len(df)] = df.iloc[:, n_label_columns:].to_numpy(dtype=dtype)
+            labels.append(df.iloc[:, :n_label_columns])
+            row += len(df)
+
+    intensities.flush()
+    del intensities  # Close the memory map.
+
+    np.save(os.path.join(store_directory, 'wavenumbers.npy'), wavenumbers)
+    if label_columns:
+        pd.concat(labels).to_csv(os.path.join(store_directory, 'labels.csv'), index=False)
+
+    metadata = {'source': os.path.basename(raw_data_filename),
+                'label_columns': label_columns,
+                'n_spectra': n_rows,
+                'dtype': np.dtype(dtype).name}
+    with open(os.path.join(store_directory, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=4)
+
+    return store_directory
+
+
+def is_store(filename):
+    """
+    Check whether the filename refers to a binary spectral store created by convert_csv_to_store.
+
+    :param filename: String of a .csv filename or a store directory.
+    :return: Boolean, True if filename is a store directory.
+    """
+    return os.path.isdir(filename) and os.path.isfile(os.path.join(filename, 'metadata.json'))
+
+
+def open_store(store_directory):
+    """
+    Open a binary spectral store. The intensities are memory-mapped rather than read, so opening a store is
+    instantaneous and slicing a window of columns out of the intensities is a view that does not copy any data.
+
+    :param store_directory: String of the store directory.
+
+    :return: df_labels - DataFrame of the label columns, with no columns if the store has no label columns.
+             wavenumbers - Numpy array of the wavenumbers (x-values).
+             intensities - Read-only memory-mapped Numpy array of shape (spectra, wavenumbers).
+             n_label_columns - Integer number of label columns, which is the offset between the column indices of the
+                               original .csv file and the column indices of the intensities.
+    """
+    with open(os.path.join(store_directory, 'metadata.json')) as f:
+        metadata = json.load(f)
+
+    intensities = np.load(os.path.join(store_directory, 'intensities.npy'), mmap_mode='r')
+    wavenumbers = np.load(os.path.join(store_directory, 'wavenumbers.npy'))
+
+    if metadata['label_columns']:
+        df_labels = pd.read_csv(os.path.join(store_directory, 'labels.csv'))
+    else:
+        df_labels = pd.DataFrame(index=pd.RangeIndex(metadata['n_spectra']))
+
+    return df_labels, wavenumbers, intensities, len(metadata['label_columns'])
+
+
+def store_dataframe(store_directory):
+    """
+    Open a binary spectral store as a DataFrame of the intensities only, with the wavenumbers as the column labels, in
+    the same layout as a .csv file with only wavenumber columns. The DataFrame is a view on the memory-mapped
+    intensities.
+
+    :param store_directory: String of the store directory.
+    :return: df - DataFrame with one spectrum per row and the wavenumbers as the column labels.
+    """
+    df_labels, wavenumbers, intensities, n_label_columns = open_store(store_directory)
+
+    return pd.DataFrame(intensities, columns=wavenumbers, copy=False)
+
+
+def read_spectra_table(filename):
+    """
+    Read a table of spectra from either a .csv file or a binary spectral store, for scripts that expect a DataFrame
+    with the wavenumbers as the column labels.
+
+    :param filename: String of a .csv filename or a store directory.
+    :return: df - DataFrame with one spectrum per row.
+    """
+    if is_store(filename):
+        return store_dataframe(filename)
+
+    return pd.read_csv(filename)
+
+
+if __name__ == '__main__':
+    # Convert the .csv files given on the command line, e.g. python SpectralStore.py df_t0.csv df_t30.csv
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert .csv files of extracted spectra into binary spectral stores.')
+    parser.add_argument('files', nargs='+', help='.csv files to convert')
+    parser.add_argument('--label-columns', type=int, default=2,
+                        help='number of leading label columns (2 for df_t*.csv files, 0 for wavenumber-only files)')
+    parser.add_argument('--float32', action='store_true', help='store the intensities as float32 instead of float64')
+    args = parser.parse_args()
+
+    for raw_data_filename in args.files:
+        store_directory = convert_csv_to_store(raw_data_filename, n_label_columns=args.label_columns,
+                                               dtype=np.float32 if args.float32 else np.float64)
+        print('Converted ' + raw_data_filename + ' to ' + store_directory)